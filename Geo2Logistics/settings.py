@@ -63,6 +63,59 @@ REST_FRAMEWORK = {
     #'DEFAULT_PERMISSION_CLASSES': ('rest_framework.permissions.IsAdminUser',),
     'PAGE_SIZE': 10
 }
+# ?limit= upper bound for keyset-paginated lists (logistics.pagination)
+PAGINATION_MAX_LIMIT = 100
+# trips returned by /api/driver/trips/ and available_trips/ without ?limit=
+DRIVER_TRIPS_LIMIT = 500
+# rows accepted by one /api/fleet/<id>/import_trips/ request (logistics.tripimport)
+TRIP_IMPORT_MAX_ROWS = 5000
+# rows per query when streaming /api/fleet/<id>/trips/finished/export.* (logistics.tripexport)
+TRIP_EXPORT_CHUNK = 1000
+
+# Geo2Tag instance; point it at `manage.py geo2tag_standin` to work offline
+GEO2TAG_SERVER_URL = os.environ.get('GEO2TAG_SERVER_URL', "http://demo.geo2tag.org/instance/")
+GEO2TAG_SERVICE_NAME = "testservice"
+
+# Geo2Tag HTTP client (logistics.Geo2TagService.Geo2TagClient)
+GEO2TAG_POOL_SIZE = 10  # keep-alive connections per host
+GEO2TAG_POOL_TIMEOUT = 5  # seconds a request waits for a free connection before failing
+GEO2TAG_CONNECT_TIMEOUT = 3  # seconds
+GEO2TAG_READ_TIMEOUT = 10  # seconds
+GEO2TAG_RETRIES = 2  # retries of idempotent requests (GET, DELETE)
+GEO2TAG_RETRY_BACKOFF = 0.3
+GEO2TAG_BREAKER_THRESHOLD = 5  # consecutive failures before the circuit opens
+GEO2TAG_BREAKER_RESET = 30  # seconds before a trial request is let through
+GEO2TAG_POINTS_PER_REQUEST = 200  # points sent in one multi-point POST /point
+GEO2TAG_OID_CACHE_TTL = 60  # seconds a channel/point oid is served from the local cache
+GEO2TAG_BACKGROUND_WORKERS = 2  # threads creating fleet channels off the request path
+
+# Write-behind queue for /api/driver/update_pos/ (logistics.positions)
+POSITION_FLUSH_INTERVAL = 2  # seconds between background flushes to Geo2Tag
+POSITION_BATCH_SIZE = 500  # inline flush threshold when the flusher thread is not running
+
+# Coalesced Driver.last_seen writes from UpdateOnlineMiddleware (logistics.presence)
+PRESENCE_FLUSH_INTERVAL = 15  # seconds between bulk last_seen updates
+
+# Cached user -> owner/driver profile id (logistics.versions)
+PROFILE_CACHE_TTL = 5 * 60  # seconds; deleting a profile clears it in the worker that deleted it
+
+# Versioned list responses with ETag (logistics.versions)
+RESPONSE_CACHE_TTL = 10 * 60  # seconds a serialized list stays cached for its version
+
+# Server-sent events per fleet, /api/fleet/<id>/events/ (logistics.events)
+FLEET_EVENTS_BUFFER = 256  # events kept per subscriber before the oldest are dropped
+FLEET_EVENTS_HISTORY = 256  # recent events per fleet replayed on reconnect with Last-Event-ID
+FLEET_EVENTS_KEEPALIVE = 15  # seconds between keepalive comments on an idle stream
+FLEET_EVENTS_MAX_DURATION = 5 * 60  # seconds before a stream is closed and the client reconnects
+FLEET_EVENTS_MAX_SUBSCRIBERS = 500  # open streams per process; each one holds a server thread
+DRIVER_WAIT_TIMEOUT = 25  # seconds /api/driver/available_trips/wait/ holds a request open
+DRIVER_WAIT_RETRY_AFTER = 5  # seconds a driver waits before retrying when all wait slots are taken
+AVAILABLE_TRIPS_REFRESH = 30  # seconds before a fleet's in-memory free trips are reloaded
+
+# Nearest-driver grid index (logistics.spatial)
+DRIVER_INDEX_CELL_SIZE = 0.01  # degrees, about 1 km
+DRIVER_INDEX_REFRESH = 30  # seconds before a fleet grid is reloaded from DriverStats
+DRIVER_INDEX_MAX_AGE = 30 * 60  # seconds a position stays usable for dispatch
 
 TEMPLATES = [
     {
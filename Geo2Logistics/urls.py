@@ -17,12 +17,9 @@ from django.conf.urls import url, include
 from django.contrib import admin
 
 import logistics.urls
-from logistics.Geo2TagService import one_time_startup
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     url(r'^', include(logistics.urls)),
 ]
-
-one_time_startup()
@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Geo2Logistics.settings")
 
 application = get_wsgi_application()
+
+from logistics.Geo2TagService import one_time_startup
+from logistics.positions import position_queue
+from logistics.presence import presence
+
+one_time_startup()
+position_queue.start()
+presence.start()
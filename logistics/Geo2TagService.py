@@ -1,24 +1,248 @@
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
-from logistics.models import Fleet
+from logistics.models import Fleet, FleetChannel, DriverPoint, Trip
 
-SERVER_URL = "http://demo.geo2tag.org/instance/"
-BASE_SERVICE_NAME = "testservice"
+SERVER_URL = getattr(settings, 'GEO2TAG_SERVER_URL', "http://demo.geo2tag.org/instance/")
+BASE_SERVICE_NAME = getattr(settings, 'GEO2TAG_SERVICE_NAME', "testservice")
 SERVICE_NAME = BASE_SERVICE_NAME
+POINTS_PER_REQUEST = getattr(settings, 'GEO2TAG_POINTS_PER_REQUEST', 200)
+
+
+# хранилище oid объектов Geo2Tag: таблица в БД, общая для всех воркеров,
+# и небольшой локальный read-through кэш поверх неё
+class OidStore(object):
+    def __init__(self, model, ttl):
+        self.model = model
+        self.ttl = ttl
+        self._cache = {}  # key -> (oid, cached_at)
+        self._lock = threading.Lock()
+
+    def _remember(self, key, oid):
+        with self._lock:
+            self._cache[key] = (oid, time.time())
+
+    def _forget(self, keys):
+        with self._lock:
+            for key in keys:
+                self._cache.pop(key, None)
+
+    def get(self, key, default=None):
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached is not None and time.time() - cached[1] < self.ttl:
+            return cached[0]
+        oid = self.model.objects.filter(pk=key).values_list('oid', flat=True).first()
+        if oid is None:
+            self._forget([key])
+            return default
+        self._remember(key, oid)
+        return oid
+
+    # читает oid сразу для многих ключей одним запросом, минуя локальный кэш
+    def get_many(self, keys):
+        found = dict(self.model.objects.filter(pk__in=keys).values_list('pk', 'oid'))
+        for key, oid in found.items():
+            self._remember(key, oid)
+        self._forget([key for key in keys if key not in found])
+        return found
+
+    def __getitem__(self, key):
+        oid = self.get(key)
+        if oid is None:
+            raise KeyError(key)
+        return oid
+
+    def __setitem__(self, key, oid):
+        self.set_many({key: oid})
+
+    def set_many(self, mapping):
+        if not mapping:
+            return
+        pk_name = self.model._meta.pk.attname
+        with transaction.atomic():
+            self.model.objects.filter(pk__in=list(mapping)).delete()
+            self.model.objects.bulk_create([self.model(**{pk_name: key, 'oid': oid}) for key, oid in mapping.items()])
+        for key, oid in mapping.items():
+            self._remember(key, oid)
+
+    # oid читается из БД, а не из кэша: другой воркер мог уже заменить его
+    def pop(self, key, default=None):
+        oid = self.get_many([key]).get(key)
+        if oid is None:
+            return default
+        self.delete_unchanged({key: oid})
+        return oid
+
+    def delete_many(self, keys):
+        self.model.objects.filter(pk__in=keys).delete()
+        self._forget(keys)
+
+    # удаляет строки, только если в них всё ещё прочитанный oid {key: oid}; если объект
+    # тем временем заменили, строка указывает на новый и остаётся (oid уникальны, поэтому
+    # хватает одного запроса по pk__in и oid__in)
+    def delete_unchanged(self, mapping):
+        if not mapping:
+            return
+        self.model.objects.filter(pk__in=list(mapping), oid__in=list(mapping.values())).delete()
+        self._forget(list(mapping))
+
+    def clear(self):
+        self.model.objects.all().delete()
+        with self._lock:
+            self._cache.clear()
 
-channel_dict = {}
-points_dict = {}
+
+OID_CACHE_TTL = getattr(settings, 'GEO2TAG_OID_CACHE_TTL', 60)
+channel_dict = OidStore(FleetChannel, OID_CACHE_TTL)
+points_dict = OidStore(DriverPoint, OID_CACHE_TTL)
+
+
+class Geo2TagUnavailable(Exception):
+    pass
+
+
+# HTTP-клиент Geo2Tag: пул keep-alive соединений, таймауты, повторы с паузой
+# и circuit breaker, который после серии ошибок сразу отказывает, не занимая воркер
+class Geo2TagClient(object):
+    def __init__(self, pool_size=10, connect_timeout=3, read_timeout=10, retries=2, backoff=0.3,
+                 failure_threshold=5, reset_timeout=30, pool_timeout=5):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_timeout = pool_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+        # не больше pool_size запросов одновременно; остальные ждут соединение не дольше pool_timeout
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+        # POST не повторяется (не идемпотентен), GET и DELETE - повторяются
+        retry = Retry(total=retries, connect=retries, read=retries, backoff_factor=backoff,
+                      status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None and time.time() - self._opened_at < self.reset_timeout
+
+    # можно ли отправить запрос; в half-open пропускается один пробный запрос, остальные
+    # отказывают сразу, пока он не вернётся (или не пройдёт ещё reset_timeout)
+    def _allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.time() - self._opened_at >= self.reset_timeout:
+                self._opened_at = time.time()
+                return True
+            return False
+
+    def _record(self, success):
+        with self._lock:
+            if success:
+                self._failures = 0
+                self._opened_at = None
+            else:
+                self._failures += 1
+                if self._failures >= self.failure_threshold:
+                    self._opened_at = time.time()
+
+    def request(self, method, url, **kwargs):
+        if not self._slots.acquire(timeout=self.pool_timeout):
+            raise Geo2TagUnavailable("No free Geo2Tag connection, skip " + method + " " + url)
+        try:
+            if not self._allow():
+                raise Geo2TagUnavailable("Geo2Tag circuit is open, skip " + method + " " + url)
+            kwargs.setdefault('timeout', self.timeout)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException:
+                self._record(False)
+                raise
+            self._record(response.status_code < 500)
+            return response
+        finally:
+            self._slots.release()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    # параллельные DELETE через пул соединений, возвращает пары (url, ответ или исключение)
+    def delete_many(self, urls, **kwargs):
+        def delete(url):
+            try:
+                return url, self.delete(url, **kwargs)
+            except Exception as e:
+                return url, e
+
+        if not urls:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.pool_size, len(urls))) as executor:
+            return list(executor.map(delete, urls))
+
+
+client = Geo2TagClient(
+    pool_size=getattr(settings, 'GEO2TAG_POOL_SIZE', 10),
+    connect_timeout=getattr(settings, 'GEO2TAG_CONNECT_TIMEOUT', 3),
+    read_timeout=getattr(settings, 'GEO2TAG_READ_TIMEOUT', 10),
+    retries=getattr(settings, 'GEO2TAG_RETRIES', 2),
+    backoff=getattr(settings, 'GEO2TAG_RETRY_BACKOFF', 0.3),
+    failure_threshold=getattr(settings, 'GEO2TAG_BREAKER_THRESHOLD', 5),
+    reset_timeout=getattr(settings, 'GEO2TAG_BREAKER_RESET', 30),
+    pool_timeout=getattr(settings, 'GEO2TAG_POOL_TIMEOUT', 5),
+)
 
 
 def getSerivceUrl():
     return SERVER_URL + "service/" + SERVICE_NAME
 
+
+startup_stats = {}
+
+
+# запускается из wsgi.py: сверка каналов идёт в фоне и не задерживает первые запросы
 def one_time_startup():
     print("Application startup execution")
-    createService()
-    clearAllFleetChannels()
+    thread = threading.Thread(target=startupReconciliation, name="geo2tag-startup")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def startupReconciliation():
+    started = time.time()
+    startup_stats.clear()
+    startup_stats["status"] = "running"
+    try:
+        createService()
+        startup_stats.update(reconcileFleetChannels())
+        startup_stats["status"] = "ok"
+    except Exception as e:
+        startup_stats["status"] = "error"
+        startup_stats["error"] = str(e)
+        print("EXCEPTION WHILE startupReconciliation: " + str(e))
+    finally:
+        startup_stats["duration"] = time.time() - started
+        close_old_connections()
+    print("startup reconciliation: " + str(startup_stats))
 
 
 def createService():
@@ -35,16 +259,51 @@ def createService():
     pass
 
 # возвращает url карты (при открытии driver-fleet-id)
+# в Geo2Tag не ходит: берёт oid канала из хранилища, а если канала ещё нет -
+# ставит его создание в фон и возвращает None, страница показывается без карты
 def getFleetMap(fleet_id):
     try:
-        fleet = Fleet.objects.get(id=fleet_id)
-        channel_id = getOrCreateFleetChannel(fleet)
-    except:
-        channel_id = "none"
+        fleet_id = int(fleet_id)
+    except ValueError:
+        return None
+    channel_id = channel_dict.get(fleet_id)
+    if channel_id is None:
+        createFleetChannelAsync(fleet_id)
+        return None
 
     return getSerivceUrl() + "/map?zoom=10&latitude=59.8944&longitude=30.2642&channel_ids=[\""+str(channel_id)+"\"]"
 
 
+background = ThreadPoolExecutor(max_workers=getattr(settings, 'GEO2TAG_BACKGROUND_WORKERS', 2))
+scheduled_channels = set()
+scheduled_lock = threading.Lock()
+
+
+# создаёт канал автопарка в фоне после коммита транзакции (при создании автопарка и при открытии карты)
+def createFleetChannelAsync(fleet_id):
+    transaction.on_commit(lambda: submitFleetChannel(fleet_id))
+
+
+def submitFleetChannel(fleet_id):
+    with scheduled_lock:
+        if fleet_id in scheduled_channels:
+            return
+        scheduled_channels.add(fleet_id)
+    background.submit(createFleetChannel, fleet_id)
+
+
+def createFleetChannel(fleet_id):
+    try:
+        fleet = Fleet.objects.select_related('owner').get(id=fleet_id)
+        getOrCreateFleetChannel(fleet)
+    except Exception as e:
+        print("EXCEPTION WHILE createFleetChannel: " + str(e))
+    finally:
+        with scheduled_lock:
+            scheduled_channels.discard(fleet_id)
+        close_old_connections()
+
+
 # создаёт канал для автопарка, если не существует (при добавлении точки updateDriverPos)
 # возвращает oid канала для fleet
 def getOrCreateFleetChannel(fleet):
@@ -57,12 +316,15 @@ def getOrCreateFleetChannel(fleet):
         url = getSerivceUrl() + '/channel'
         full_name = str(fleet.name) + "_" + str(fleet.id)
         data = {'name': full_name, 'json': {'name': str(fleet.name), 'id': str(fleet.id), 'owner': fleet.owner.first_name+' '+fleet.owner.last_name}}
-        request = requests.post(url, data=data)
+        request = client.post(url, data=data)
         response = request.text
         channel_exists = response == 'null'
         if channel_exists:
+            # канал уже создан другим воркером или до перезапуска
             print(full_name+' already exists : '+str(channel_exists))
-            oid = None
+            oid = channel_dict.get(fleet.id, None) or findFleetChannel(full_name)
+            if oid is not None:
+                channel_dict[fleet.id] = oid
         else:
             oid = json.loads(response)["$oid"]
             channel_dict[fleet.id] = oid
@@ -72,13 +334,23 @@ def getOrCreateFleetChannel(fleet):
         print("EXCEPTION WHILE createFleetChannel: " + str(e))
 
 
+# ищет oid существующего канала по имени
+def findFleetChannel(full_name):
+    url = getSerivceUrl() + '/channel?number=0'
+    request = client.get(url)
+    for channel in json.loads(request.text):
+        if channel.get("name") == full_name:
+            return channel["_id"]["$oid"]
+    return None
+
+
 # удаляет канал автопарка (при удалении автопарка)
 def deleteFleetChannel(fleet):
     try:
         channel_oid = channel_dict.get(fleet.id)
         headers = {'content-type': 'application/json'}
         url = getSerivceUrl() + "/channel/" + channel_oid
-        request = requests.delete(url, headers=headers)
+        request = client.delete(url, headers=headers)
         channel_dict.pop(fleet.id)
         print("delete channel of fleet " + str(fleet) +" result: "+request.text)
 
@@ -86,24 +358,69 @@ def deleteFleetChannel(fleet):
         print("EXCEPTION WHILE deleteFleetChannel: " + str(e))
 
 
-# удаляет все каналы (при запуске приложения)
+# сверяет каналы Geo2Tag с автопарками в БД (при запуске приложения):
+# удаляет только каналы-сироты и лишние дубли, восстанавливает кэш oid каналов
+# и убирает точки водителей, у которых нет текущего рейса
+def reconcileFleetChannels():
+    url = getSerivceUrl() + '/channel?number=0'
+    remote_channels = json.loads(client.get(url).text)
+
+    fleet_ids = {}
+    for fleet_id, name in Fleet.objects.values_list('id', 'name'):
+        fleet_ids[str(name) + "_" + str(fleet_id)] = fleet_id
+    stored = dict(FleetChannel.objects.values_list('fleet_id', 'oid'))
+
+    matched = {}
+    orphans = []
+    for channel in remote_channels:
+        channel_oid = channel["_id"]["$oid"]
+        fleet_id = fleet_ids.get(channel.get("name"))
+        if fleet_id is None:
+            orphans.append(channel_oid)
+        elif fleet_id not in matched or stored.get(fleet_id) == channel_oid:
+            if fleet_id in matched:
+                orphans.append(matched[fleet_id])
+            matched[fleet_id] = channel_oid
+        else:
+            orphans.append(channel_oid)
+
+    headers = {'content-type': 'application/json'}
+    failed = [url for url, result in client.delete_many([getSerivceUrl() + "/channel/" + oid for oid in orphans], headers=headers)
+              if isinstance(result, Exception)]
+
+    channel_dict.delete_many([fleet_id for fleet_id in stored if fleet_id not in matched])
+    channel_dict.set_many({fleet_id: oid for fleet_id, oid in matched.items() if stored.get(fleet_id) != oid})
+
+    active_drivers = Trip.objects.filter(is_finished=False, driver__isnull=False).values_list('driver_id', flat=True)
+    stale_points = dict(DriverPoint.objects.exclude(driver_id__in=active_drivers).values_list('driver_id', 'oid'))
+    client.delete_many([getSerivceUrl() + '/point/' + oid for oid in stale_points.values()])
+    points_dict.delete_many(list(stale_points))
+
+    return {
+        "remote_channels": len(remote_channels),
+        "matched_channels": len(matched),
+        "deleted_channels": len(orphans) - len(failed),
+        "failed_deletes": len(failed),
+        "stale_points": len(stale_points),
+    }
+
+
+# удаляет все каналы (при /api/reload/)
 def clearAllFleetChannels():
     print("delete all channels")
 
     try:
         url = getSerivceUrl() + '/channel?number=0'
-        request = requests.get(url)
+        request = client.get(url)
         response = request.text
         print(response)
         parsed_string = json.loads(response)
-        for channel in parsed_string:
-            channel_oid = channel["_id"]["$oid"]
-            headers = {'content-type': 'application/json'}
-            url = getSerivceUrl() + "/channel/" + channel_oid
-            print("DELETE " + url)
-            requests.delete(url, headers=headers)
-            channel_dict.clear()
-            points_dict.clear()
+        headers = {'content-type': 'application/json'}
+        urls = [getSerivceUrl() + "/channel/" + channel["_id"]["$oid"] for channel in parsed_string]
+        for url, result in client.delete_many(urls, headers=headers):
+            print("DELETE " + url + " " + str(getattr(result, 'text', result)))
+        channel_dict.clear()
+        points_dict.clear()
 
     except Exception as e:
         print("EXCEPTION WHILE clearAllFleetChannels: " + str(e))
@@ -111,49 +428,93 @@ def clearAllFleetChannels():
 
 # обновляет текущее метоположение водителя ( при api/driver/update_pos/)
 def updateDriverPos(fleet, driver, lat, lon):
-    try:
-        channel_oid = getOrCreateFleetChannel(fleet)
-        if channel_oid is not None:
-            point_oid = points_dict.get(driver.id, None)
+    publishDriverPositions([(fleet, driver, lat, lon)])
 
-            url = getSerivceUrl() + '/point'
-            data = [{"lon": float(lat), "lat": float(lon), "alt": 1.1,
-                     "json": {"name": driver.first_name + " " + driver.last_name}, "channel_id": channel_oid}]
-            if point_oid is None:
-                request = requests.post(url, data=json.dumps(data))
-                point_oid = json.loads(request.text)[0]
-                points_dict[driver.id] = point_oid
-                print("added point " + str(lat) + " " + str(lon) + " for driver " + str(driver) + " in fleet " + str(fleet) + " result: "+request.text)
 
-            else:
-                # delete old
-                del_url = getSerivceUrl() + '/point/' + point_oid
-                request = requests.delete(del_url)
-                success = request.text == '{}'
-                if success:
-                    points_dict.pop(driver.id)
-                    # add new
-                    request = requests.post(url, data=json.dumps(data))
-                    point_oid = json.loads(request.text)[0]
-                    points_dict[driver.id] = point_oid
-                    print("updated point " + str(lat) + " " + str(lon) + " for driver " + str(driver) + " in fleet " + str(fleet) + " result: " + request.text)
-
-                else:
-                    print("error while delete "+request.text)
+# публикует местоположения сразу многих водителей (возможно, из разных автопарков):
+# один POST /point со списком точек на пачку и удаление вытесненных точек
+# возвращает количество опубликованных точек
+def publishDriverPositions(updates):
+    published = 0
+    try:
+        channels = {}
+        latest = {}
+        for fleet, driver, lat, lon in updates:
+            if fleet.id not in channels:
+                channels[fleet.id] = getOrCreateFleetChannel(fleet)
+            if channels[fleet.id] is not None:
+                latest[driver.id] = (fleet, driver, lat, lon)
+        entries = list(latest.values())
+
+        url = getSerivceUrl() + '/point'
+        for start in range(0, len(entries), POINTS_PER_REQUEST):
+            batch = entries[start:start + POINTS_PER_REQUEST]
+            data = [{"lon": float(lat), "lat": float(lon), "alt": 1.1,
+                     "json": {"name": driver.first_name + " " + driver.last_name}, "channel_id": channels[fleet.id]}
+                    for fleet, driver, lat, lon in batch]
+            request = client.post(url, data=json.dumps(data))
+            point_oids = json.loads(request.text)
+            if len(point_oids) != len(batch):
+                print("error while publish points: " + request.text)
+                continue
+
+            old_oids = points_dict.get_many([driver.id for fleet, driver, lat, lon in batch])
+            superseded = [getSerivceUrl() + '/point/' + old_oid for old_oid in old_oids.values()]
+            points_dict.set_many({driver.id: point_oid for (fleet, driver, lat, lon), point_oid in zip(batch, point_oids)})
+            published += len(batch)
+            print("published " + str(len(batch)) + " points, superseded " + str(len(superseded)))
+
+            # старые точки удаляются после добавления новых, чтобы водитель не пропадал с карты
+            for del_url, result in client.delete_many(superseded):
+                if isinstance(result, Exception) or result.text != '{}':
+                    print("error while delete " + del_url + " " + str(getattr(result, 'text', result)))
 
     except Exception as e:
-        print("EXCEPTION WHILE updateDriverPos: " + str(e))
+        print("EXCEPTION WHILE publishDriverPositions: " + str(e))
+    return published
 
 
 # удаляет точку, соответствующую водителю в автопарке fleet (при исключении водителя из автопарка и при завершении поездки)
 def deleteDriverPos(fleet, driver):
     try:
-        point_oid = points_dict.get(driver.id)
+        # из БД, как в get_many: в кэше воркера может быть точка, уже заменённая другим воркером
+        point_oid = points_dict.get_many([driver.id])[driver.id]
         url = getSerivceUrl() + '/point/' + point_oid
-        request = requests.delete(url)
-        points_dict.pop(driver.id)
+        request = client.delete(url)
+        points_dict.delete_unchanged({driver.id: point_oid})
         print("cleared position for driver " + str(driver) + " from fleet " + str(fleet) + " result: "+request.text)
     except Exception as e:
         print("EXCEPTION WHILE deleteDriverPos: " + str(e))
 
 
+# удаляет точки нескольких водителей автопарка параллельными запросами (массовое исключение из автопарка)
+def deleteDriverPositions(fleet_id, driver_ids):
+    try:
+        oids = points_dict.get_many(driver_ids)
+        urls = {getSerivceUrl() + '/point/' + oid: driver_id for driver_id, oid in oids.items()}
+        deleted = []
+        for url, result in client.delete_many(list(urls)):
+            if isinstance(result, Exception):
+                print("error while delete " + url + " " + str(result))
+            else:
+                deleted.append(urls[url])
+        points_dict.delete_unchanged({driver_id: oids[driver_id] for driver_id in deleted})
+        print("cleared positions of " + str(len(deleted)) + " drivers from fleet " + str(fleet_id))
+    except Exception as e:
+        print("EXCEPTION WHILE deleteDriverPositions: " + str(e))
+
+
+# то же в фоне после коммита транзакции, чтобы запрос не ждал Geo2Tag
+def deleteDriverPositionsAsync(fleet_id, driver_ids):
+    driver_ids = list(driver_ids)
+    if driver_ids:
+        transaction.on_commit(lambda: background.submit(deleteDriverPositionsInBackground, fleet_id, driver_ids))
+
+
+def deleteDriverPositionsInBackground(fleet_id, driver_ids):
+    try:
+        deleteDriverPositions(fleet_id, driver_ids)
+    finally:
+        close_old_connections()
+
+
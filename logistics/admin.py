@@ -1,5 +1,5 @@
 from django.contrib import admin
 
-from logistics.models import Trip, Driver, Fleet, Owner, DriverStats, TripStats
+from logistics.models import Trip, Driver, Fleet, Owner, DriverStats, TripStats, FleetChannel, DriverPoint, DriverPosition
 
-admin.site.register([Trip, Driver, Fleet, Owner, DriverStats, TripStats])
\ No newline at end of file
+admin.site.register([Trip, Driver, Fleet, Owner, DriverStats, TripStats, FleetChannel, DriverPoint, DriverPosition])
\ No newline at end of file
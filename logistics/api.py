@@ -1,18 +1,39 @@
+import time
+
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User, Group
+from django.db import connection, transaction, IntegrityError
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from rest_framework import status
 from rest_framework.authentication import BasicAuthentication, SessionAuthentication
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from logistics.Geo2TagService import updateDriverPos, deleteFleetChannel, deleteDriverPos, clearAllFleetChannels
-from logistics.permissions import is_driver, is_owner, IsOwnerPermission, IsDriverPermission, IsOwnerOrDriverPermission
+from logistics.Geo2TagService import createFleetChannelAsync, deleteFleetChannel, deleteDriverPos, deleteDriverPositionsAsync, \
+    clearAllFleetChannels, startup_stats
+from logistics.events import fleet_events, available_trips, publishPosition, publishTrips, streamEvents, waitTripNotices
+from logistics.pagination import listData
+from logistics.positions import position_queue
+from logistics.presence import presence
+from logistics.spatial import driver_index
+from logistics.tripexport import exportTripChunks, ndjsonLines, csvLines
+from logistics.tripimport import readTripRows, validateTripRows, createTrips, IMPORT_MAX_ROWS
+from logistics.tripstats import updateTripStats, recomputeTripStatsLater
+from logistics.versions import versionedResponse, bumpFleets, bumpMembership, bumpDriverFleets, profileId, \
+    driverFleetIds, ownerFleetIds
+from logistics.permissions import is_driver, is_owner, owns_fleet, in_fleet, IsOwnerPermission, IsDriverPermission, IsOwnerOrDriverPermission
 from .forms import SignUpForm, LoginForm, FleetAddForm, FleetInviteDismissForm, DriverPendingFleetAddDeclineForm, AddTripForm, DriverReportProblemForm, \
-    DriverAcceptTripForm, DriverUpdatePosForm
-from .models import Fleet, Driver, Owner, DriverStats, Trip
-from .serializers import FleetSerializer, DriverSerializer, TripSerializer
+    DriverAcceptTripForm, DriverUpdatePosForm, NearestDriversForm, TripExportForm
+from .models import Fleet, Driver, Owner, DriverStats, Trip, DriverPosition
+from .serializers import FleetSerializer, DriverSerializer, TripSerializer, DriverLocationSerializer, \
+    DriverPositionSerializer
+
+# ограничение списков рейсов водителя без ?limit= (свежие первыми)
+DRIVER_TRIPS_LIMIT = getattr(settings, 'DRIVER_TRIPS_LIMIT', 500)
 
 
 class CsrfExemptSessionAuthentication(SessionAuthentication):
@@ -81,13 +102,15 @@ class FleetList(APIView):
 
     def get(self, request):
         if is_owner(request.user):
-            fleets = Fleet.objects.filter(owner=request.user.owner)
-            serialized_fleets = FleetSerializer(fleets, many=True)
-            return Response(serialized_fleets.data, status=status.HTTP_200_OK)
+            owner_id = profileId(request.user, 'owner')
+            fleets = FleetSerializer.with_counts(Fleet.objects.filter(owner_id=owner_id))
+            scopes = [('owner', owner_id)] + [('fleet', fleet_id) for fleet_id in ownerFleetIds(owner_id)]
+            return versionedResponse(request, scopes, lambda: listData(request, self, fleets, FleetSerializer))
         elif is_driver(request.user):
-            fleets = request.user.driver.fleets
-            serialized_fleets = FleetSerializer(fleets, many=True)
-            return Response(serialized_fleets.data, status=status.HTTP_200_OK)
+            driver_id = profileId(request.user, 'driver')
+            fleets = FleetSerializer.with_counts(Fleet.objects.filter(fleets=driver_id))
+            scopes = [('driver', driver_id)] + [('fleet', fleet_id) for fleet_id in driverFleetIds(driver_id)]
+            return versionedResponse(request, scopes, lambda: listData(request, self, fleets, FleetSerializer))
         else:
             return Response({"status": "error", "errors": ["Not authorized"]}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -101,6 +124,7 @@ class FleetList(APIView):
                 fleet = form.save(commit=False)
                 fleet.owner = owner
                 fleet.save()
+                createFleetChannelAsync(fleet.id)
                 print(fleet.name, fleet.description, fleet.owner, fleet.id)
                 return Response({"status": "ok", "fleet_id": fleet.id}, status=status.HTTP_201_CREATED)
             except:
@@ -113,10 +137,12 @@ class DriversByFleet(APIView):
     permission_classes = (IsOwnerPermission,)
 
     def get(self, request, fleet_id):
-        if Fleet.objects.get(pk=fleet_id) in Fleet.objects.filter(owner=request.user.owner):
-            drivers = Driver.objects.filter(fleets=fleet_id)
-            serialized_drivers = DriverSerializer(drivers, many=True)
-            return Response(serialized_drivers.data, status=status.HTTP_200_OK)
+        if owns_fleet(request.user, fleet_id):
+            drivers = DriverSerializer.with_current_trip(Driver.objects.filter(fleets=fleet_id))
+            # is_online зависит от времени - кэш живёт не дольше интервала записи отметок присутствия
+            return versionedResponse(request, [('fleet', int(fleet_id))],
+                                     lambda: listData(request, self, drivers, DriverSerializer),
+                                     bucket=int(time.time() // presence.flush_interval))
         else:
             return Response({"status": "error", "errors": ["Wrong fleet_id"]}, status=status.HTTP_409_CONFLICT)
 
@@ -125,10 +151,10 @@ class PendingDriversByFleet(APIView):
     permission_classes = (IsOwnerPermission,)
 
     def get(self, request, fleet_id):
-        if Fleet.objects.get(pk=fleet_id) in Fleet.objects.filter(owner=request.user.owner):
-            drivers = Driver.objects.exclude(fleets=fleet_id).exclude(pending_fleets=fleet_id)
-            serialized_drivers = DriverSerializer(drivers, many=True)
-            return Response(serialized_drivers.data, status=status.HTTP_200_OK)
+        if owns_fleet(request.user, fleet_id):
+            drivers = DriverSerializer.with_current_trip(
+                Driver.objects.exclude(fleets=fleet_id).exclude(pending_fleets=fleet_id))
+            return Response(listData(request, self, drivers, DriverSerializer), status=status.HTTP_200_OK)
         else:
             return Response({"status": "error", "errors": ["Wrong fleet_id"]}, status=status.HTTP_409_CONFLICT)
 
@@ -138,17 +164,17 @@ class FleetByIdView(APIView):
     authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
 
     def get(self, request, fleet_id):
-        fleet = Fleet.objects.get(id=fleet_id)
-        if fleet in Fleet.objects.filter(owner=request.user.owner):
+        if owns_fleet(request.user, fleet_id):
+            fleet = Fleet.objects.get(id=fleet_id)
             serialized_fleet = FleetSerializer(fleet, many=False)
             return Response(serialized_fleet.data, status=status.HTTP_200_OK)
         else:
             return Response({"status": "error"}, status=status.HTTP_400_BAD_REQUEST)
 
     def delete(self, request, fleet_id):
-        fleet_for_delete = Fleet.objects.get(id=fleet_id)
-        if fleet_for_delete in Fleet.objects.filter(owner=request.user.owner):
-            deleteFleetChannel()
+        if owns_fleet(request.user, fleet_id):
+            fleet_for_delete = Fleet.objects.get(id=fleet_id)
+            deleteFleetChannel(fleet_for_delete)
             fleet_for_delete.delete()
             return Response({"status": "ok"}, status=status.HTTP_200_OK)
         else:
@@ -156,37 +182,41 @@ class FleetByIdView(APIView):
 
 
 # OWNER API
+# "1,2,,3" -> [1, 2, 3] без повторов (id водителей и автопарков в формах)
+def parseIds(value):
+    # без повторов, в порядке первого появления
+    return list(dict.fromkeys(int(item) for item in value.split(sep=',') if item != ''))
+
+
 class FleetInvite(APIView):
     permission_classes = (IsOwnerPermission,)
     authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
 
     def post(self, request, fleet_id):
         # POST /api/fleet/(?P<fleet_id>[-\w]+)/invite/
+        # driver_id - один id или несколько через запятую; конфликты ищутся одним запросом на связь,
+        # приглашения добавляются одним bulk insert
         form_offer_invite = FleetInviteDismissForm(request.data)
         if form_offer_invite.is_valid():
             try:
                 fleet = Fleet.objects.get(id=fleet_id)
-                if fleet in Fleet.objects.filter(owner=request.user.owner):
-                    ids = form_offer_invite.cleaned_data.get('driver_id')
-                    failed = False
-                    ids_fleet_failed = []
-                    ids_pending_failed = []
-                    for driver_id in ids.split(sep=','):
-                        if driver_id != '':
-                            driver = Driver.objects.get(id=driver_id)
-                            if fleet in driver.fleets.all():
-                                ids_fleet_failed.append(driver_id)
-                                failed = True
-                            elif fleet in driver.pending_fleets.all():
-                                ids_pending_failed.append(driver_id)
-                                failed = True
-                            else:
-                                driver.pending_fleets.add(fleet)
-                                driver.save()
-                    if failed:
+                if owns_fleet(request.user, fleet.id):
+                    ids = parseIds(form_offer_invite.cleaned_data.get('driver_id'))
+                    missing = set(ids) - set(Driver.objects.filter(id__in=ids).values_list('id', flat=True))
+                    if missing:
+                        return Response({"status": "error", "errors": ["Driver matching query does not exist."],
+                                         "driver_id": sorted(missing)}, status=status.HTTP_409_CONFLICT)
+                    in_fleet = set(Driver.fleets.through.objects.filter(fleet=fleet, driver_id__in=ids)
+                                   .values_list('driver_id', flat=True))
+                    in_pending = set(Driver.pending_fleets.through.objects.filter(fleet=fleet, driver_id__in=ids)
+                                     .values_list('driver_id', flat=True)) - in_fleet
+                    Driver.pending_fleets.through.objects.bulk_create(
+                        [Driver.pending_fleets.through(driver_id=driver_id, fleet=fleet)
+                         for driver_id in ids if driver_id not in in_fleet and driver_id not in in_pending])
+                    if in_fleet or in_pending:
                         return Response({"status": "error",
-                                         "errors": {"Drivers is already in fleet": ids_fleet_failed,
-                                                    "Drivers is already in pending fleet": ids_pending_failed}},
+                                         "errors": {"Drivers is already in fleet": [str(i) for i in ids if i in in_fleet],
+                                                    "Drivers is already in pending fleet": [str(i) for i in ids if i in in_pending]}},
                                         status=status.HTTP_409_CONFLICT)
                     return Response({"status": "ok"}, status=status.HTTP_200_OK)
                 else:
@@ -204,22 +234,33 @@ class FleetDismiss(APIView):
 
     def post(self, request, fleet_id):
         # POST /api/fleet/(?P<fleet_id>[-\w]+)/dismiss/
+        # driver_id - один id или несколько через запятую; точки водителей удаляются из Geo2Tag в фоне
         form_dismiss = FleetInviteDismissForm(request.data)
         if form_dismiss.is_valid():
             try:
                 fleet = Fleet.objects.get(id=fleet_id)
-                if fleet in Fleet.objects.filter(owner=request.user.owner):
-                    id = form_dismiss.cleaned_data.get('driver_id')
-                    driver = Driver.objects.get(id=id)
-                    deleteDriverPos(fleet, driver)
-                    driver.fleets.remove(fleet)
-                    driver.save()
-                    print(fleet.id, id, driver.id)
+                if owns_fleet(request.user, fleet.id):
+                    ids = parseIds(form_dismiss.cleaned_data.get('driver_id'))
+                    missing = set(ids) - set(Driver.objects.filter(id__in=ids).values_list('id', flat=True))
+                    if missing:
+                        return Response({"status": "error", "errors": ["Driver matching query does not exist."],
+                                         "driver_id": sorted(missing)}, status=status.HTTP_409_CONFLICT)
+                    members = Driver.fleets.through.objects.filter(fleet=fleet, driver_id__in=ids)
+                    driver_ids = list(members.values_list('driver_id', flat=True))
+                    with transaction.atomic():
+                        members.delete()
+                        # версии повышаются после коммита, чтобы опрос между ними не закэшировал старые строки под новым ETag
+                        transaction.on_commit(lambda: bumpMembership([fleet.id], driver_ids))
+                        deleteDriverPositionsAsync(fleet.id, driver_ids)
+                    for driver_id in driver_ids:
+                        position_queue.discard(driver_id, fleet.id)
+                        driver_index.remove(fleet.id, driver_id)
+                    print(fleet.id, driver_ids)
                     return Response({"status": "ok"}, status=status.HTTP_200_OK)
                 else:
                     return Response({"status": "error", "errors": ["Not owner of fleet"]}, status=status.HTTP_409_CONFLICT)
-            except:
-                return Response({"status": "error"}, status=status.HTTP_409_CONFLICT)
+            except Exception as e:
+                return Response({"status": "error", "errors": [str(e)]}, status=status.HTTP_409_CONFLICT)
         else:
             return Response({"status": "error"}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -230,10 +271,11 @@ class TripsByFleetUnaccepted(APIView):
 
     def get(self, request, fleet_id):
         # GET /api/fleet/(?P<fleet_id>[-\w]+)/trips/unaccepted/
-        fleet = get_object_or_404(Fleet, id=fleet_id, owner=request.user.owner)
-        trips = Trip.objects.filter(fleet=fleet, driver=None, is_finished=False)
-        serialized_trips = TripSerializer(trips, many=True)
-        return Response(serialized_trips.data, status=status.HTTP_200_OK)
+        if not owns_fleet(request.user, fleet_id):
+            raise Http404
+        trips = Trip.objects.filter(fleet=fleet_id, driver=None, is_finished=False).select_related('tripstats')
+        return versionedResponse(request, [('fleet', int(fleet_id))],
+                                 lambda: listData(request, self, trips, TripSerializer))
 
 
 class TripsByFleetFinished(APIView):
@@ -243,9 +285,85 @@ class TripsByFleetFinished(APIView):
     def get(self, request, fleet_id):
         # GET /api/fleet/(?P<fleet_id>[-\w]+)/trips/finished/
         fleet = get_object_or_404(Fleet, id=fleet_id, owner=request.user.owner)
-        trips = Trip.objects.filter(fleet=fleet, is_finished=True)
-        serialized_trips = TripSerializer(trips, many=True)
-        return Response(serialized_trips.data, status=status.HTTP_200_OK)
+        trips = Trip.objects.filter(fleet=fleet, is_finished=True).select_related('tripstats')
+        return Response(listData(request, self, trips, TripSerializer), status=status.HTTP_200_OK)
+
+
+class TripsByFleetFinishedExport(APIView):
+    permission_classes = (IsOwnerPermission,)
+    authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
+
+    def get(self, request, fleet_id, export_format):
+        # GET /api/fleet/(?P<fleet_id>[-\w]+)/trips/finished/export.(ndjson|csv)?date_from=&date_to=
+        # вся история автопарка потоком, пачками по TRIP_EXPORT_CHUNK строк
+        if not owns_fleet(request.user, fleet_id):
+            raise Http404
+        form = TripExportForm(request.query_params)
+        if not form.is_valid():
+            return Response({"status": "error", "errors": form.errors}, status=status.HTTP_400_BAD_REQUEST)
+        chunks = exportTripChunks(int(fleet_id), form.cleaned_data['date_from'], form.cleaned_data['date_to'])
+        if export_format == 'csv':
+            response = StreamingHttpResponse(csvLines(chunks), content_type='text/csv; charset=utf-8')
+        else:
+            response = StreamingHttpResponse(ndjsonLines(chunks), content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="fleet' + str(fleet_id) + '-trips.' + export_format + '"'
+        return response
+
+
+class FleetPositions(APIView):
+    permission_classes = (IsOwnerPermission,)
+    authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
+
+    def get(self, request, fleet_id):
+        # GET /api/fleet/(?P<fleet_id>[-\w]+)/positions/
+        fleet = get_object_or_404(Fleet, id=fleet_id, owner=request.user.owner)
+        locations = DriverStats.objects.filter(driver__fleets=fleet, position_date__isnull=False)
+        return Response(listData(request, self, locations, DriverLocationSerializer), status=status.HTTP_200_OK)
+
+
+class NearestDrivers(APIView):
+    permission_classes = (IsOwnerPermission,)
+    authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
+
+    def get(self, request, fleet_id):
+        # GET /api/fleet/(?P<fleet_id>[-\w]+)/nearest_drivers/?lat=&lon=&k=
+        fleet = get_object_or_404(Fleet, id=fleet_id, owner=request.user.owner)
+        form = NearestDriversForm(request.query_params)
+        if not form.is_valid():
+            return Response({"status": "error", "errors": form.errors}, status=status.HTTP_400_BAD_REQUEST)
+        nearest = driver_index.nearest(fleet.id, form.cleaned_data['lat'], form.cleaned_data['lon'],
+                                       form.cleaned_data['k'] or 5)
+        return Response([{"driver_id": driver_id, "distance": distance, "lat": lat, "lon": lon}
+                         for driver_id, distance, lat, lon in nearest], status=status.HTTP_200_OK)
+
+
+class FleetEvents(APIView):
+    permission_classes = (IsOwnerPermission,)
+    authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
+
+    def get(self, request, fleet_id):
+        # GET /api/fleet/(?P<fleet_id>[-\w]+)/events/  text/event-stream: position и trip
+        if not owns_fleet(request.user, fleet_id):
+            raise Http404
+        if fleet_events.subscribers_count() >= getattr(settings, 'FLEET_EVENTS_MAX_SUBSCRIBERS', 500):
+            return Response({"status": "error", "errors": "Too many event streams, use polling"},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        last_event_id = request.META.get('HTTP_LAST_EVENT_ID') or request.query_params.get('last_event_id')
+        try:
+            last_event_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            last_event_id = None
+        # поток не обращается к БД - соединение не держим, пока клиент подключён
+        if not connection.in_atomic_block:
+            connection.close()
+        response = StreamingHttpResponse(
+            streamEvents(int(fleet_id), last_event_id,
+                         getattr(settings, 'FLEET_EVENTS_KEEPALIVE', 15),
+                         getattr(settings, 'FLEET_EVENTS_MAX_DURATION', 5 * 60)),
+            content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 
 # DRIVER API
@@ -255,9 +373,8 @@ class DriverPendingFleets(APIView):
 
     def get(self, request):
         #GET /api/driver/pending_fleets/
-        pending_fleets = request.user.driver.pending_fleets
-        serialized_pending_fleets = FleetSerializer(pending_fleets, many=True)
-        return Response(serialized_pending_fleets.data, status=status.HTTP_200_OK)
+        pending_fleets = FleetSerializer.with_counts(request.user.driver.pending_fleets.all())
+        return Response(listData(request, self, pending_fleets, FleetSerializer), status=status.HTTP_200_OK)
 
 
 class DriverPendingFleetsAccept(APIView):
@@ -269,20 +386,21 @@ class DriverPendingFleetsAccept(APIView):
         form_pending_to_fleet = DriverPendingFleetAddDeclineForm(request.data)
         if form_pending_to_fleet.is_valid():
             try:
-                fleets = request.user.driver.fleets
-                pending_fleets = request.user.driver.pending_fleets
-                ids = form_pending_to_fleet.cleaned_data.get('fleet_id')
-                for fleet_id in ids.split(sep=','):
-                    try:
-                        waited_fleet = Fleet.objects.get(id=fleet_id)
-                        print(waited_fleet.id)
-                    except Exception as e:
-                        return Response({"status": "error", "errors": [str(e)]}, status=status.HTTP_409_CONFLICT)
-                    if waited_fleet is not None:
-                        if waited_fleet in pending_fleets.all():
-                            pending_fleets.remove(waited_fleet)
-                            fleets.add(waited_fleet)
-                    print("accepted " + str(waited_fleet.id) + " by " + str(request.user.username))
+                driver = request.user.driver
+                ids = parseIds(form_pending_to_fleet.cleaned_data.get('fleet_id'))
+                if Fleet.objects.filter(id__in=ids).count() < len(ids):
+                    return Response({"status": "error", "errors": ["Fleet matching query does not exist."]},
+                                    status=status.HTTP_409_CONFLICT)
+                pending = Driver.pending_fleets.through.objects.filter(driver=driver, fleet_id__in=ids)
+                with transaction.atomic():
+                    accepted = set(pending.values_list('fleet_id', flat=True))
+                    accepted -= set(Driver.fleets.through.objects.filter(driver=driver, fleet_id__in=accepted)
+                                    .values_list('fleet_id', flat=True))
+                    pending.delete()
+                    Driver.fleets.through.objects.bulk_create(
+                        [Driver.fleets.through(driver=driver, fleet_id=fleet_id) for fleet_id in accepted])
+                    transaction.on_commit(lambda: bumpMembership(accepted, [driver.id]))
+                print("accepted " + str(sorted(accepted)) + " by " + str(request.user.username))
                 return Response({"status": "ok"}, status=status.HTTP_200_OK)
             except Exception as e:
                 return Response({"status": "error", "errors": [str(e)]}, status=status.HTTP_409_CONFLICT)
@@ -299,18 +417,12 @@ class DriverPendingFleetsDecline(APIView):
         form_pending_decline = DriverPendingFleetAddDeclineForm(request.data)
         if form_pending_decline.is_valid():
             try:
-                pending_fleets = request.user.driver.pending_fleets
-                ids = form_pending_decline.cleaned_data.get('fleet_id')
-                for fleet_id in ids.split(sep=','):
-                    try:
-                        waited_fleet = Fleet.objects.get(id=fleet_id)
-                        print(waited_fleet.id)
-                    except Exception as e:
-                        return Response({"status": "error", "errors": [str(e)]}, status=status.HTTP_409_CONFLICT)
-                    if waited_fleet is not None:
-                        if waited_fleet in pending_fleets.all():
-                            pending_fleets.remove(waited_fleet)
-                    print("declined " + str(waited_fleet.id) + " by " + str(request.user.username))
+                ids = parseIds(form_pending_decline.cleaned_data.get('fleet_id'))
+                if Fleet.objects.filter(id__in=ids).count() < len(ids):
+                    return Response({"status": "error", "errors": ["Fleet matching query does not exist."]},
+                                    status=status.HTTP_409_CONFLICT)
+                Driver.pending_fleets.through.objects.filter(driver=request.user.driver, fleet_id__in=ids).delete()
+                print("declined " + str(ids) + " by " + str(request.user.username))
                 return Response({"status": "ok"}, status=status.HTTP_200_OK)
             except Exception as e:
                 return Response({"status": "error", "errors": [str(e)]}, status=status.HTTP_409_CONFLICT)
@@ -324,9 +436,8 @@ class DriverFleets(APIView):
 
     def get(self, request):
         #GET /api/driver/fleets/
-        fleets = request.user.driver.fleets
-        serialized_fleets = FleetSerializer(fleets, many=True)
-        return Response(serialized_fleets.data, status=status.HTTP_200_OK)
+        fleets = FleetSerializer.with_counts(request.user.driver.fleets.all())
+        return Response(listData(request, self, fleets, FleetSerializer), status=status.HTTP_200_OK)
 
 
 class DriverFleetAvailableTrips(APIView):
@@ -340,10 +451,9 @@ class DriverFleetAvailableTrips(APIView):
         except:
             return Response({"status": "error"}, status=status.HTTP_404_NOT_FOUND)
         trips = Trip.objects.none()
-        if fleet in request.user.driver.fleets.all():
-            trips = Trip.objects.filter(fleet=fleet, driver=None, is_finished=False)
-        serialized_trips = TripSerializer(trips, many=True)
-        return Response(serialized_trips.data, status=status.HTTP_200_OK)
+        if in_fleet(request.user, fleet.id):
+            trips = Trip.objects.filter(fleet=fleet, driver=None, is_finished=False).select_related('tripstats')
+        return Response(listData(request, self, trips, TripSerializer), status=status.HTTP_200_OK)
 
 
 class DriverAvailableTrips(APIView):
@@ -352,13 +462,60 @@ class DriverAvailableTrips(APIView):
 
     def get(self, request):
         #GET /api/driver/available_trips/
-        fleets = request.user.driver.fleets
-        trips = Trip.objects.none()
-        for fleet in fleets.all():
-            trips_add = Trip.objects.filter(fleet=fleet, driver=None, is_finished=False)
-            trips = trips | trips_add
-        serialized_trips = TripSerializer(trips, many=True)
-        return Response(serialized_trips.data, status=status.HTTP_200_OK)
+        # один запрос с join по членству водителя в автопарках, без OR на каждый автопарк
+        driver_id = profileId(request.user, 'driver')
+        trips = Trip.objects.filter(fleet__fleets=driver_id, driver=None, is_finished=False) \
+            .select_related('tripstats')
+        scopes = [('driver', driver_id)] + [('fleet', fleet_id) for fleet_id in driverFleetIds(driver_id)]
+        return versionedResponse(request, scopes,
+                                 lambda: listData(request, self, trips, TripSerializer, limit=DRIVER_TRIPS_LIMIT))
+
+
+class DriverWaitTrips(APIView):
+    permission_classes = (IsDriverPermission,)
+    authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
+
+    def get(self, request):
+        #GET /api/driver/available_trips/wait/?last_event_id=&timeout=
+        # long-poll вместо опроса available_trips: ответ приходит, когда в автопарке водителя
+        # появился свободный рейс или рейс принял другой водитель, либо по истечении timeout
+        driver_id = profileId(request.user, 'driver')
+        fleet_ids = driverFleetIds(driver_id)
+        max_timeout = getattr(settings, 'DRIVER_WAIT_TIMEOUT', 25)
+        try:
+            last_event_id = int(request.query_params['last_event_id'])
+        except (KeyError, ValueError):
+            last_event_id = None
+        try:
+            timeout = max(min(float(request.query_params.get('timeout', max_timeout)), max_timeout), 0)
+        except ValueError:
+            timeout = max_timeout
+        notices = []
+        if last_event_id is None:
+            # первый запрос - только текущее состояние и id события, с которого ждать
+            last_event_id = fleet_events.last_id()
+        elif fleet_events.subscribers_count() >= getattr(settings, 'FLEET_EVENTS_MAX_SUBSCRIBERS', 500):
+            # мест для ожидания нет: пустой 200 клиент сразу повторил бы, поэтому 503 и время повтора
+            retry_after = getattr(settings, 'DRIVER_WAIT_RETRY_AFTER', 5)
+            response = Response({"status": "error", "errors": "Too many waiting drivers, retry later",
+                                 "retry": retry_after}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            response['Retry-After'] = str(retry_after)
+            return response
+        else:
+            # пока ждём, соединение с БД не держим
+            if not connection.in_atomic_block:
+                connection.close()
+            if fleet_ids:
+                last_event_id, notices = waitTripNotices(fleet_ids, driver_id, last_event_id, timeout)
+            else:
+                # у водителя нет автопарков - уведомлений не будет, но ответ не отдаём сразу,
+                # иначе клиент опрашивает без паузы
+                time.sleep(timeout)
+        return Response({
+            "last_event_id": last_event_id,
+            "notices": [data if event_type == "trip" else {"state": "reset"} for event_id, event_type, data in notices],
+            "available": available_trips.for_fleets(fleet_ids),
+        }, status=status.HTTP_200_OK)
 
 
 class DriverFleetTrips(APIView):
@@ -373,10 +530,9 @@ class DriverFleetTrips(APIView):
         except:
             return Response({"status": "error"}, status=status.HTTP_409_CONFLICT)
         trips = Trip.objects.none()
-        if fleet in request.user.driver.fleets.all():
-            trips = Trip.objects.filter(fleet=fleet, driver=request.user.driver)
-        serialized_trips = TripSerializer(trips, many=True)
-        return Response(serialized_trips.data, status=status.HTTP_200_OK)
+        if in_fleet(request.user, fleet.id):
+            trips = Trip.objects.filter(fleet=fleet, driver=request.user.driver).select_related('tripstats')
+        return Response(listData(request, self, trips, TripSerializer), status=status.HTTP_200_OK)
 
 
 class DriverTrips(APIView):
@@ -385,13 +541,10 @@ class DriverTrips(APIView):
 
     def get(self, request):
         #GET /api/driver/trips/
-        fleets = request.user.driver.fleets
-        trips = Trip.objects.none()
-        for fleet in fleets.all():
-            trips_add = Trip.objects.filter(fleet=fleet, driver=request.user.driver)
-            trips = trips | trips_add
-        serialized_trips = TripSerializer(trips, many=True)
-        return Response(serialized_trips.data, status=status.HTTP_200_OK)
+        driver = request.user.driver
+        trips = Trip.objects.filter(fleet__fleets=driver, driver=driver).select_related('tripstats')
+        return Response(listData(request, self, trips, TripSerializer, limit=DRIVER_TRIPS_LIMIT),
+                        status=status.HTTP_200_OK)
 
 
 class TripById(APIView):
@@ -402,14 +555,31 @@ class TripById(APIView):
         #GET /api/driver/trips/
         trip = get_object_or_404(Trip, id=trip_id)
         current_user = request.user
-        if is_driver(current_user) and trip.driver!=current_user.driver:
+        if is_driver(current_user) and trip.driver_id != current_user.driver.id:
             return Response({"status": "error", "errors": "Not your trip"},status=status.HTTP_409_CONFLICT)
-        if is_owner(current_user) and (trip.fleet.owner!=current_user.owner):
+        if is_owner(current_user) and not owns_fleet(current_user, trip.fleet_id):
             return Response({"status": "error", "errors": "Not your trip"}, status=status.HTTP_409_CONFLICT)
         serialized_trips = TripSerializer(trip)
         return Response(serialized_trips.data, status=status.HTTP_200_OK)
 
 
+class TripTrack(APIView):
+    permission_classes = (IsOwnerOrDriverPermission,)
+    authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
+
+    def get(self, request, trip_id):
+        #GET /api/trip/<trip_id>/track/
+        trip = get_object_or_404(Trip, id=trip_id)
+        current_user = request.user
+        if is_driver(current_user) and trip.driver_id != current_user.driver.id:
+            return Response({"status": "error", "errors": "Not your trip"}, status=status.HTTP_409_CONFLICT)
+        if is_owner(current_user) and not owns_fleet(current_user, trip.fleet_id):
+            return Response({"status": "error", "errors": "Not your trip"}, status=status.HTTP_409_CONFLICT)
+        positions = DriverPosition.objects.filter(trip=trip).order_by('timestamp')
+        return Response(listData(request, self, positions, DriverPositionSerializer, ordering='timestamp'),
+                        status=status.HTTP_200_OK)
+
+
 class DriverAcceptTrip(APIView):
     permission_classes = (IsDriverPermission,)
     authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
@@ -421,39 +591,53 @@ class DriverAcceptTrip(APIView):
         if not trip_id_form.is_valid():
             return Response({"status": "trip_id_form not valid"}, status=status.HTTP_400_BAD_REQUEST)
         trip_id = trip_id_form.cleaned_data.get('trip_id')
-        trip = get_object_or_404(Trip, id=trip_id)
         try:
-            print(trip, trip.id, trip.fleet, trip.driver, trip.is_finished)
-            print(driver, driver.fleets.all())
-            if trip.driver == driver and trip.is_finished:
-                return Response({"status": "error", "errors": "You have already been finished this trip"},
-                                status=status.HTTP_409_CONFLICT)
-            elif trip.driver == driver:
-                # TODO Redirect to page with current trip
-                return Response({"status": "error", "errors": "It's your current trip"},
-                                status=status.HTTP_409_CONFLICT)
-            elif trip.driver is not None:
-                return Response({"status": "error", "errors": "This trip has already been accepted"},
-                                status=status.HTTP_409_CONFLICT)
-            elif trip.is_finished:
-                return Response({"status": "error", "errors": "This trip is finished but don't have a driver!!!"},
-                                status=status.HTTP_409_CONFLICT)
-            if trip.fleet not in driver.fleets.all():
-                return Response({"status": "error", "errors": "You are not a member in that fleet"},
-                                status=status.HTTP_409_CONFLICT)
-            if Trip.objects.filter(driver=driver, is_finished=False).exists():
-                # TODO Redirect to page with current trip
-                return Response({"status": "error", "errors": "You have already accepted current trip"},
-                                status=status.HTTP_409_CONFLICT)
-            # TODO Change 1 to static variable
-            if trip.problem is not 1:
-                return Response({"status": "error", "errors": "The trip has a problem"},
-                                status=status.HTTP_409_CONFLICT)
-            trip.driver = driver
-            trip.save()
+            # все условия проверяются в одном UPDATE, поэтому из одновременных запросов рейс получит один водитель
+            with transaction.atomic():
+                # условия только на саму строку рейса и EXISTS, без join: иначе Django
+                # делает UPDATE ... WHERE id IN (SELECT ...) и повторная проверка строки теряется
+                accepted = Trip.objects.filter(id=trip_id, driver=None, is_finished=False, problem=1) \
+                    .extra(where=["EXISTS (SELECT 1 FROM logistics_driver_fleets member "
+                                  "WHERE member.fleet_id = logistics_trip.fleet_id AND member.driver_id = %s)",
+                                  "NOT EXISTS (SELECT 1 FROM logistics_trip active "
+                                  "WHERE active.driver_id = %s AND active.is_finished = %s)"],
+                           params=[driver.id, driver.id, False]) \
+                    .update(driver=driver)
+        except IntegrityError:
+            # другой рейс водителя приняли параллельно (logistics_trip_one_active)
+            accepted = 0
+        if accepted:
+            bumpDriverFleets(driver.id)
+            driver_index.set_available(driver.id, False)
+            # UPDATE не возвращает автопарк рейса; без available_trips читаем его, только если кто-то слушает события
+            fleet_id = available_trips.fleet_of(int(trip_id))
+            if fleet_id is None and fleet_events.subscribers_count():
+                fleet_id = Trip.objects.filter(id=trip_id).values_list('fleet_id', flat=True).first()
+            publishTrips(fleet_id, "accepted", [int(trip_id)], driver.id)
             return Response({"status": "ok"}, status=status.HTTP_200_OK)
-        except Exception as e:
-            return Response({"status": "error", "errors": [str(e)]}, status=status.HTTP_409_CONFLICT)
+        return self.rejection(get_object_or_404(Trip, id=trip_id), driver)
+
+    # какое из условий UPDATE не выполнилось
+    def rejection(self, trip, driver):
+        if trip.driver_id == driver.id and trip.is_finished:
+            error = "You have already been finished this trip"
+        elif trip.driver_id == driver.id:
+            # TODO Redirect to page with current trip
+            error = "It's your current trip"
+        elif trip.driver_id is not None:
+            error = "This trip has already been accepted"
+        elif trip.is_finished:
+            error = "This trip is finished but don't have a driver!!!"
+        elif not driver.fleets.filter(id=trip.fleet_id).exists():
+            error = "You are not a member in that fleet"
+        elif Trip.objects.filter(driver=driver, is_finished=False).exists():
+            # TODO Redirect to page with current trip
+            error = "You have already accepted current trip"
+        elif trip.problem != 1:
+            error = "The trip has a problem"
+        else:
+            error = "Trip was changed, try again"
+        return Response({"status": "error", "errors": error}, status=status.HTTP_409_CONFLICT)
 
 
 class AddTrip(APIView):
@@ -467,9 +651,9 @@ class AddTrip(APIView):
             try:
                 fleet = get_object_or_404(Fleet, id=fleet_id)
                 current_user = request.user
-                if is_driver(current_user) and (not fleet in current_user.driver.fleets.all()):
+                if is_driver(current_user) and not in_fleet(current_user, fleet.id):
                     return Response({"status": "error", "errors": "You are not a member in that fleet"}, status=status.HTTP_409_CONFLICT)
-                if is_owner(current_user) and (fleet.owner != current_user.owner):
+                if is_owner(current_user) and not owns_fleet(current_user, fleet.id):
                     return Response({"status": "error", "errors": "It is not your fleet"}, status=status.HTTP_409_CONFLICT)
 
                 trip = form_add_trip.save(commit=False)
@@ -478,6 +662,7 @@ class AddTrip(APIView):
                 trip.save()
                 trip.name = str(fleet.name)+"#"+str(trip.id)
                 trip.save()
+                publishTrips(fleet.id, "added", [trip.id])
                 print(trip.name, trip.description, trip.driver, trip.fleet, trip.start_date, trip.id)
                 return Response({"status": "ok"}, status=status.HTTP_201_CREATED)
             except Exception as e:
@@ -486,6 +671,39 @@ class AddTrip(APIView):
             return Response({"status": "error"}, status=status.HTTP_400_BAD_REQUEST)
 
 
+class ImportTrips(APIView):
+    permission_classes = (IsOwnerOrDriverPermission,)
+    authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
+
+    def post(self, request, fleet_id):
+        #POST /api/fleet/<fleet_id>/import_trips/  JSON-массив или CSV с полями AddTripForm
+        fleet = get_object_or_404(Fleet, id=fleet_id)
+        current_user = request.user
+        if is_driver(current_user) and not in_fleet(current_user, fleet.id):
+            return Response({"status": "error", "errors": "You are not a member in that fleet"}, status=status.HTTP_409_CONFLICT)
+        if is_owner(current_user) and not owns_fleet(current_user, fleet.id):
+            return Response({"status": "error", "errors": "It is not your fleet"}, status=status.HTTP_409_CONFLICT)
+        try:
+            rows = readTripRows(request)
+        except Exception as e:
+            return Response({"status": "error", "errors": [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+        if not rows or len(rows) > IMPORT_MAX_ROWS:
+            return Response({"status": "error", "errors": ["Expected 1.." + str(IMPORT_MAX_ROWS) + " rows"]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # все строки или ничего: при ошибках возвращаются номера строк и ошибки полей
+        trips, errors = validateTripRows(rows)
+        if errors:
+            return Response({"status": "error", "errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ids = createTrips(fleet, trips)
+            bumpFleets([fleet.id])
+            publishTrips(fleet.id, "added", ids)
+            print("imported " + str(len(ids)) + " trips to " + str(fleet))
+            return Response({"status": "ok", "created": len(ids), "ids": ids}, status=status.HTTP_201_CREATED)
+        except Exception as e:
+            return Response({"status": "error", "errors": [str(e)]}, status=status.HTTP_409_CONFLICT)
+
+
 class DriverCurrentTrip(APIView):
     permission_classes = (IsDriverPermission,)
     authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
@@ -522,6 +740,7 @@ class DriverReportProblem(APIView):
                 print(trip.problem)
                 form_report_problem.save()
                 print(trip.problem)
+                publishTrips(trip.fleet_id, "problem", [trip.id], trip.driver_id, trip.problem)
                 return Response({"status": "ok"}, status=status.HTTP_200_OK)
             except Exception as e:
                 return Response({"status": "error", "errors": [str(e)]}, status=status.HTTP_409_CONFLICT)
@@ -545,6 +764,14 @@ class DriverFinishTrip(APIView):
             trip.is_finished = True
             trip.end_date = timezone.now()
             trip.save()
+            position_queue.discard(request.user.driver.id)
+            driver_index.set_available(request.user.driver.id, True)
+            # сразу - по точкам этого процесса, позже - по точкам, сброшенным другими воркерами
+            position_queue.flush_driver_history(request.user.driver.id)
+            updateTripStats([trip])
+            recomputeTripStatsLater(trip.id)
+            bumpDriverFleets(request.user.driver.id)
+            publishTrips(trip.fleet_id, "finished", [trip.id], trip.driver_id)
             deleteDriverPos(trip.fleet, request.user.driver)
             return Response({"status": "ok"}, status=status.HTTP_200_OK)
         except Exception as e:
@@ -573,9 +800,11 @@ class DriverUpdatePos(APIView):
             return Response({"status": "update_pos_form not valid"}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            lat = update_pos_form.cleaned_data.get('lat')
-            lon = update_pos_form.cleaned_data.get('lon')
-            updateDriverPos(trip.fleet, driver, lat, lon)
+            lat = float(update_pos_form.cleaned_data.get('lat'))
+            lon = float(update_pos_form.cleaned_data.get('lon'))
+            position_queue.put(trip.fleet, driver, lat, lon, trip.id)
+            driver_index.update(trip.fleet_id, driver.id, lat, lon, available=False)
+            publishPosition(trip.fleet_id, driver.id, lat, lon, trip.id)
             return Response({"status": "ok"}, status=status.HTTP_200_OK)
         except Exception as e:
             return Response({"status": "error", "errors": [str(e)]}, status=status.HTTP_409_CONFLICT)
@@ -595,6 +824,24 @@ class ReloadGeo(APIView):
             return Response({"status": "error", "errors": [str(e)]}, status=status.HTTP_409_CONFLICT)
 
 
+class PositionQueueStats(APIView):
+    permission_classes = (IsAdminUser,)
+    authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
+
+    def get(self, request):
+        # GET /api/position_queue/
+        return Response(position_queue.metrics(), status=status.HTTP_200_OK)
+
+
+class Geo2TagStartupStats(APIView):
+    permission_classes = (IsAdminUser,)
+    authentication_classes = (CsrfExemptSessionAuthentication, BasicAuthentication)
+
+    def get(self, request):
+        # GET /api/reload/status/
+        return Response(startup_stats, status=status.HTTP_200_OK)
+
+
 spam_driver_dict = {}
 time_interval = 5 # 5 секунд
 def filterSpam(driver_id):
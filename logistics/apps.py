@@ -3,3 +3,8 @@ from django.apps import AppConfig
 class LogisticsServiceConfig(AppConfig):
     name = 'logistics'
     verbose_name = "Logistics Service"
+
+    def ready(self):
+        # обработчики сигналов (сброс кэша ролей, версии списков)
+        import logistics.permissions
+        import logistics.versions
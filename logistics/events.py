@@ -0,0 +1,277 @@
+import collections
+import itertools
+import json
+import threading
+import time
+
+from django.conf import settings
+
+from logistics.models import Trip
+
+RECONNECT_DELAY = 3000  # мс, поле retry для EventSource
+
+
+# Подписка одного клиента на события одного или нескольких автопарков. Буфер ограничен:
+# если клиент не успевает читать, старые события вытесняются, а клиент получает
+# событие reset и должен перечитать состояние через REST API.
+class Subscription(object):
+    def __init__(self, broker, fleet_ids, buffer_size):
+        self.broker = broker
+        self.fleet_ids = fleet_ids
+        self.dropped = 0
+        self._events = collections.deque(maxlen=buffer_size)
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def push(self, event):
+        with self._condition:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append(event)
+            self._condition.notify()
+
+    # ждёт события не дольше timeout секунд; возвращает список (id, тип, данные) или []
+    def get(self, timeout):
+        with self._condition:
+            if not self._events and not self._closed:
+                self._condition.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            events.insert(0, (None, "reset", {"dropped": dropped}))
+        return events
+
+    def close(self):
+        self.broker.unsubscribe(self)
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+
+# Раздача событий автопарка всем подписчикам процесса (SSE /api/fleet/<id>/events/,
+# ожидание рейсов водителем). Публикация - O(число подписчиков автопарка), без записи в БД;
+# последние history событий автопарка хранятся для переподключения с Last-Event-ID.
+# Работает в пределах одного процесса: события, принятые другим воркером, сюда не попадают.
+class EventBroker(object):
+    def __init__(self, buffer_size, history_size):
+        self.buffer_size = buffer_size
+        self.history_size = history_size
+        self._subscribers = {}  # fleet_id -> set(Subscription)
+        self._count = 0
+        self._history = {}  # fleet_id -> deque((id, тип, данные))
+        self._started_id = int(time.time() * 1000)
+        self._last_id = self._started_id
+        self._trimmed = {}  # fleet_id -> id последнего вытесненного из истории события
+        self._ids = itertools.count(self._started_id + 1)
+        self._lock = threading.Lock()
+
+    # fleet_ids - id автопарка или список id
+    def subscribe(self, fleet_ids, last_event_id=None):
+        if isinstance(fleet_ids, (list, tuple, set)):
+            fleet_ids = tuple(int(fleet_id) for fleet_id in fleet_ids)
+        else:
+            fleet_ids = (int(fleet_ids),)
+        subscription = Subscription(self, fleet_ids, self.buffer_size)
+        with self._lock:
+            for fleet_id in fleet_ids:
+                self._subscribers.setdefault(fleet_id, set()).add(subscription)
+            self._count += 1
+            history = [event for fleet_id in fleet_ids for event in self._history.get(fleet_id, ())]
+            trimmed = max([self._trimmed.get(fleet_id, self._started_id) for fleet_id in fleet_ids] or [0])
+            last_id = self._last_id
+        if last_event_id is not None:
+            if last_event_id < trimmed:
+                # часть пропущенных событий уже вытеснена из истории (или процесс перезапущен,
+                # или id выдан другим воркером); last_id - с какого события продолжать после сброса
+                subscription.push((None, "reset", {"dropped": None, "last_id": last_id}))
+            for event in sorted(history, key=lambda event: event[0]):
+                if event[0] > last_event_id:
+                    subscription.push(event)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            removed = False
+            for fleet_id in subscription.fleet_ids:
+                subscribers = self._subscribers.get(fleet_id)
+                if subscribers is not None and subscription in subscribers:
+                    removed = True
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[fleet_id]
+            if removed:
+                self._count -= 1
+
+    def publish(self, fleet_id, event_type, data):
+        fleet_id = int(fleet_id)
+        with self._lock:
+            event = (next(self._ids), event_type, data)
+            self._last_id = event[0]
+            history = self._history.get(fleet_id)
+            if history is None:
+                history = self._history[fleet_id] = collections.deque(maxlen=self.history_size)
+            elif len(history) == history.maxlen:
+                self._trimmed[fleet_id] = history[0][0]
+            history.append(event)
+            subscribers = list(self._subscribers.get(fleet_id, ()))
+        for subscription in subscribers:
+            subscription.push(event)
+        return event[0]
+
+    # id последнего опубликованного события - с него клиент начинает ждать следующие
+    def last_id(self):
+        with self._lock:
+            return self._last_id
+
+    def subscribers_count(self, fleet_id=None):
+        with self._lock:
+            if fleet_id is not None:
+                return len(self._subscribers.get(int(fleet_id), ()))
+            return self._count
+
+
+# Свободные рейсы (driver IS NULL, не завершены) по автопаркам в памяти процесса.
+# Автопарк читается из БД при первом запросе и раз в refresh_interval секунд
+# (рейсы, созданные и принятые другими воркерами), между перечитываниями
+# обновляется событиями publishTrips без обращения к БД.
+class AvailableTrips(object):
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._trips = {}  # fleet_id -> set(trip_id)
+        self._fleets = {}  # trip_id -> fleet_id
+        self._loaded_at = {}  # fleet_id -> time.time()
+        self._lock = threading.Lock()
+
+    def add(self, fleet_id, trip_ids):
+        with self._lock:
+            trips = self._trips.get(fleet_id)
+            if trips is None:
+                # автопарк ещё не загружен - прочитается из БД целиком
+                return
+            for trip_id in trip_ids:
+                trips.add(trip_id)
+                self._fleets[trip_id] = fleet_id
+
+    def remove(self, trip_ids):
+        with self._lock:
+            for trip_id in trip_ids:
+                fleet_id = self._fleets.pop(trip_id, None)
+                if fleet_id is not None:
+                    self._trips[fleet_id].discard(trip_id)
+
+    def fleet_of(self, trip_id):
+        with self._lock:
+            return self._fleets.get(trip_id)
+
+    def _load(self, fleet_ids):
+        trips = {fleet_id: set() for fleet_id in fleet_ids}
+        for fleet_id, trip_id in Trip.objects.filter(fleet_id__in=fleet_ids, driver=None, is_finished=False) \
+                .values_list('fleet_id', 'id'):
+            trips[fleet_id].add(trip_id)
+        now = time.time()
+        with self._lock:
+            for fleet_id, trip_ids in trips.items():
+                for trip_id in self._trips.get(fleet_id, ()):
+                    self._fleets.pop(trip_id, None)
+                for trip_id in trip_ids:
+                    self._fleets[trip_id] = fleet_id
+                self._trips[fleet_id] = trip_ids
+                self._loaded_at[fleet_id] = now
+
+    # {fleet_id: [trip_id, ...]}; устаревшие автопарки перечитываются одним запросом
+    def for_fleets(self, fleet_ids):
+        now = time.time()
+        stale = [fleet_id for fleet_id in fleet_ids
+                 if now - self._loaded_at.get(fleet_id, 0) >= self.refresh_interval]
+        if stale:
+            self._load(stale)
+        with self._lock:
+            return {fleet_id: sorted(self._trips.get(fleet_id, ())) for fleet_id in fleet_ids}
+
+
+def formatEvent(event):
+    event_id, event_type, data = event
+    text = "event: " + event_type + "\ndata: " + json.dumps(data) + "\n\n"
+    return text if event_id is None else "id: " + str(event_id) + "\n" + text
+
+
+def publishPosition(fleet_id, driver_id, lat, lon, trip_id=None):
+    fleet_events.publish(fleet_id, "position", {"driver_id": driver_id, "lat": lat, "lon": lon, "trip_id": trip_id})
+
+
+# state: added / accepted / problem / finished
+# fleet_id может быть None, если автопарк рейса неизвестен и событие слушать некому
+def publishTrips(fleet_id, state, trip_ids, driver_id=None, problem=None):
+    trip_ids = list(trip_ids)
+    if state == "added":
+        available_trips.add(fleet_id, trip_ids)
+    elif state in ("accepted", "finished"):
+        available_trips.remove(trip_ids)
+    if fleet_id is None:
+        return
+    data = {"state": state, "trip_ids": trip_ids, "driver_id": driver_id, "fleet_id": fleet_id}
+    if problem is not None:
+        data["problem"] = problem
+    fleet_events.publish(fleet_id, "trip", data)
+
+
+# события для водителя, ожидающего рейсы: новые свободные рейсы и рейсы, принятые другими
+def isTripNotice(event, driver_id):
+    event_id, event_type, data = event
+    if event_type == "reset":
+        return True
+    if event_type != "trip":
+        return False
+    return data["state"] == "added" or (data["state"] == "accepted" and data["driver_id"] != driver_id)
+
+
+# long-poll: ждёт до timeout секунд событий автопарков водителя после last_event_id.
+# Возвращает (id последнего просмотренного события, уведомления)
+def waitTripNotices(fleet_ids, driver_id, last_event_id, timeout):
+    deadline = time.time() + timeout
+    subscription = fleet_events.subscribe(fleet_ids, last_event_id)
+    notices = []
+    try:
+        while True:
+            for event in subscription.get(max(deadline - time.time(), 0)):
+                if event[0] is not None:
+                    last_event_id = max(last_event_id, event[0])
+                elif event[2].get("last_id") is not None:
+                    # после сброса ждём с текущего события, иначе каждый опрос снова получит сброс
+                    last_event_id = max(last_event_id, event[2]["last_id"])
+                if isTripNotice(event, driver_id):
+                    notices.append(event)
+            if notices or time.time() >= deadline:
+                break
+    finally:
+        subscription.close()
+    return last_event_id, notices
+
+
+# генератор тела ответа text/event-stream; завершается через max_duration секунд
+# (EventSource сам переподключится с Last-Event-ID), пока ждёт - шлёт комментарии-keepalive.
+# Подписка создаётся при первой итерации, чтобы закрытие ответа всегда её снимало.
+def streamEvents(fleet_id, last_event_id, keepalive, max_duration):
+    deadline = time.time() + max_duration
+    subscription = fleet_events.subscribe(fleet_id, last_event_id)
+    try:
+        yield "retry: " + str(RECONNECT_DELAY) + "\n\n"
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            events = subscription.get(min(keepalive, remaining))
+            if events:
+                yield "".join(formatEvent(event) for event in events)
+            else:
+                yield ": keepalive\n\n"
+    finally:
+        subscription.close()
+
+
+fleet_events = EventBroker(
+    buffer_size=getattr(settings, 'FLEET_EVENTS_BUFFER', 256),
+    history_size=getattr(settings, 'FLEET_EVENTS_HISTORY', 256),
+)
+available_trips = AvailableTrips(refresh_interval=getattr(settings, 'AVAILABLE_TRIPS_REFRESH', 30))
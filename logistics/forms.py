@@ -33,11 +33,11 @@ class FleetAddForm(forms.ModelForm):
 
 class FleetInviteDismissForm(forms.Form):
     # drivers_id = forms.ModelMultipleChoiceField(queryset=Driver.objects.all())
-    driver_id = forms.CharField(label='Driver id', max_length=100)
+    driver_id = forms.CharField(label='Driver id', max_length=10000)  # один id или несколько через запятую
 
 
 class DriverPendingFleetAddDeclineForm(forms.Form):
-    fleet_id = forms.CharField(label='Select pending fleets:', max_length=100)
+    fleet_id = forms.CharField(label='Select pending fleets:', max_length=10000)
 
 
 class AddTripForm(forms.ModelForm):
@@ -67,4 +67,15 @@ class DriverAcceptTripForm(forms.Form):
 
 class DriverUpdatePosForm(forms.Form):
     lat = forms.CharField(max_length=20)
-    lon = forms.CharField(max_length=20)
\ No newline at end of file
+    lon = forms.CharField(max_length=20)
+
+
+class NearestDriversForm(forms.Form):
+    lat = forms.FloatField(min_value=-90, max_value=90)
+    lon = forms.FloatField(min_value=-180, max_value=180)
+    k = forms.IntegerField(min_value=1, max_value=100, required=False)
+
+
+class TripExportForm(forms.Form):
+    date_from = forms.DateTimeField(required=False)
+    date_to = forms.DateTimeField(required=False)
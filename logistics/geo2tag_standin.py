@@ -0,0 +1,179 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+
+# Локальная замена demo.geo2tag.org для тестов и нагрузочных замеров.
+# Реализует те запросы, которые делает Geo2TagService:
+#   POST   /instance/service/<name>/channel        -> {"$oid": ...} или 'null', если канал с таким именем есть
+#   GET    /instance/service/<name>/channel?number=0
+#   DELETE /instance/service/<name>/channel/<oid>  -> '{}'
+#   POST   /instance/service/<name>/point          -> ["<oid>", ...] на список точек
+#   GET    /instance/service/<name>/point?number=0
+#   DELETE /instance/service/<name>/point/<oid>    -> '{}'
+#   GET    /instance/service/<name>/map
+# latency добавляет задержку к каждому ответу, error_rate - долю ответов 500.
+class Geo2TagStandIn(object):
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.channels = {}  # oid -> channel
+        self.points = {}  # oid -> point
+        self.requests = {}  # "METHOD resource" -> count
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), _StandInHandler)
+        self._server.standin = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://" + host + ":" + str(port) + "/instance/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="geo2tag-standin")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def reset(self):
+        with self._lock:
+            self.channels.clear()
+            self.points.clear()
+            self.requests.clear()
+
+    def count(self, method, resource):
+        with self._lock:
+            return self.requests.get(method + " " + resource, 0)
+
+    def _new_oid(self):
+        return uuid.uuid4().hex[:24]
+
+    def _should_fail(self):
+        with self._lock:
+            return self.error_rate > 0 and self._random.random() < self.error_rate
+
+    def _count(self, method, resource):
+        with self._lock:
+            key = method + " " + resource
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def handle(self, method, resource, oid, query, body):
+        with self._lock:
+            if resource == "channel":
+                if method == "POST" and oid is None:
+                    name = parse_qs(body.decode('utf-8')).get('name', [None])[0]
+                    if name is None:
+                        return 400, {"message": "name is required"}
+                    if any(channel["name"] == name for channel in self.channels.values()):
+                        return 200, None
+                    new_oid = self._new_oid()
+                    self.channels[new_oid] = {"_id": {"$oid": new_oid}, "name": name, "json": {}}
+                    return 200, {"$oid": new_oid}
+                if method == "GET" and oid is None:
+                    return 200, self._limit(list(self.channels.values()), query)
+                if method == "DELETE" and oid is not None:
+                    if self.channels.pop(oid, None) is None:
+                        return 404, None
+                    for point_oid in [key for key, point in self.points.items() if point["channel_id"] == oid]:
+                        del self.points[point_oid]
+                    return 200, {}
+
+            if resource == "point":
+                if method == "POST" and oid is None:
+                    oids = []
+                    for point in json.loads(body.decode('utf-8')):
+                        new_oid = self._new_oid()
+                        self.points[new_oid] = dict(point, _id={"$oid": new_oid})
+                        oids.append(new_oid)
+                    return 200, oids
+                if method == "GET" and oid is None:
+                    points = list(self.points.values())
+                    channel_ids = query.get('channel_ids')
+                    if channel_ids:
+                        points = [point for point in points if point["channel_id"] in channel_ids]
+                    return 200, self._limit(points, query)
+                if method == "DELETE" and oid is not None:
+                    if self.points.pop(oid, None) is None:
+                        return 404, None
+                    return 200, {}
+
+            if resource == "map" and method == "GET":
+                return 200, "<html><body>Geo2Tag stand-in map</body></html>"
+
+            return 404, None
+
+    def _limit(self, items, query):
+        number = int(query.get('number', ['0'])[0])
+        return items[:number] if number > 0 else items
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    route = re.compile(r'^/instance/service/[^/]+/(?P<resource>channel|point|map)(?:/(?P<oid>[^/]+))?/?$')
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method):
+        standin = self.server.standin
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if standin.latency:
+            time.sleep(standin.latency)
+
+        parsed = urlparse(self.path)
+        match = self.route.match(parsed.path)
+        if match is None:
+            self._send(404, None)
+            return
+        standin._count(method, match.group('resource'))
+        if standin._should_fail():
+            self._send(500, "Internal Server Error")
+        else:
+            code, payload = standin.handle(method, match.group('resource'), match.group('oid'),
+                                           parse_qs(parsed.query), body)
+            self._send(code, payload)
+
+    def _send(self, code, payload):
+        if isinstance(payload, str):
+            content_type, text = "text/html", payload
+        else:
+            content_type, text = "application/json", json.dumps(payload) if payload is not None else 'null'
+        data = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from logistics.geo2tag_standin import Geo2TagStandIn
+
+
+class Command(BaseCommand):
+    help = "Run a local Geo2Tag stand-in server (set GEO2TAG_SERVER_URL to the printed url)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8282)
+        parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+        parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with 500")
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        standin = Geo2TagStandIn(host=options['host'], port=options['port'], latency=options['latency'],
+                                 error_rate=options['error_rate'], seed=options['seed'])
+        self.stdout.write("Geo2Tag stand-in is listening on " + standin.url)
+        try:
+            standin.serve_forever()
+        except KeyboardInterrupt:
+            pass
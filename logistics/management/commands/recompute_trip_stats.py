@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from logistics.tripstats import recomputeFinishedTrips
+
+
+class Command(BaseCommand):
+    help = "Recompute TripStats of finished trips from their DriverPosition history"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fleet', type=int, default=None, help="only trips of this fleet id")
+        parser.add_argument('--chunk', type=int, default=1000, help="trips per batch")
+
+    def handle(self, *args, **options):
+        total = recomputeFinishedTrips(chunk_size=options['chunk'], fleet_id=options['fleet'])
+        self.stdout.write("Recomputed stats for " + str(total) + " trips")
@@ -1,6 +1,4 @@
-from django.utils import timezone
-
-from logistics.permissions import is_driver
+from logistics.presence import presence
 
 
 class UpdateOnlineMiddleware(object):
@@ -16,9 +14,9 @@ class UpdateOnlineMiddleware(object):
 
         # Code to be executed for each request/response after
         # the view is called.
+        # last_seen пишется в БД пачкой (logistics.presence), а не на каждый запрос
         user = request.user
-        if is_driver(user):
-            user.driver.last_seen = timezone.now()
-            user.driver.save(update_fields=["last_seen"])
+        if user.is_authenticated():
+            presence.touch(user.id)
 
         return response
\ No newline at end of file
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 01:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logistics', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DriverPoint',
+            fields=[
+                ('driver', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='logistics.Driver')),
+                ('oid', models.CharField(max_length=50)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FleetChannel',
+            fields=[
+                ('fleet', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='logistics.Fleet')),
+                ('oid', models.CharField(max_length=50)),
+            ],
+        ),
+    ]
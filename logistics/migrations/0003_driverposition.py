@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 01:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logistics', '0002_driverpoint_fleetchannel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DriverPosition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lat', models.FloatField()),
+                ('lon', models.FloatField()),
+                ('timestamp', models.DateTimeField()),
+                ('driver', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='logistics.Driver')),
+                ('trip', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='logistics.Trip')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='driverstats',
+            name='lat',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='driverstats',
+            name='lon',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='driverstats',
+            name='position_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='driverposition',
+            index_together=set([('driver', 'timestamp'), ('trip', 'timestamp')]),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 01:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logistics', '0003_driverposition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tripstats',
+            name='avg_speed',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tripstats',
+            name='distance',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tripstats',
+            name='duration',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tripstats',
+            name='idle_time',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tripstats',
+            name='max_speed',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tripstats',
+            name='points_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 01:59
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+ONE_ACTIVE_TRIP_INDEX = 'logistics_trip_one_active'
+
+
+# частичные индексы есть в SQLite и PostgreSQL; на других СУБД остаётся проверка в DriverAcceptTrip
+def create_one_active_trip_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('sqlite', 'postgresql'):
+        return
+    Trip = apps.get_model('logistics', 'Trip')
+    duplicates = Trip.objects.filter(is_finished=False, driver__isnull=False).values_list('driver_id', flat=True)
+    seen = set()
+    for driver_id in duplicates:
+        if driver_id in seen:
+            raise RuntimeError("Driver " + str(driver_id) + " has several unfinished trips, "
+                               "finish the extra ones before migrating")
+        seen.add(driver_id)
+    schema_editor.execute(
+        "CREATE UNIQUE INDEX " + ONE_ACTIVE_TRIP_INDEX + " ON logistics_trip (driver_id) "
+        "WHERE driver_id IS NOT NULL AND NOT is_finished")
+
+
+def drop_one_active_trip_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('sqlite', 'postgresql'):
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS " + ONE_ACTIVE_TRIP_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logistics', '0004_tripstats_values'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='trip',
+            index_together=set([('driver', 'is_finished'), ('fleet', 'driver', 'is_finished')]),
+        ),
+        migrations.RunPython(create_one_active_trip_index, drop_one_active_trip_index),
+    ]
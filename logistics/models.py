@@ -44,7 +44,10 @@ class Driver(models.Model):
 
 class DriverStats(models.Model):
     driver = models.OneToOneField(Driver, on_delete=models.CASCADE)
-    # TODO текущее местоположение
+    # текущее местоположение (последняя точка из DriverPosition)
+    lat = models.FloatField(null=True, blank=True)
+    lon = models.FloatField(null=True, blank=True)
+    position_date = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return self.driver.first_name+' '+self.driver.last_name+' stats'
@@ -72,13 +75,77 @@ class Trip(models.Model):
     driver = models.ForeignKey(Driver, null=True, blank=True)
     fleet = models.ForeignKey(Fleet)
 
+    class Meta:
+        index_together = [
+            ('driver', 'is_finished'),  # текущий рейс водителя
+            ('fleet', 'driver', 'is_finished'),  # свободные рейсы автопарка (driver IS NULL)
+        ]
+        # не больше одного незавершённого рейса на водителя - частичный уникальный индекс
+        # logistics_trip_one_active в миграции 0005 (index_together так не умеет)
+
     def __str__(self):
         return 'trip ' + self.name
 
 
 class TripStats(models.Model):
     trip = models.OneToOneField(Trip, on_delete=models.CASCADE)
-    # TODO длительность, дальность, маршрут
+    # считается по точкам DriverPosition рейса (logistics.tripstats), маршрут - сами точки
+    distance = models.FloatField(default=0)  # метры
+    duration = models.FloatField(default=0)  # секунды
+    avg_speed = models.FloatField(default=0)  # м/с
+    max_speed = models.FloatField(default=0)  # м/с
+    idle_time = models.FloatField(default=0)  # секунды
+    points_count = models.IntegerField(default=0)
 
     def __str__(self):
         return 'Trip ' + self.trip.name + ' stats'
+
+
+# oid канала Geo2Tag для автопарка, общий для всех воркеров и переживает перезапуск
+class FleetChannel(models.Model):
+    fleet = models.OneToOneField(Fleet, on_delete=models.CASCADE, primary_key=True)
+    oid = models.CharField(max_length=50)
+
+    def __str__(self):
+        return str(self.fleet_id) + ' channel ' + self.oid
+
+
+# oid текущей точки водителя в Geo2Tag
+class DriverPoint(models.Model):
+    driver = models.OneToOneField(Driver, on_delete=models.CASCADE, primary_key=True)
+    oid = models.CharField(max_length=50)
+
+    def __str__(self):
+        return str(self.driver_id) + ' point ' + self.oid
+
+
+# история местоположений водителя, пишется пачками из logistics.positions
+class DriverPosition(models.Model):
+    driver = models.ForeignKey(Driver, on_delete=models.CASCADE, db_index=False)
+    trip = models.ForeignKey(Trip, null=True, blank=True, on_delete=models.CASCADE, db_index=False)
+    lat = models.FloatField()
+    lon = models.FloatField()
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        index_together = [
+            ('driver', 'timestamp'),
+            ('trip', 'timestamp'),
+        ]
+
+    def __str__(self):
+        return str(self.driver_id) + ' at ' + str(self.lat) + ' ' + str(self.lon)
+
+
+# версия данных для ETag и кэша списков (logistics.versions), общая для всех воркеров:
+# scope - 'fleet', 'owner' или 'driver', key - id автопарка, владельца или водителя
+class DataVersion(models.Model):
+    scope = models.CharField(max_length=10)
+    key = models.IntegerField()
+    version = models.BigIntegerField()
+
+    class Meta:
+        unique_together = [('scope', 'key')]
+
+    def __str__(self):
+        return self.scope + ' ' + str(self.key) + ' v' + str(self.version)
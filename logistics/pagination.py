@@ -0,0 +1,41 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+# Постраничная выдача списков по ключу (id), а не по OFFSET: страница берётся
+# условием id < последнего показанного, поэтому её стоимость не растёт с историей.
+# Включается, если клиент передал limit или cursor (фронтенд - через getAllPages в list-pages.js).
+# Без них отдаётся простой список, но не больше max_page_size записей.
+class KeysetPagination(CursorPagination):
+    page_size_query_param = 'limit'
+    max_page_size = getattr(settings, 'PAGINATION_MAX_LIMIT', 100)
+    ordering = '-id'
+
+    def __init__(self, ordering=None):
+        if ordering is not None:
+            self.ordering = ordering
+
+    # CursorPagination в DRF 3.5 не читает page_size_query_param
+    def get_page_size(self, request):
+        try:
+            limit = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if limit <= 0:
+            return self.page_size
+        return min(limit, self.max_page_size)
+
+    @classmethod
+    def is_requested(cls, request):
+        return cls.page_size_query_param in request.query_params or cls.cursor_query_param in request.query_params
+
+
+# данные для Response со списком: страница KeysetPagination ({next, previous, results}) или список
+# первых limit записей в порядке ordering (по умолчанию PAGINATION_MAX_LIMIT), если страница не запрошена
+def listData(request, view, queryset, serializer_class, ordering=None, limit=None):
+    paginator = KeysetPagination(ordering)
+    if not KeysetPagination.is_requested(request):
+        queryset = queryset.order_by(paginator.ordering)[:limit or paginator.max_page_size]
+        return serializer_class(queryset, many=True).data
+    page = paginator.paginate_queryset(queryset, request, view)
+    return paginator.get_paginated_response(serializer_class(page, many=True).data).data
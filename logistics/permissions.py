@@ -1,12 +1,61 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
 from rest_framework import permissions
 
+from logistics.models import Driver, Fleet
+
+# Группы пользователя: один запрос, результат запоминается на объекте user, то есть на время запроса.
+# Между запросами не кэшируются: кэш процесса не увидел бы изменения групп в других воркерах.
+def user_roles(user):
+    roles = getattr(user, '_logistics_roles', None)
+    if roles is None:
+        if user.pk is None:
+            roles = frozenset()
+        else:
+            roles = frozenset(user.groups.values_list('name', flat=True))
+        user._logistics_roles = roles
+    return roles
+
 
 def is_owner(user):
-    return user.groups.filter(name='OWNER').exists()
+    return 'OWNER' in user_roles(user)
 
 
 def is_driver(user):
-    return user.groups.filter(name='DRIVER').exists()
+    return 'DRIVER' in user_roles(user)
+
+
+# Доступ к автопарку: один EXISTS по индексам, результат запоминается на объекте user
+# до конца запроса. Не загружает ни профиль владельца/водителя, ни список его автопарков.
+def _fleet_access(user, kind, fleet_id, query):
+    try:
+        key = (kind, int(fleet_id))
+    except (TypeError, ValueError):
+        return False
+    if user.pk is None:
+        return False
+    memo = user.__dict__.setdefault('_logistics_fleet_access', {})
+    if key not in memo:
+        memo[key] = query(key[1]).exists()
+    return memo[key]
+
+
+def owns_fleet(user, fleet_id):
+    return _fleet_access(user, 'owner', fleet_id,
+                         lambda pk: Fleet.objects.filter(pk=pk, owner__user_id=user.pk))
+
+
+def in_fleet(user, fleet_id):
+    return _fleet_access(user, 'driver', fleet_id,
+                         lambda pk: Driver.fleets.through.objects.filter(fleet_id=pk, driver__user_id=user.pk))
+
+
+# группы изменили у этого же объекта user - запомненные роли больше не верны
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_roles(sender, instance, action, reverse, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear') and not reverse:
+        instance.__dict__.pop('_logistics_roles', None)
 
 
 class IsOwnerPermission(permissions.BasePermission):
@@ -0,0 +1,181 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, When, Value, FloatField, DateTimeField
+from django.utils import timezone
+
+from logistics.Geo2TagService import publishDriverPositions
+from logistics.models import DriverPosition, DriverStats
+
+
+# Write-behind очередь местоположений водителей.
+# /api/driver/update_pos/ только кладёт последнюю точку водителя в память,
+# а фоновый поток раз в flush_interval секунд отправляет накопленное в Geo2Tag
+# одним пакетным запросом (publishDriverPositions).
+# Повторные точки одного водителя между сбросами схлопываются в одну.
+# Все точки при этом копятся в истории и пишутся в DriverPosition одним bulk insert.
+class PositionQueue(object):
+    def __init__(self, flush_interval, batch_size):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = {}  # driver_id -> (fleet, driver, lat, lon, received_at)
+        self._history = []  # несохранённые DriverPosition
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._history_lock = threading.Lock()  # держится от выемки истории до её записи в БД
+        self._thread = None
+        self._stop = threading.Event()
+        self._stats = {
+            "enqueued": 0,
+            "coalesced": 0,
+            "flushed": 0,
+            "errors": 0,
+            "flushes": 0,
+            "history_written": 0,
+            "last_flush_at": None,
+            "last_flush_duration": 0.0,
+            "last_flush_lag": 0.0,
+            "max_flush_lag": 0.0,
+        }
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # запускает фоновый поток сброса (вызывается из wsgi.py)
+    def start(self):
+        with self._lock:
+            if self.is_running():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="position-queue-flusher")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print("EXCEPTION WHILE PositionQueue.flush: " + str(e))
+            finally:
+                close_old_connections()
+
+    # ставит точку водителя в очередь, более старая неотправленная точка заменяется
+    def put(self, fleet, driver, lat, lon, trip_id=None):
+        position = DriverPosition(driver_id=driver.id, trip_id=trip_id, lat=lat, lon=lon, timestamp=timezone.now())
+        with self._lock:
+            if driver.id in self._pending:
+                self._stats["coalesced"] += 1
+            self._pending[driver.id] = (fleet, driver, lat, lon, time.time())
+            self._history.append(position)
+            self._stats["enqueued"] += 1
+            depth = max(len(self._pending), len(self._history))
+        # без фонового потока (manage.py shell, тесты) очередь сбрасывается сама по заполнении
+        if not self.is_running() and depth >= self.batch_size:
+            self.flush()
+
+    # убирает неотправленную точку водителя (при завершении рейса и исключении из автопарка)
+    def discard(self, driver_id, fleet_id=None):
+        with self._lock:
+            entry = self._pending.get(driver_id)
+            if entry is not None and (fleet_id is None or entry[0].id == int(fleet_id)):
+                del self._pending[driver_id]
+
+    def _take(self):
+        with self._lock:
+            pending, history = self._pending, self._history
+            self._pending, self._history = {}, []
+        return list(pending.values()), history
+
+    # записывает в БД накопленные в этом процессе точки одного водителя, не дожидаясь фонового
+    # сброса (перед расчётом статистики его рейса). Если фоновый сброс уже забрал точки,
+    # _history_lock дождётся их записи. Точки из очередей других воркеров сюда не попадают -
+    # их учитывает отложенный пересчёт (tripstats.recomputeTripStatsLater).
+    def flush_driver_history(self, driver_id):
+        with self._history_lock:
+            with self._lock:
+                history = [position for position in self._history if position.driver_id == driver_id]
+                if history:
+                    self._history = [position for position in self._history if position.driver_id != driver_id]
+            self._save_history(history)
+
+    def _save_history(self, history):
+        if not history:
+            return
+        try:
+            savePositions(history)
+        except Exception as e:
+            print("EXCEPTION WHILE savePositions: " + str(e))
+            return
+        with self._lock:
+            self._stats["history_written"] += len(history)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._history_lock:
+                entries, history = self._take()
+                self._save_history(history)
+            if not entries:
+                return 0
+            started = time.time()
+            lag = started - min(entry[4] for entry in entries)
+            published = publishDriverPositions([entry[:4] for entry in entries])
+            errors = len(entries) - published
+            finished = time.time()
+            with self._lock:
+                self._stats["flushes"] += 1
+                self._stats["flushed"] += published
+                self._stats["errors"] += errors
+                self._stats["last_flush_at"] = finished
+                self._stats["last_flush_duration"] = finished - started
+                self._stats["last_flush_lag"] = lag
+                self._stats["max_flush_lag"] = max(self._stats["max_flush_lag"], lag)
+            return len(entries)
+
+    # метрики очереди: глубина, возраст самой старой точки, задержка сброса
+    def metrics(self):
+        with self._lock:
+            now = time.time()
+            oldest = min((entry[4] for entry in self._pending.values()), default=None)
+            metrics = dict(self._stats)
+            metrics["running"] = self.is_running()
+            metrics["depth"] = len(self._pending)
+            metrics["history_depth"] = len(self._history)
+            metrics["oldest_pending_age"] = now - oldest if oldest is not None else 0.0
+            return metrics
+
+
+# сохраняет точки одним bulk insert и обновляет текущее местоположение в DriverStats
+# (по одному UPDATE на UPDATE_CHUNK водителей, а не на каждую точку)
+UPDATE_CHUNK = 100
+
+
+def savePositions(positions):
+    DriverPosition.objects.bulk_create(positions)
+    latest = {}
+    for position in positions:
+        latest[position.driver_id] = position
+    driver_ids = list(latest)
+    for start in range(0, len(driver_ids), UPDATE_CHUNK):
+        chunk = [latest[driver_id] for driver_id in driver_ids[start:start + UPDATE_CHUNK]]
+        DriverStats.objects.filter(driver_id__in=[position.driver_id for position in chunk]).update(
+            lat=Case(*[When(driver_id=p.driver_id, then=Value(p.lat)) for p in chunk], output_field=FloatField()),
+            lon=Case(*[When(driver_id=p.driver_id, then=Value(p.lon)) for p in chunk], output_field=FloatField()),
+            position_date=Case(*[When(driver_id=p.driver_id, then=Value(p.timestamp)) for p in chunk],
+                               output_field=DateTimeField()),
+        )
+
+
+position_queue = PositionQueue(
+    flush_interval=getattr(settings, 'POSITION_FLUSH_INTERVAL', 2),
+    batch_size=getattr(settings, 'POSITION_BATCH_SIZE', 500),
+)
@@ -0,0 +1,93 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, When, Value, DateTimeField
+from django.utils import timezone
+
+from logistics.models import Driver
+
+ONLINE_PERIOD = 2 * 60  # секунд после последнего запроса водитель считается online
+
+
+# Отметки активности пользователей (Driver.last_seen).
+# UpdateOnlineMiddleware только запоминает время последнего запроса пользователя,
+# а в БД оно пишется раз в flush_interval секунд одним UPDATE на UPDATE_CHUNK водителей.
+# Ключ - user_id, чтобы не загружать request.user.driver на каждом запросе;
+# владельцы в UPDATE просто не находятся.
+class PresenceTracker(object):
+    UPDATE_CHUNK = 100
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._seen = {}  # user_id -> время последнего запроса
+        self._recent = {}  # user_id -> время, в том числе уже записанное в БД (для is_online)
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # запускает фоновый поток записи (вызывается из wsgi.py)
+    def start(self):
+        with self._lock:
+            if self.is_running():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="presence-flusher")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print("EXCEPTION WHILE PresenceTracker.flush: " + str(e))
+            finally:
+                close_old_connections()
+
+    def touch(self, user_id):
+        now = timezone.now()
+        with self._lock:
+            self._seen[user_id] = now
+            self._recent[user_id] = now
+            due = time.time() - self._last_flush >= self.flush_interval
+        # без фонового потока (manage.py runserver без wsgi.py, тесты) пишем сами раз в интервал
+        if due and not self.is_running():
+            self.flush()
+
+    # самое свежее известное время активности пользователя (или None)
+    def last_seen(self, user_id):
+        return self._recent.get(user_id)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                seen, self._seen = self._seen, {}
+                self._last_flush = time.time()
+                # старше порога online значения уже не нужны - их хватает из БД
+                threshold = timezone.now() - timedelta(seconds=ONLINE_PERIOD)
+                self._recent = {user_id: date for user_id, date in self._recent.items() if date >= threshold}
+            user_ids = list(seen)
+            for start in range(0, len(user_ids), self.UPDATE_CHUNK):
+                chunk = user_ids[start:start + self.UPDATE_CHUNK]
+                Driver.objects.filter(user_id__in=chunk).update(
+                    last_seen=Case(*[When(user_id=user_id, then=Value(seen[user_id])) for user_id in chunk],
+                                   output_field=DateTimeField()))
+            return len(user_ids)
+
+
+presence = PresenceTracker(flush_interval=getattr(settings, 'PRESENCE_FLUSH_INTERVAL', 15))
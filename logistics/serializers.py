@@ -2,7 +2,8 @@ from django.contrib.auth.models import Group
 from django.utils import timezone
 from rest_framework import serializers
 
-from .models import Owner, Fleet, Driver, Trip
+from .models import Owner, Fleet, Driver, Trip, DriverStats, DriverPosition, TripStats
+from .presence import presence, ONLINE_PERIOD
 
 
 class FleetSerializer(serializers.ModelSerializer):
@@ -20,14 +21,31 @@ class FleetSerializer(serializers.ModelSerializer):
             'trips_count'
         )
 
+    # для списков счётчики приходят из with_counts одним запросом
     def get_cars_count(self, obj):
+        if hasattr(obj, 'cars_count'):
+            return obj.cars_count
         drivers = Driver.objects.filter(fleets=obj)
         return drivers.count()
 
     def get_trips_count(self, obj):
+        if hasattr(obj, 'trips_count'):
+            return obj.trips_count
         trips = Trip.objects.filter(fleet=obj)
         return trips.count()
 
+    # счётчики водителей и рейсов коррелированными подзапросами, без запроса на каждый автопарк
+    # (annotate(Count) по двум связям перемножил бы строки)
+    @staticmethod
+    def with_counts(fleets):
+        fleet_table = Fleet._meta.db_table
+        return fleets.extra(select={
+            'cars_count': 'SELECT COUNT(*) FROM ' + Driver.fleets.through._meta.db_table +
+                          ' WHERE fleet_id = ' + fleet_table + '.id',
+            'trips_count': 'SELECT COUNT(*) FROM ' + Trip._meta.db_table +
+                           ' WHERE fleet_id = ' + fleet_table + '.id',
+        })
+
 
 class OwnerSerializer(serializers.ModelSerializer):
     login = serializers.ReadOnlyField(source='user.username')
@@ -49,6 +67,7 @@ class DriverSerializer(serializers.ModelSerializer):
     login = serializers.ReadOnlyField(source='user.username')
     email = serializers.ReadOnlyField(source='user.email')
     is_online = serializers.SerializerMethodField()
+    last_seen = serializers.SerializerMethodField()
     current_trip_fleet_id = serializers.SerializerMethodField()
 
     class Meta:
@@ -68,21 +87,61 @@ class DriverSerializer(serializers.ModelSerializer):
         )
 
     def get_is_online(self, obj):
-        if obj.last_seen is not None:
-            diff = timezone.now() - obj.last_seen
-            if diff.seconds < 2 * 60: # two minutes
+        last_seen = self._last_seen(obj)
+        if last_seen is not None:
+            diff = timezone.now() - last_seen
+            if diff.seconds < ONLINE_PERIOD: # two minutes
                 return True
         return False
 
+    def get_last_seen(self, obj):
+        last_seen = self._last_seen(obj)
+        return serializers.DateTimeField().to_representation(last_seen) if last_seen is not None else None
+
+    # отметка из памяти свежее, пока presence не записал её в БД
+    def _last_seen(self, obj):
+        recent = presence.last_seen(obj.user_id)
+        if recent is not None and (obj.last_seen is None or recent > obj.last_seen):
+            return recent
+        return obj.last_seen
+
     def get_current_trip_fleet_id(self, obj):
+        if hasattr(obj, 'current_trip_fleet_id'):
+            return obj.current_trip_fleet_id if obj.current_trip_fleet_id is not None else -1
         try:
             trip = Trip.objects.get(driver=obj, is_finished=False)
-            return trip.fleet.id
+            return trip.fleet_id
         except:
             return -1
 
+    # user и автопарк текущего рейса в том же запросе, что и сами водители
+    @staticmethod
+    def with_current_trip(drivers):
+        trip_table = Trip._meta.db_table
+        return drivers.select_related('user').extra(
+            select={'current_trip_fleet_id': 'SELECT ' + trip_table + '.fleet_id FROM ' + trip_table +
+                                             ' WHERE ' + trip_table + '.driver_id = ' + Driver._meta.db_table +
+                                             '.id AND ' + trip_table + '.is_finished = %s LIMIT 1'},
+            select_params=(False,),
+        )
+
+
+class TripStatsSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = TripStats
+        fields = (
+            'distance',
+            'duration',
+            'avg_speed',
+            'max_speed',
+            'idle_time',
+            'points_count'
+        )
+
 
 class TripSerializer(serializers.ModelSerializer):
+    stats = TripStatsSerializer(source='tripstats', read_only=True)
 
     class Meta:
         model = Trip
@@ -98,7 +157,32 @@ class TripSerializer(serializers.ModelSerializer):
             'end_date',
             'is_finished',
             'problem',
-            'problem_description'
+            'problem_description',
+            'stats'
+        )
+
+
+class DriverLocationSerializer(serializers.ModelSerializer):
+    driver_id = serializers.ReadOnlyField()
+
+    class Meta:
+        model = DriverStats
+        fields = (
+            'driver_id',
+            'lat',
+            'lon',
+            'position_date'
+        )
+
+
+class DriverPositionSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = DriverPosition
+        fields = (
+            'lat',
+            'lon',
+            'timestamp'
         )
 
 
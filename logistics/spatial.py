@@ -0,0 +1,186 @@
+import math
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from logistics.models import DriverStats, Trip
+
+EARTH_RADIUS = 6371000.0  # метры
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+# Равномерная сетка текущих положений водителей одного автопарка.
+# Ячейка - cell_size градусов по широте и долготе; поиск k ближайших обходит
+# кольца ячеек вокруг точки запроса и останавливается, как только следующее
+# кольцо заведомо дальше k-го найденного водителя.
+class FleetGrid(object):
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}  # (i, j) -> set(driver_id)
+        self.drivers = {}  # driver_id -> [lat, lon, cell, available, updated_at]
+        self.loaded_at = 0
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size))
+
+    def update(self, driver_id, lat, lon, available, updated_at):
+        cell = self._cell(lat, lon)
+        entry = self.drivers.get(driver_id)
+        if entry is not None and entry[2] != cell:
+            self._remove_from_cell(driver_id, entry[2])
+        self.cells.setdefault(cell, set()).add(driver_id)
+        self.drivers[driver_id] = [lat, lon, cell, available, updated_at]
+
+    def set_available(self, driver_id, available):
+        entry = self.drivers.get(driver_id)
+        if entry is not None:
+            entry[3] = available
+
+    def remove(self, driver_id):
+        entry = self.drivers.pop(driver_id, None)
+        if entry is not None:
+            self._remove_from_cell(driver_id, entry[2])
+
+    def _remove_from_cell(self, driver_id, cell):
+        drivers = self.cells.get(cell)
+        if drivers is not None:
+            drivers.discard(driver_id)
+            if not drivers:
+                del self.cells[cell]
+
+    # нижняя оценка размера ячейки в метрах в пределах radius колец от широты lat
+    def _cell_meters(self, lat, radius):
+        cos_lat = math.cos(math.radians(min(abs(lat) + (radius + 1) * self.cell_size, 90.0)))
+        return math.radians(self.cell_size) * EARTH_RADIUS * max(cos_lat, 0.0)
+
+    def _ring(self, center, radius):
+        ci, cj = center
+        if radius == 0:
+            yield center
+            return
+        for j in range(cj - radius, cj + radius + 1):
+            yield ci - radius, j
+            yield ci + radius, j
+        for i in range(ci - radius + 1, ci + radius):
+            yield i, cj - radius
+            yield i, cj + radius
+
+    # k ближайших водителей к точке: список (driver_id, расстояние в метрах, lat, lon)
+    def nearest(self, lat, lon, k, available_only=True, min_updated_at=None):
+        def accept(driver_id):
+            entry = self.drivers[driver_id]
+            if available_only and not entry[3]:
+                return None
+            if min_updated_at is not None and entry[4] < min_updated_at:
+                return None
+            return driver_id, haversine(lat, lon, entry[0], entry[1]), entry[0], entry[1]
+
+        found = []
+        center = self._cell(lat, lon)
+        visited_cells = 0
+        radius = 0
+        while visited_cells < len(self.cells):
+            if 8 * radius > len(self.cells) - visited_cells:
+                # колец больше, чем занятых ячеек - дешевле просмотреть оставшиеся ячейки целиком
+                for cell, drivers in self.cells.items():
+                    if max(abs(cell[0] - center[0]), abs(cell[1] - center[1])) >= radius:
+                        found.extend(filter(None, map(accept, drivers)))
+                break
+            for cell in self._ring(center, radius):
+                drivers = self.cells.get(cell)
+                if drivers:
+                    visited_cells += 1
+                    found.extend(filter(None, map(accept, drivers)))
+            if len(found) >= k:
+                found.sort(key=lambda item: item[1])
+                found = found[:k]
+                if found[-1][1] <= radius * self._cell_meters(lat, radius + 1):
+                    break
+            radius += 1
+        found.sort(key=lambda item: item[1])
+        return found[:k]
+
+
+# Индекс по всем автопаркам процесса. Сетка автопарка строится из DriverStats
+# при первом запросе и перечитывается раз в refresh_interval секунд, чтобы видеть
+# точки, принятые другими воркерами; между перечитываниями обновляется из update_pos.
+class DriverIndex(object):
+    def __init__(self, cell_size, refresh_interval, max_age):
+        self.cell_size = cell_size
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self._grids = {}  # fleet_id -> FleetGrid
+        self._driver_fleets = {}  # driver_id -> set(fleet_id)
+        self._lock = threading.Lock()
+
+    def _grid(self, fleet_id):
+        grid = self._grids.get(fleet_id)
+        if grid is None:
+            grid = self._grids[fleet_id] = FleetGrid(self.cell_size)
+        return grid
+
+    def update(self, fleet_id, driver_id, lat, lon, available=False):
+        with self._lock:
+            self._grid(fleet_id).update(driver_id, lat, lon, available, timezone.now())
+            self._driver_fleets.setdefault(driver_id, set()).add(fleet_id)
+
+    # водитель взял или завершил рейс - меняется доступность во всех его автопарках
+    def set_available(self, driver_id, available):
+        with self._lock:
+            for fleet_id in self._driver_fleets.get(driver_id, ()):
+                self._grids[fleet_id].set_available(driver_id, available)
+
+    def remove(self, fleet_id, driver_id):
+        with self._lock:
+            grid = self._grids.get(fleet_id)
+            if grid is not None:
+                grid.remove(driver_id)
+            self._driver_fleets.get(driver_id, set()).discard(fleet_id)
+
+    def _load(self, fleet_id):
+        since = timezone.now() - timedelta(seconds=self.max_age)
+        locations = DriverStats.objects.filter(driver__fleets=fleet_id, position_date__gte=since) \
+            .values_list('driver_id', 'lat', 'lon', 'position_date')
+        busy = set(Trip.objects.filter(driver__fleets=fleet_id, is_finished=False).values_list('driver_id', flat=True))
+        grid = FleetGrid(self.cell_size)
+        for driver_id, lat, lon, position_date in locations:
+            grid.update(driver_id, lat, lon, driver_id not in busy, position_date)
+        grid.loaded_at = time.time()
+        with self._lock:
+            old = self._grids.get(fleet_id)
+            if old is not None:
+                # точки, пришедшие в этот процесс свежее, чем в БД, не теряем
+                for driver_id, entry in old.drivers.items():
+                    current = grid.drivers.get(driver_id)
+                    if current is None or current[4] < entry[4]:
+                        grid.update(driver_id, entry[0], entry[1], entry[3], entry[4])
+                for driver_id in old.drivers:
+                    self._driver_fleets.get(driver_id, set()).discard(fleet_id)
+            for driver_id in grid.drivers:
+                self._driver_fleets.setdefault(driver_id, set()).add(fleet_id)
+            self._grids[fleet_id] = grid
+
+    def nearest(self, fleet_id, lat, lon, k):
+        grid = self._grids.get(fleet_id)
+        if grid is None or time.time() - grid.loaded_at >= self.refresh_interval:
+            self._load(fleet_id)
+        min_updated_at = timezone.now() - timedelta(seconds=self.max_age)
+        with self._lock:
+            return self._grids[fleet_id].nearest(lat, lon, k, min_updated_at=min_updated_at)
+
+
+driver_index = DriverIndex(
+    cell_size=getattr(settings, 'DRIVER_INDEX_CELL_SIZE', 0.01),
+    refresh_interval=getattr(settings, 'DRIVER_INDEX_REFRESH', 30),
+    max_age=getattr(settings, 'DRIVER_INDEX_MAX_AGE', 30 * 60),
+)
@@ -8,7 +8,7 @@ dApp.config(function($interpolateProvider) {
 
 dApp.controller('getPendings', ['$scope', '$http', function ($scope, $http) {
     $scope.fleets = [];
-    return $http.get('/api/driver/pending_fleets').then(function(result) {
+    return getAllPages($http, '/api/driver/pending_fleets/').then(function(result) {
         return angular.forEach(result.data, function(item) {
             console.log(item);
             return $scope.fleets.push(item);
@@ -83,7 +83,7 @@ dApp.controller('driverFleets', ['$scope', '$http', function ($scope, $http) {
     $scope.showDriversFleets = function(){
         $scope.dfleets =[];
 
-        $http.get('/api/driver/fleets/').then(function (res) {
+        getAllPages($http, '/api/driver/fleets/').then(function (res) {
             return angular.forEach(res.data, function(item) {
                 return $scope.dfleets.push(item);
             });
@@ -112,7 +112,7 @@ dApp.controller('driverFleets', ['$scope', '$http', function ($scope, $http) {
     $scope.getTrips = function () {
         console.log($scope.fleetId);
         $scope.trips = [];
-        $http.get('/api/driver/fleet/'+ $scope.fleetId +'/available_trips/').then(function(result) { // можно сделать выборку по конкретному автопарку
+        getAllPages($http, '/api/driver/fleet/'+ $scope.fleetId +'/available_trips/').then(function(result) { // можно сделать выборку по конкретному автопарку
             console.log(result.data);
             return angular.forEach(result.data, function(item) {
                 $scope.trips.push(item);
@@ -124,10 +124,14 @@ dApp.controller('driverFleets', ['$scope', '$http', function ($scope, $http) {
     $scope.getTripsOld = function (fleetId) {
         $scope.fleetId = fleetId;
         $scope.trips = [];
+        // список обновляется сам, когда свободные рейсы появляются или их разбирают
+        waitAvailableTrips($http, function () {
+            $scope.getTripsOld($scope.fleetId);
+        });
         if(fleetId == -1) {
             document.getElementById('create-new-trip').style.display = 'none';
 
-            $http.get('/api/driver/available_trips/').then(function (result) { // можно сделать выборку по конкретному автопарку
+            getAllPages($http, '/api/driver/available_trips/').then(function (result) { // можно сделать выборку по конкретному автопарку
                 console.log(result.data);
                 return angular.forEach(result.data, function (item) {
                     $scope.trips.push(item);
@@ -135,7 +139,7 @@ dApp.controller('driverFleets', ['$scope', '$http', function ($scope, $http) {
             });
         } else {
             document.getElementById('create-new-trip').style.display = 'block';
-            $http.get('/api/driver/fleet/' + $scope.fleetId + '/available_trips/').then(function (result) { // можно сделать выборку по конкретному автопарку
+            getAllPages($http, '/api/driver/fleet/' + $scope.fleetId + '/available_trips/').then(function (result) { // можно сделать выборку по конкретному автопарку
                 return angular.forEach(result.data, function (item) {
                     $scope.trips.push(item);
                 });
@@ -147,7 +151,7 @@ dApp.controller('driverFleets', ['$scope', '$http', function ($scope, $http) {
     $scope.getPrevTrips = function () {
         console.log($scope.fleetId);
         $scope.trips = [];
-        $http.get('/api/driver/fleet/'+ $scope.fleetId +'/available_trips/').then(function(result) { // можно сделать выборку по конкретному автопарку
+        getAllPages($http, '/api/driver/fleet/'+ $scope.fleetId +'/available_trips/').then(function(result) { // можно сделать выборку по конкретному автопарку
             console.log(result.data);
             return angular.forEach(result.data, function(item) {
                 $scope.trips.push(item);
@@ -161,14 +165,14 @@ dApp.controller('driverFleets', ['$scope', '$http', function ($scope, $http) {
         $scope.finishedTrips = [];
 
         if(fleet == -1) {
-            $http.get('/api/driver/trips/').then(function (result) { // можно сделать выборку по конкретному автопарку
+            getAllPages($http, '/api/driver/trips/').then(function (result) { // можно сделать выборку по конкретному автопарку
                 return angular.forEach(result.data, function (item) {
                     $scope.finishedTrips.push(item);
                 });
             });
         }
         else {
-            $http.get('/api/driver/fleet/' + fleet + '/trips/').then(function (result) {
+            getAllPages($http, '/api/driver/fleet/' + fleet + '/trips/').then(function (result) {
                 return angular.forEach(result.data, function (item) {
                     $scope.finishedTrips.push(item);
                 });
@@ -202,7 +206,7 @@ dApp.controller('driverFleets', ['$scope', '$http', function ($scope, $http) {
 
     $scope.refreshPendings = function () {
         $scope.pendings = [];
-        $http.get('/api/driver/pending_fleets/').then(function(result) {
+        getAllPages($http, '/api/driver/pending_fleets/').then(function(result) {
             return angular.forEach(result.data, function(item) {
                 $scope.pendings.push(item);
             });
@@ -10,7 +10,7 @@ myApp.config(function($interpolateProvider) {
 myApp.controller('GetOwnersFleetsController',[
     '$scope', '$http', function($scope, $http) {
         $scope.fleets = [];
-        return $http.get('/api/fleet/').then(function(result) {
+        return getAllPages($http, '/api/fleet/').then(function(result) {
             return angular.forEach(result.data, function(item) {
                 return $scope.fleets.push(item);
             });
@@ -86,7 +86,7 @@ myApp.controller('ownerFleetController',[
         };
 
         $scope.loadDriversData = function () {
-            return $http.get('/api/fleet/'+$scope.getFleetId()+'/drivers/').then(function(result) {
+            return getAllPages($http, '/api/fleet/'+$scope.getFleetId()+'/drivers/').then(function(result) {
                 return angular.forEach(result.data, function(item) {
                     return driversStorage.getDrivers().push(item);
                 });
@@ -127,7 +127,7 @@ myApp.controller('ownerFleetController',[
         $scope.showPendingDrivers = function(fleetId){
             $scope.pdrivers =[];
 
-            return $http.get('/api/fleet/'+fleetId+'/pending_drivers/').then(function (res) {
+            return getAllPages($http, '/api/fleet/'+fleetId+'/pending_drivers/').then(function (res) {
                 return angular.forEach(res.data, function(item) {
                     return $scope.pdrivers.push(item);
                 });
@@ -159,7 +159,7 @@ myApp.controller('ownerFleetController',[
         };
         $scope.getTrips = function (id) {
             $scope.trips = [];
-            $http.get('/api/fleet/'+id+'/trips/unaccepted/').then(function (result) { // можно сделать выборку по конкретному автопарку
+            getAllPages($http, '/api/fleet/'+id+'/trips/unaccepted/').then(function (result) { // можно сделать выборку по конкретному автопарку
                 return angular.forEach(result.data, function (item) {
                     $scope.trips.push(item);
                 });
@@ -169,7 +169,7 @@ myApp.controller('ownerFleetController',[
 
         $scope.getFinishedTrips = function (id) {
             $scope.finishedTrips = [];
-            $http.get('/api/fleet/'+id+'/trips/finished/').then(function (result) { // можно сделать выборку по конкретному автопарку
+            getAllPages($http, '/api/fleet/'+id+'/trips/finished/').then(function (result) { // можно сделать выборку по конкретному автопарку
                 return angular.forEach(result.data, function (item) {
                     $scope.finishedTrips.push(item);
                 });
@@ -0,0 +1,16 @@
+// Загружает весь список API по страницам: запрашивает ?limit=100 и идёт по ссылкам next.
+// Без limit сервер отдаёт только первые PAGINATION_MAX_LIMIT записей.
+// Результат как у $http.get: {data: [...все элементы]}.
+function getAllPages($http, url) {
+    var items = [];
+    function load(pageUrl) {
+        return $http.get(pageUrl).then(function (result) {
+            items = items.concat(result.data.results);
+            if (result.data.next) {
+                return load(result.data.next);
+            }
+            return {data: items};
+        });
+    }
+    return load(url + (url.indexOf('?') < 0 ? '?' : '&') + 'limit=100');
+}
@@ -0,0 +1,37 @@
+// Long-poll /api/driver/available_trips/wait/: onNotices(data) вызывается, когда в автопарках
+// водителя появились или разобраны свободные рейсы. На 503 (все места ожидания заняты) и на
+// ошибки следующий запрос откладывается на Retry-After, удваивая паузу при повторных отказах
+// (не больше минуты) и со случайным разбросом, чтобы водители не возвращались все разом.
+// Между успешными запросами - не меньше WAIT_MIN_DELAY мс, даже если сервер ответил сразу.
+var WAIT_MIN_DELAY = 1000;
+
+function waitAvailableTrips($http, onNotices) {
+    if (waitAvailableTrips.started) {
+        return;
+    }
+    waitAvailableTrips.started = true;
+    var lastEventId = null;
+    var failures = 0;
+
+    function poll() {
+        var url = '/api/driver/available_trips/wait/';
+        if (lastEventId !== null) {
+            url += '?last_event_id=' + lastEventId;
+        }
+        var started = Date.now();
+        $http.get(url).then(function (result) {
+            failures = 0;
+            lastEventId = result.data.last_event_id;
+            if (result.data.notices.length) {
+                onNotices(result.data);
+            }
+            setTimeout(poll, Math.max(WAIT_MIN_DELAY - (Date.now() - started), 0));
+        }, function (error) {
+            failures = Math.min(failures + 1, 6);
+            var retryAfter = parseInt(error.headers('Retry-After'), 10) || (error.data && error.data.retry) || 1;
+            var delay = Math.min(retryAfter * Math.pow(2, failures - 1), 60) * 1000;
+            setTimeout(poll, delay * (0.5 + Math.random()));
+        });
+    }
+    poll();
+}
@@ -1,7 +1,51 @@
+import csv
+import io
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import requests
+
+from django.contrib.auth.models import User, Group
+from django.core.cache import cache
 from django.test import Client
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction, IntegrityError
+from django.utils import timezone
+
+from logistics import Geo2TagService
+from logistics.api import parseIds
+from logistics.Geo2TagService import Geo2TagClient, Geo2TagUnavailable, publishDriverPositions
+from logistics.models import Owner, Driver, Fleet, DriverPoint, FleetChannel, Trip, DriverStats, DriverPosition, TripStats
+from logistics.events import EventBroker, AvailableTrips, formatEvent, fleet_events, publishTrips, waitTripNotices
+from logistics.geo2tag_standin import Geo2TagStandIn
+from logistics.pagination import KeysetPagination
+from logistics.permissions import is_driver, is_owner, owns_fleet, in_fleet
+from logistics.positions import PositionQueue, position_queue
+from logistics.presence import PresenceTracker
+from logistics.spatial import FleetGrid, DriverIndex, haversine
+from logistics import tripstats
+from logistics.tripstats import computeTripStats, updateTripStats
+from logistics.urls import urlpatterns
+from logistics.versions import bumpFleets, getVersions, profileId
+
 
-from logistics.permissions import is_driver, is_owner
+def createOwner(login):
+    user = User.objects.create_user(username=login, password=login)
+    user.groups.add(Group.objects.get_or_create(name='OWNER')[0])
+    return Owner.objects.create(user=user, first_name=login, last_name="Owner")
+
+
+def createDriver(login):
+    user = User.objects.create_user(username=login, password=login)
+    user.groups.add(Group.objects.get_or_create(name='DRIVER')[0])
+    driver = Driver.objects.create(user=user, first_name=login, last_name="Driver")
+    DriverStats.objects.create(driver=driver)
+    return driver
 
 
 class CommonApiTest(TestCase):
@@ -61,3 +105,1345 @@ class CommonApiTest(TestCase):
 
         self.assertFalse(is_owner(response.wsgi_request.user))
         self.assertTrue(is_driver(response.wsgi_request.user))
+
+
+class PositionQueueTest(TestCase):
+
+    def setUp(self):
+        self.queue = PositionQueue(flush_interval=60, batch_size=100)
+        patcher = mock.patch('logistics.positions.savePositions')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fleet = SimpleNamespace(id=1)
+        self.driver1 = SimpleNamespace(id=1)
+        self.driver2 = SimpleNamespace(id=2)
+
+    def test_coalesce_per_driver(self):
+        self.queue.put(self.fleet, self.driver1, "59.1", "30.1")
+        self.queue.put(self.fleet, self.driver1, "59.2", "30.2")
+        self.queue.put(self.fleet, self.driver2, "59.3", "30.3")
+        metrics = self.queue.metrics()
+        self.assertEqual(metrics["depth"], 2)
+        self.assertEqual(metrics["coalesced"], 1)
+
+        with mock.patch('logistics.positions.publishDriverPositions', return_value=2) as publish:
+            self.assertEqual(self.queue.flush(), 2)
+        self.assertEqual(publish.call_count, 1)
+        self.assertCountEqual(publish.call_args[0][0], [(self.fleet, self.driver1, "59.2", "30.2"),
+                                                        (self.fleet, self.driver2, "59.3", "30.3")])
+
+        metrics = self.queue.metrics()
+        self.assertEqual(metrics["depth"], 0)
+        self.assertEqual(metrics["flushed"], 2)
+
+    def test_discard(self):
+        self.queue.put(self.fleet, self.driver1, "59.1", "30.1")
+        self.queue.discard(self.driver1.id, fleet_id=2)
+        self.assertEqual(self.queue.metrics()["depth"], 1)
+        self.queue.discard(self.driver1.id)
+        self.assertEqual(self.queue.metrics()["depth"], 0)
+
+    def test_inline_flush_without_thread(self):
+        queue = PositionQueue(flush_interval=60, batch_size=2)
+        with mock.patch('logistics.positions.publishDriverPositions', return_value=2) as publish:
+            queue.put(self.fleet, self.driver1, "59.1", "30.1")
+            self.assertEqual(publish.call_count, 0)
+            queue.put(self.fleet, self.driver2, "59.2", "30.2")
+            self.assertEqual(publish.call_count, 1)
+
+
+class Geo2TagClientTest(TestCase):
+
+    def test_circuit_breaker(self):
+        client = Geo2TagClient(connect_timeout=0.5, read_timeout=0.5, retries=0, failure_threshold=2, reset_timeout=60)
+        url = "http://127.0.0.1:1/instance/service/testservice/channel"
+        for i in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                client.get(url)
+        self.assertTrue(client.is_open())
+        with self.assertRaises(Geo2TagUnavailable):
+            client.get(url)
+
+    def test_circuit_half_open(self):
+        client = Geo2TagClient(connect_timeout=0.5, read_timeout=0.5, retries=0, failure_threshold=1, reset_timeout=0)
+        url = "http://127.0.0.1:1/instance/service/testservice/channel"
+        with self.assertRaises(requests.ConnectionError):
+            client.get(url)
+        # reset_timeout истёк - пробный запрос снова идёт в сеть
+        with self.assertRaises(requests.ConnectionError):
+            client.get(url)
+
+    def blocking_request(self, client, release):
+        response = mock.Mock(status_code=200)
+        started = threading.Event()
+
+        def request(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return response
+        patcher = mock.patch.object(client.session, 'request', side_effect=request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return started
+
+    def test_half_open_lets_one_probe(self):
+        client = Geo2TagClient(connect_timeout=0.5, read_timeout=0.5, retries=0, failure_threshold=1, reset_timeout=0.2)
+        url = "http://127.0.0.1:1/instance/service/testservice/channel"
+        with self.assertRaises(requests.ConnectionError):
+            client.get(url)
+        time.sleep(0.25)
+
+        release = threading.Event()
+        started = self.blocking_request(client, release)
+        probe = threading.Thread(target=client.get, args=(url,))
+        probe.start()
+        self.assertTrue(started.wait(5))
+        # пока пробный запрос не вернулся, остальные отказывают сразу
+        with self.assertRaises(Geo2TagUnavailable):
+            client.get(url)
+        release.set()
+        probe.join()
+        self.assertFalse(client.is_open())
+        self.assertEqual(client.get(url).status_code, 200)
+
+    def test_pool_wait_is_bounded(self):
+        client = Geo2TagClient(pool_size=1, pool_timeout=0.1, retries=0)
+        url = "http://127.0.0.1:1/instance/service/testservice/channel"
+        release = threading.Event()
+        started = self.blocking_request(client, release)
+        busy = threading.Thread(target=client.get, args=(url,))
+        busy.start()
+        self.assertTrue(started.wait(5))
+        began = time.time()
+        with self.assertRaises(Geo2TagUnavailable):
+            client.get(url)
+        self.assertLess(time.time() - began, 2)
+        release.set()
+        busy.join()
+        # нехватка соединений - не ошибка Geo2Tag, breaker не открывается
+        self.assertFalse(client.is_open())
+
+
+class PublishDriverPositionsTest(TestCase):
+
+    def setUp(self):
+        owner = createOwner("owner1")
+        self.fleet1 = Fleet.objects.create(name="fleet1", owner=owner)
+        self.fleet2 = Fleet.objects.create(name="fleet2", owner=owner)
+        self.drivers = [createDriver("driver" + str(i)) for i in range(3)]
+        Geo2TagService.channel_dict[self.fleet1.id] = "channel1"
+        Geo2TagService.channel_dict[self.fleet2.id] = "channel2"
+        Geo2TagService.points_dict[self.drivers[0].id] = "old0"
+
+    def tearDown(self):
+        Geo2TagService.channel_dict.clear()
+        Geo2TagService.points_dict.clear()
+
+    def test_one_post_for_many_drivers(self):
+        updates = [(self.fleet1, self.drivers[0], "59.1", "30.1"),
+                   (self.fleet1, self.drivers[1], "59.2", "30.2"),
+                   (self.fleet2, self.drivers[2], "59.3", "30.3")]
+        client = Geo2TagService.client
+        with mock.patch.object(client, 'post', return_value=SimpleNamespace(text='["p0", "p1", "p2"]')) as post, \
+                mock.patch.object(client, 'delete_many', return_value=[]) as delete_many:
+            self.assertEqual(publishDriverPositions(updates), 3)
+
+        self.assertEqual(post.call_count, 1)
+        sent = json.loads(post.call_args[1]['data'])
+        self.assertEqual([point["channel_id"] for point in sent], ["channel1", "channel1", "channel2"])
+        delete_many.assert_called_once_with([Geo2TagService.getSerivceUrl() + '/point/old0'])
+        self.assertEqual([Geo2TagService.points_dict[driver.id] for driver in self.drivers], ["p0", "p1", "p2"])
+
+
+class OidStoreTest(TestCase):
+
+    def tearDown(self):
+        Geo2TagService.points_dict.clear()
+
+    def test_store_is_shared_through_db(self):
+        driver = createDriver("driver1")
+        Geo2TagService.points_dict[driver.id] = "point1"
+        self.assertEqual(DriverPoint.objects.get(driver=driver).oid, "point1")
+
+        # другой воркер видит тот же oid через свой собственный кэш
+        other = Geo2TagService.OidStore(DriverPoint, ttl=60)
+        with self.assertNumQueries(1):
+            self.assertEqual(other.get(driver.id), "point1")
+        with self.assertNumQueries(0):
+            self.assertEqual(other.get(driver.id), "point1")
+
+        self.assertEqual(other.pop(driver.id), "point1")
+        self.assertFalse(DriverPoint.objects.filter(driver=driver).exists())
+        self.assertIsNone(Geo2TagService.OidStore(DriverPoint, ttl=60).get(driver.id))
+
+    def test_delete_driver_pos_keeps_replaced_point(self):
+        driver = createDriver("driver1")
+        flusher, worker = Geo2TagService.OidStore(DriverPoint, ttl=60), Geo2TagService.OidStore(DriverPoint, ttl=60)
+        flusher[driver.id] = "old"
+        self.assertEqual(worker.get(driver.id), "old")
+        # точку заменили в другом воркере; в кэше этого воркера - старый oid
+        flusher[driver.id] = "new"
+        with mock.patch.object(Geo2TagService, 'points_dict', worker), \
+                mock.patch.object(Geo2TagService, 'client') as client:
+            # пока идёт DELETE, фоновый сброс ставит следующую точку
+            client.delete.side_effect = lambda url: flusher.__setitem__(driver.id, "newer")
+            Geo2TagService.deleteDriverPos(None, driver)
+        self.assertTrue(client.delete.call_args[0][0].endswith("/point/new"))
+        self.assertEqual(DriverPoint.objects.get(driver=driver).oid, "newer")
+
+        with mock.patch.object(Geo2TagService, 'points_dict', worker), mock.patch.object(Geo2TagService, 'client'):
+            Geo2TagService.deleteDriverPos(None, driver)
+        self.assertFalse(DriverPoint.objects.filter(driver=driver).exists())
+
+
+class ReconcileFleetChannelsTest(TestCase):
+
+    def tearDown(self):
+        Geo2TagService.channel_dict.clear()
+        Geo2TagService.points_dict.clear()
+
+    def test_delete_only_orphans(self):
+        owner = createOwner("owner1")
+        fleet1 = Fleet.objects.create(name="fleet1", owner=owner)
+        fleet2 = Fleet.objects.create(name="fleet2", owner=owner)
+        busy, idle = createDriver("busy"), createDriver("idle")
+        Trip.objects.create(name="t", fleet=fleet1, driver=busy, start_date=timezone.now())
+        Geo2TagService.channel_dict[fleet1.id] = "c1"
+        Geo2TagService.points_dict.set_many({busy.id: "p-busy", idle.id: "p-idle"})
+
+        remote = [{"_id": {"$oid": "c1dup"}, "name": "fleet1_" + str(fleet1.id)},
+                  {"_id": {"$oid": "c1"}, "name": "fleet1_" + str(fleet1.id)},
+                  {"_id": {"$oid": "c2"}, "name": "fleet2_" + str(fleet2.id)},
+                  {"_id": {"$oid": "gone"}, "name": "deleted_999"}]
+        client = Geo2TagService.client
+        deleted = []
+        with mock.patch.object(client, 'get', return_value=SimpleNamespace(text=json.dumps(remote))), \
+                mock.patch.object(client, 'delete_many', side_effect=lambda urls, **kw: deleted.extend(urls) or []):
+            stats = Geo2TagService.reconcileFleetChannels()
+
+        url = Geo2TagService.getSerivceUrl()
+        self.assertCountEqual(deleted, [url + "/channel/c1dup", url + "/channel/gone", url + "/point/p-idle"])
+        self.assertEqual(stats["matched_channels"], 2)
+        self.assertEqual(stats["deleted_channels"], 2)
+        self.assertEqual(dict(FleetChannel.objects.values_list('fleet_id', 'oid')), {fleet1.id: "c1", fleet2.id: "c2"})
+        self.assertEqual(list(DriverPoint.objects.values_list('oid', flat=True)), ["p-busy"])
+
+
+class Geo2TagStandInTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(Geo2TagStandInTest, cls).setUpClass()
+        cls.standin = Geo2TagStandIn().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.standin.stop()
+        super(Geo2TagStandInTest, cls).tearDownClass()
+
+    def setUp(self):
+        self.standin.reset()
+        self.standin.error_rate = 0.0
+        client = Geo2TagClient(connect_timeout=1, read_timeout=1, retries=0, failure_threshold=2)
+        for patcher in (mock.patch.object(Geo2TagService, 'SERVER_URL', self.standin.url),
+                        mock.patch.object(Geo2TagService, 'client', client)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        owner = createOwner("owner1")
+        self.fleet = Fleet.objects.create(name="fleet1", owner=owner)
+        self.drivers = [createDriver("driver" + str(i)) for i in range(2)]
+
+    def tearDown(self):
+        Geo2TagService.channel_dict.clear()
+        Geo2TagService.points_dict.clear()
+
+    def test_channel_and_points(self):
+        channel_oid = Geo2TagService.getOrCreateFleetChannel(self.fleet)
+        self.assertIn(channel_oid, self.standin.channels)
+        self.assertEqual(Geo2TagService.getOrCreateFleetChannel(self.fleet), channel_oid)
+        self.assertEqual(self.standin.count("POST", "channel"), 1)
+
+        updates = [(self.fleet, driver, "59.9", "30.3") for driver in self.drivers]
+        self.assertEqual(Geo2TagService.publishDriverPositions(updates), 2)
+        self.assertEqual(Geo2TagService.publishDriverPositions(updates), 2)
+        self.assertEqual(self.standin.count("POST", "point"), 2)
+        self.assertEqual(self.standin.count("DELETE", "point"), 2)
+        self.assertEqual(len(self.standin.points), 2)
+
+        Geo2TagService.deleteDriverPos(self.fleet, self.drivers[0])
+        self.assertEqual(len(self.standin.points), 1)
+
+    def test_existing_channel_is_reused(self):
+        channel_oid = Geo2TagService.getOrCreateFleetChannel(self.fleet)
+        Geo2TagService.channel_dict.clear()
+        self.assertEqual(Geo2TagService.getOrCreateFleetChannel(self.fleet), channel_oid)
+        self.assertEqual(len(self.standin.channels), 1)
+
+    def test_reconcile_deletes_orphans(self):
+        Geo2TagService.getOrCreateFleetChannel(self.fleet)
+        self.standin.handle("POST", "channel", None, {}, b"name=removed_fleet_999")
+        stats = Geo2TagService.reconcileFleetChannels()
+        self.assertEqual(stats["deleted_channels"], 1)
+        self.assertEqual([channel["name"] for channel in self.standin.channels.values()],
+                         ["fleet1_" + str(self.fleet.id)])
+
+    def test_errors_open_circuit(self):
+        Geo2TagService.getOrCreateFleetChannel(self.fleet)
+        self.standin.error_rate = 1.0
+        updates = [(self.fleet, driver, "59.9", "30.3") for driver in self.drivers]
+        self.assertEqual(Geo2TagService.publishDriverPositions(updates), 0)
+        self.assertEqual(Geo2TagService.publishDriverPositions(updates), 0)
+        self.assertTrue(Geo2TagService.client.is_open())
+        self.assertEqual(self.standin.count("POST", "point"), 2)
+        self.assertEqual(Geo2TagService.publishDriverPositions(updates), 0)
+        self.assertEqual(self.standin.count("POST", "point"), 2)
+
+
+class FleetMapTest(TestCase):
+
+    def setUp(self):
+        self.owner = createOwner("owner1")
+        self.fleet = Fleet.objects.create(name="fleet1", owner=self.owner)
+
+    def tearDown(self):
+        Geo2TagService.channel_dict.clear()
+
+    def test_map_page_does_not_call_geo2tag(self):
+        c = Client()
+        c.login(username="owner1", password="owner1")
+        with mock.patch.object(Geo2TagService, 'client') as client, \
+                mock.patch.object(Geo2TagService, 'createFleetChannelAsync') as create:
+            response = c.get('/fleet/' + str(self.fleet.id) + '/')
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(response.context["map_url"])
+            create.assert_called_once_with(self.fleet.id)
+
+            Geo2TagService.channel_dict[self.fleet.id] = "channel1"
+            response = c.get('/fleet/' + str(self.fleet.id) + '/')
+            self.assertIn('channel_ids=["channel1"]', response.context["map_url"])
+            self.assertFalse(client.method_calls)
+
+    def test_channel_scheduled_on_fleet_create(self):
+        c = Client()
+        c.login(username="owner1", password="owner1")
+        with mock.patch('logistics.api.createFleetChannelAsync') as create:
+            response = c.post('/api/fleet/add-fleet/', {"name": "fleet2", "description": ""})
+        self.assertEqual(response.status_code, 201)
+        create.assert_called_once_with(response.data["fleet_id"])
+
+    def test_fleet_delete_removes_channel(self):
+        c = Client()
+        c.login(username="owner1", password="owner1")
+        Geo2TagService.channel_dict[self.fleet.id] = "channel1"
+        with mock.patch.object(Geo2TagService, 'client') as client:
+            response = c.delete('/api/fleet/' + str(self.fleet.id) + '/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Fleet.objects.filter(id=self.fleet.id).exists())
+        self.assertTrue(client.delete.call_args[0][0].endswith("/channel/channel1"))
+        self.assertIsNone(Geo2TagService.channel_dict.get(self.fleet.id))
+
+
+class PositionHistoryTest(TestCase):
+
+    def setUp(self):
+        self.owner = createOwner("owner1")
+        self.fleet = Fleet.objects.create(name="fleet1", owner=self.owner)
+        self.driver = createDriver("driver1")
+        self.driver.fleets.add(self.fleet)
+        self.trip = Trip.objects.create(name="trip1", fleet=self.fleet, driver=self.driver, start_date=timezone.now())
+
+    def test_positions_and_track(self):
+        c = Client()
+        c.login(username="driver1", password="driver1")
+        with mock.patch('logistics.api.filterSpam', return_value=False):
+            for lat, lon in (("59.1", "30.1"), ("59.2", "30.2"), ("59.3", "30.3")):
+                response = c.post('/api/driver/update_pos/', {"lat": lat, "lon": lon})
+                self.assertEqual(response.status_code, 200)
+
+        with mock.patch('logistics.positions.publishDriverPositions', return_value=1):
+            with self.assertNumQueries(2):
+                position_queue.flush()
+        self.assertEqual(DriverPosition.objects.filter(trip=self.trip).count(), 3)
+
+        c.login(username="owner1", password="owner1")
+        response = c.get('/api/fleet/' + str(self.fleet.id) + '/positions/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]["driver_id"], self.driver.id)
+        self.assertEqual((response.data[0]["lat"], response.data[0]["lon"]), (59.3, 30.3))
+
+        response = c.get('/api/trip/' + str(self.trip.id) + '/track/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([point["lat"] for point in response.data], [59.1, 59.2, 59.3])
+
+    def test_flush_driver_history_only_own_points(self):
+        other = createDriver("driver2")
+        queue = PositionQueue(flush_interval=60, batch_size=100)
+        queue.put(self.fleet, self.driver, 59.1, 30.1, self.trip.id)
+        queue.put(self.fleet, other, 59.2, 30.2)
+        queue.put(self.fleet, self.driver, 59.3, 30.3, self.trip.id)
+
+        queue.flush_driver_history(self.driver.id)
+        self.assertEqual(DriverPosition.objects.filter(driver=self.driver).count(), 2)
+        self.assertEqual(DriverPosition.objects.filter(driver=other).count(), 0)
+        self.assertEqual(queue.metrics()["history_depth"], 1)
+        self.assertEqual(queue.metrics()["depth"], 2)
+
+    def test_flush_driver_history_waits_for_background_flush(self):
+        queue = PositionQueue(flush_interval=60, batch_size=100)
+        queue.put(self.fleet, self.driver, 59.1, 30.1, self.trip.id)
+        # фоновый сброс забрал точки, но ещё не записал их
+        queue._history_lock.acquire()
+        entries, history = queue._take()
+        done = threading.Event()
+        worker = threading.Thread(target=lambda: (queue.flush_driver_history(self.driver.id), done.set()))
+        worker.start()
+        self.assertFalse(done.wait(0.2))
+        queue._save_history(history)
+        queue._history_lock.release()
+        worker.join()
+        self.assertEqual(DriverPosition.objects.filter(trip=self.trip).count(), 1)
+
+
+class SpatialIndexTest(TestCase):
+
+    def test_nearest_matches_full_scan(self):
+        rnd = random.Random(1)
+        grid = FleetGrid(cell_size=0.01)
+        now = timezone.now()
+        positions = {}
+        for driver_id in range(3000):
+            lat, lon = 59.9 + rnd.uniform(-0.3, 0.3), 30.3 + rnd.uniform(-0.5, 0.5)
+            available = driver_id % 3 != 0
+            grid.update(driver_id, lat, lon, available, now)
+            if available:
+                positions[driver_id] = (lat, lon)
+        grid.remove(1)
+        positions.pop(1)
+
+        for lat, lon in ((59.9, 30.3), (59.61, 29.81), (61.0, 35.0)):
+            expected = sorted(positions, key=lambda d: haversine(lat, lon, *positions[d]))[:10]
+            self.assertEqual([item[0] for item in grid.nearest(lat, lon, 10)], expected)
+
+    def test_nearest_drivers_api(self):
+        owner = createOwner("owner1")
+        fleet = Fleet.objects.create(name="fleet1", owner=owner)
+        near, far, busy = createDriver("near"), createDriver("far"), createDriver("busy")
+        for driver, lat in ((near, 59.90), (far, 59.95), (busy, 59.9001)):
+            driver.fleets.add(fleet)
+            DriverStats.objects.filter(driver=driver).update(lat=lat, lon=30.3, position_date=timezone.now())
+        Trip.objects.create(name="t", fleet=fleet, driver=busy, start_date=timezone.now())
+
+        c = Client()
+        c.login(username="owner1", password="owner1")
+        index = DriverIndex(cell_size=0.01, refresh_interval=30, max_age=600)
+        with mock.patch('logistics.api.driver_index', index):
+            response = c.get('/api/fleet/' + str(fleet.id) + '/nearest_drivers/', {"lat": 59.9, "lon": 30.3, "k": 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item["driver_id"] for item in response.data], [near.id, far.id])
+
+        response = c.get('/api/fleet/' + str(fleet.id) + '/nearest_drivers/', {"lat": 100})
+        self.assertEqual(response.status_code, 400)
+
+
+class TripStatsTest(TestCase):
+
+    def test_compute_matches_per_point_loop(self):
+        rnd = random.Random(2)
+        trip_ids, lats, lons, seconds = [], [], [], []
+        for trip_id in (1, 2, 3):
+            lat, lon, t = 59.9, 30.3, 0.0
+            for i in range(50):
+                trip_ids.append(trip_id)
+                lats.append(lat)
+                lons.append(lon)
+                seconds.append(t)
+                lat, lon, t = lat + rnd.uniform(-0.001, 0.001), lon + rnd.uniform(-0.001, 0.001), t + rnd.choice((5, 10))
+        stats = computeTripStats(trip_ids, lats, lons, seconds)
+
+        self.assertEqual(sorted(stats), [1, 2, 3])
+        for trip_id in (1, 2, 3):
+            idx = [i for i, t in enumerate(trip_ids) if t == trip_id]
+            segments = [(haversine(lats[i], lons[i], lats[i + 1], lons[i + 1]), seconds[i + 1] - seconds[i])
+                        for i in idx[:-1]]
+            self.assertAlmostEqual(stats[trip_id]["distance"], sum(d for d, _ in segments), places=3)
+            self.assertAlmostEqual(stats[trip_id]["max_speed"], max(d / dt for d, dt in segments), places=6)
+            self.assertEqual(stats[trip_id]["points_count"], 50)
+            self.assertEqual(stats[trip_id]["track_duration"], seconds[idx[-1]] - seconds[idx[0]])
+
+    def test_idle_time(self):
+        stats = computeTripStats([7, 7, 7, 7], [59.9, 59.9, 59.9, 59.91], [30.3, 30.3, 30.3, 30.3], [0, 60, 120, 180])
+        self.assertEqual(stats[7]["idle_time"], 120)
+        self.assertAlmostEqual(stats[7]["distance"], 1112, delta=1)
+
+    def test_finish_trip_fills_stats(self):
+        owner = createOwner("owner1")
+        fleet = Fleet.objects.create(name="fleet1", owner=owner)
+        driver = createDriver("driver1")
+        driver.fleets.add(fleet)
+        trip = Trip.objects.create(name="trip1", fleet=fleet, driver=driver, start_date=timezone.now())
+
+        c = Client()
+        c.login(username="driver1", password="driver1")
+        with mock.patch('logistics.api.filterSpam', return_value=False):
+            for lat in ("59.90", "59.91", "59.92"):
+                c.post('/api/driver/update_pos/', {"lat": lat, "lon": "30.3"})
+        with mock.patch('logistics.api.deleteDriverPos'):
+            response = c.post('/api/driver/finish_trip/')
+        self.assertEqual(response.status_code, 200)
+
+        stats = TripStats.objects.get(trip=trip)
+        self.assertEqual(stats.points_count, 3)
+        self.assertAlmostEqual(stats.distance, 2224, delta=2)
+
+        c.login(username="owner1", password="owner1")
+        response = c.get('/api/fleet/' + str(fleet.id) + '/trips/finished/')
+        self.assertEqual(response.data[0]["stats"]["points_count"], 3)
+
+    def test_finish_trip_recomputes_later(self):
+        owner = createOwner("owner1")
+        fleet = Fleet.objects.create(name="fleet1", owner=owner)
+        driver = createDriver("driver1")
+        driver.fleets.add(fleet)
+        trip = Trip.objects.create(name="trip1", fleet=fleet, driver=driver, start_date=timezone.now())
+        DriverPosition.objects.create(driver=driver, trip=trip, lat=59.90, lon=30.3, timestamp=timezone.now())
+
+        c = Client()
+        c.login(username="driver1", password="driver1")
+        with mock.patch('logistics.api.deleteDriverPos'), mock.patch('django.db.transaction.on_commit') as on_commit:
+            self.assertEqual(c.post('/api/driver/finish_trip/').status_code, 200)
+        self.assertEqual(TripStats.objects.get(trip=trip).points_count, 1)
+        timers = [call[0][0].__self__ for call in on_commit.call_args_list
+                  if getattr(call[0][0], '__self__', None) is not None and
+                  isinstance(call[0][0].__self__, threading.Timer)]
+        self.assertEqual(len(timers), 1)
+        self.assertEqual(timers[0].interval, tripstats.RECOMPUTE_DELAY)
+
+        # другой воркер сбросил свои точки рейса уже после завершения
+        DriverPosition.objects.create(driver=driver, trip=trip, lat=59.91, lon=30.3, timestamp=timezone.now())
+        with mock.patch('logistics.tripstats.close_old_connections'):
+            timers[0].function(*timers[0].args)
+        self.assertEqual(TripStats.objects.get(trip=trip).points_count, 2)
+
+    def test_update_stats_durations_from_db(self):
+        owner = createOwner("owner1")
+        fleet = Fleet.objects.create(name="fleet1", owner=owner)
+        driver = createDriver("driver1")
+        start = timezone.now()
+        trips = [Trip.objects.create(name="trip" + str(i), fleet=fleet, start_date=start)
+                 for i in range(2)]
+        for i, trip in enumerate(trips):
+            DriverPosition.objects.bulk_create([
+                DriverPosition(driver=driver, trip=trip, lat=59.9 + 0.001 * k, lon=30.3,
+                               timestamp=start + timezone.timedelta(seconds=30 * k * (i + 1), milliseconds=250 * k))
+                for k in range(4)])
+
+        updateTripStats(trips)
+        for i, trip in enumerate(trips):
+            stats = TripStats.objects.get(trip=trip)
+            self.assertEqual(stats.points_count, 4)
+            self.assertAlmostEqual(stats.duration, 90 * (i + 1) + 0.75, places=2)
+
+
+class ListQueryCountTest(TestCase):
+
+    def setUp(self):
+        self.owner = createOwner("owner1")
+        self.driver = createDriver("driver1")
+        self.fleet = Fleet.objects.create(name="fleet0", owner=self.owner)
+        self.driver.fleets.add(self.fleet)
+        # отметки присутствия не сбрасываются посреди замера
+        patcher = mock.patch('logistics.middleware.presence', PresenceTracker(flush_interval=3600))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_rows(self, n):
+        for i in range(n):
+            fleet = Fleet.objects.create(name="fleet", owner=self.owner)
+            driver = createDriver("driver_" + str(Driver.objects.count()))
+            driver.fleets.add(self.fleet)
+            createDriver("free_" + str(Driver.objects.count()))
+            self.driver.fleets.add(fleet)
+            self.driver.pending_fleets.add(Fleet.objects.create(name="pending", owner=self.owner))
+            Trip.objects.create(name="t", fleet=fleet, driver=driver, start_date=timezone.now())
+
+    def count_queries(self, username, url):
+        c = Client()
+        c.login(username=username, password=username)
+        with CaptureQueriesContext(connection) as queries:
+            response = c.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.data
+
+    def test_constant_queries(self):
+        urls = (("owner1", '/api/fleet/'), ("driver1", '/api/fleet/'), ("driver1", '/api/driver/fleets/'),
+                ("driver1", '/api/driver/pending_fleets/'),
+                ("owner1", '/api/fleet/' + str(self.fleet.id) + '/drivers/'),
+                ("owner1", '/api/fleet/' + str(self.fleet.id) + '/pending_drivers/'))
+        self.add_rows(1)
+        for username, url in urls:
+            self.count_queries(username, url)
+        self.add_rows(1)
+        before = [self.count_queries(username, url)[0] for username, url in urls]
+        self.add_rows(5)
+        after = [self.count_queries(username, url)[0] for username, url in urls]
+        self.assertEqual(before, after)
+
+        _, drivers = self.count_queries("owner1", '/api/fleet/' + str(self.fleet.id) + '/drivers/')
+        fleet_ids = {driver["login"]: driver["current_trip_fleet_id"] for driver in drivers}
+        self.assertEqual(fleet_ids["driver1"], -1)
+        self.assertEqual(fleet_ids["driver_3"], Trip.objects.get(driver__user__username="driver_3").fleet_id)
+        _, fleets = self.count_queries("owner1", '/api/fleet/')
+        counts = {fleet["id"]: (fleet["cars_count"], fleet["trips_count"]) for fleet in fleets}
+        self.assertEqual(counts[self.fleet.id], (8, 0))
+
+
+# Бюджет SQL-запросов на каждый маршрут API. Данные досеиваются и замер повторяется:
+# число запросов не должно зависеть от числа автопарков, водителей и рейсов.
+class QueryBudgetTest(TestCase):
+    # (пользователь, метод, url, данные, бюджет); данные-строка - тело text/csv.
+    # Здесь должен быть каждый маршрут api/ из urls.py - это проверяет test_every_api_route_has_budget
+    ROUTES = (
+        ("anon", "post", "/api/signup/", {"login": "{new_user}", "email": "{new_user}@example.com", "password": "p",
+                                          "role": "1", "first_name": "f", "last_name": "l"}, 7),
+        ("anon", "post", "/api/auth/", {"login": "{new_user}", "password": "p"}, 9),
+        ("anon", "get", "/api/logout/", None, 4),
+        ("owner1", "get", "/api/fleet/", None, 7),
+        ("owner1", "post", "/api/fleet/add-fleet/", {"name": "added", "description": ""}, 11),
+        ("owner1", "get", "/api/fleet/{fleet}/", None, 7),
+        ("owner1", "get", "/api/fleet/{fleet}/drivers/", None, 6),
+        ("owner1", "get", "/api/fleet/{fleet}/pending_drivers/", None, 5),
+        ("owner1", "post", "/api/fleet/{fleet}/invite/", {"driver_id": "{free_driver}"}, 9),
+        ("owner1", "post", "/api/fleet/{fleet}/dismiss/", {"driver_id": "{member}"}, 11),
+        ("owner1", "get", "/api/fleet/{fleet}/trips/unaccepted/", None, 6),
+        ("owner1", "get", "/api/fleet/{fleet}/trips/finished/", None, 6),
+        ("owner1", "get", "/api/fleet/{fleet}/trips/finished/export.ndjson", None, 6),
+        ("owner1", "get", "/api/fleet/{fleet}/trips/finished/export.csv", None, 6),
+        ("owner1", "get", "/api/fleet/{fleet}/positions/", None, 6),
+        ("owner1", "get", "/api/fleet/{fleet}/events/", None, 4),
+        ("owner1", "get", "/api/fleet/{fleet}/nearest_drivers/", {"lat": "59.9", "lon": "30.3"}, 5),
+        ("owner1", "delete", "/api/fleet/{spare_fleet}/", None, 15),
+        ("owner1", "delete", "/api/fleet/{spare_fleet2}/delete/", None, 15),
+        ("owner1", "get", "/api/trip/{trip}/", None, 6),
+        ("owner1", "get", "/api/trip/{trip}/track/", None, 6),
+        ("owner1", "post", "/api/fleet/{fleet}/add_trip/", {"description": "d"}, 9),
+        ("owner1", "post", "/api/fleet/{fleet}/import_trips/", "description\nimported\n", 11),
+        ("driver1", "get", "/api/fleet/", None, 6),
+        ("driver1", "get", "/api/driver/fleets/", None, 5),
+        ("driver1", "get", "/api/driver/pending_fleets/", None, 5),
+        ("driver1", "post", "/api/driver/pending_fleets/accept/", {"fleet_id": "{pending_fleet}"}, 11),
+        ("driver1", "post", "/api/driver/pending_fleets/decline/", {"fleet_id": "{pending_fleet2}"}, 6),
+        ("driver1", "get", "/api/driver/available_trips/", None, 6),
+        ("driver1", "get", "/api/driver/available_trips/wait/", {"timeout": "0"}, 4),
+        ("driver1", "get", "/api/driver/fleet/{fleet}/available_trips/", None, 6),
+        ("driver1", "get", "/api/driver/trips/", None, 5),
+        ("driver1", "get", "/api/driver/fleet/{fleet}/trips/", None, 7),
+        ("driver1", "post", "/api/driver/accept_trip/", {"trip_id": "{open_trip}"}, 9),
+        ("driver1", "get", "/api/driver/current_trip/", None, 7),
+        ("driver1", "post", "/api/driver/update_pos/", {"lat": "59.9", "lon": "30.3"}, 6),
+        ("driver1", "post", "/api/driver/report_problem/", {"problem": 1}, 7),
+        ("driver1", "post", "/api/driver/finish_trip/", None, 17),
+        ("driver1", "get", "/api/trip/{trip}/", None, 6),
+        ("admin1", "get", "/api/reload/", None, 2),
+        ("admin1", "get", "/api/reload/status/", None, 2),
+        ("admin1", "get", "/api/position_queue/", None, 2),
+    )
+
+    def setUp(self):
+        self.owner = createOwner("owner1")
+        self.driver = createDriver("driver1")
+        self.fleet = Fleet.objects.create(name="fleet0", owner=self.owner)
+        self.driver.fleets.add(self.fleet, Fleet.objects.create(name="fleet1", owner=self.owner))
+        self.driver.pending_fleets.add(Fleet.objects.create(name="pending", owner=self.owner))
+        self.trip = Trip.objects.create(name="own", fleet=self.fleet, driver=self.driver, start_date=timezone.now(),
+                                        is_finished=True)
+        # отметки присутствия не сбрасываются посреди замера
+        patcher = mock.patch('logistics.middleware.presence', PresenceTracker(flush_interval=3600))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        User.objects.create_superuser("admin1", "admin1@example.com", "admin1")
+        self.rows = 0
+        self.clients = {"anon": Client()}
+        for username in ("owner1", "driver1", "admin1"):
+            self.clients[username] = Client()
+            self.clients[username].login(username=username, password=username)
+
+    def seed(self, n):
+        self.rows += n
+        for i in range(n):
+            fleet = Fleet.objects.create(name="fleet", owner=self.owner)
+            driver = createDriver("driver_" + str(Driver.objects.count()))
+            driver.fleets.add(self.fleet, fleet)
+            createDriver("free_" + str(Driver.objects.count()))
+            Trip.objects.create(name="t", fleet=self.fleet, driver=driver, start_date=timezone.now())
+            Trip.objects.create(name="t", fleet=self.fleet, start_date=timezone.now())
+            Trip.objects.create(name="t", fleet=self.fleet, driver=self.driver, start_date=timezone.now(),
+                                end_date=timezone.now(), is_finished=True)
+            DriverPosition.objects.create(driver=self.driver, trip=self.trip, lat=59.9, lon=30.3,
+                                          timestamp=timezone.now())
+            DriverStats.objects.filter(driver=driver).update(lat=59.9, lon=30.3, position_date=timezone.now())
+
+    # удаляемый автопарк с рейсами, их точками и статистикой - по строке на каждую засеянную
+    def spare_fleet(self):
+        fleet = Fleet.objects.create(name="spare", owner=self.owner)
+        for i in range(self.rows):
+            trip = Trip.objects.create(name="t", fleet=fleet, start_date=timezone.now(), end_date=timezone.now(),
+                                       is_finished=True)
+            DriverPosition.objects.create(driver=self.driver, trip=trip, lat=59.9, lon=30.3, timestamp=timezone.now())
+            TripStats.objects.create(trip=trip, points_count=1)
+        return fleet.id
+
+    def measure(self):
+        counts = []
+        open_trip = Trip.objects.filter(fleet=self.fleet, driver=None, is_finished=False).first()
+        # маршруты, которые что-то удаляют или меняют членство, получают свежие объекты на каждый замер
+        number = User.objects.count()
+        member = createDriver("member_" + str(number))
+        member.fleets.add(self.fleet)
+        pending_fleet, pending_fleet2 = [Fleet.objects.create(name="pending", owner=self.owner) for i in range(2)]
+        self.driver.pending_fleets.add(pending_fleet, pending_fleet2)
+        values = {"fleet": self.fleet.id, "trip": self.trip.id, "open_trip": open_trip.id, "member": member.id,
+                  "free_driver": createDriver("invitee_" + str(number)).id, "new_user": "signup_" + str(number),
+                  "spare_fleet": self.spare_fleet(), "spare_fleet2": self.spare_fleet(),
+                  "pending_fleet": pending_fleet.id, "pending_fleet2": pending_fleet2.id}
+        for username, method, url, data, budget in self.ROUTES:
+            client = self.clients[username]
+            url = url.format(**values)
+            with mock.patch('logistics.api.filterSpam', return_value=False), \
+                    mock.patch('logistics.api.deleteDriverPos'), \
+                    mock.patch('logistics.api.deleteFleetChannel'), \
+                    mock.patch('logistics.api.deleteDriverPositionsAsync'), \
+                    mock.patch('logistics.api.clearAllFleetChannels'), \
+                    CaptureQueriesContext(connection) as queries:
+                if isinstance(data, str):
+                    response = getattr(client, method)(url, data, content_type="text/csv")
+                else:
+                    data = {key: str(value).format(**values) for key, value in (data or {}).items()}
+                    response = getattr(client, method)(url, data)
+                if response.streaming and response['Content-Type'] != 'text/event-stream':
+                    b"".join(response.streaming_content)
+            self.assertLess(response.status_code, 300, url + " " + str(getattr(response, 'data', '')))
+            counts.append(len(queries))
+        return counts
+
+    def test_every_api_route_has_budget(self):
+        paths = [route[2].format(fleet=1, trip=1, spare_fleet=1, spare_fleet2=1).lstrip('/') for route in self.ROUTES]
+        for pattern in urlpatterns:
+            if hasattr(pattern, 'url_patterns') or not pattern.regex.pattern.startswith('^api/'):
+                continue
+            self.assertTrue(any(pattern.regex.search(path) for path in paths),
+                            pattern.regex.pattern + " has no entry in QueryBudgetTest.ROUTES")
+
+    def test_query_budgets(self):
+        self.seed(2)
+        self.measure()
+        small = self.measure()
+        self.seed(10)
+        self.measure()
+        large = self.measure()
+        for route, before, after in zip(self.ROUTES, small, large):
+            self.assertEqual(before, after, route[2] + " makes a query per row")
+            self.assertLessEqual(after, route[4], route[2] + " is over its query budget")
+
+
+class PresenceTest(TestCase):
+
+    def test_last_seen_is_coalesced(self):
+        createOwner("owner1")
+        driver = createDriver("driver1")
+        tracker = PresenceTracker(flush_interval=3600)
+        c = Client()
+        c.login(username="driver1", password="driver1")
+        with mock.patch('logistics.middleware.presence', tracker), \
+                mock.patch('logistics.serializers.presence', tracker):
+            for i in range(3):
+                c.get('/api/driver/fleets/')
+            self.assertIsNone(Driver.objects.get(id=driver.id).last_seen)
+
+            fleet = Fleet.objects.create(name="fleet1", owner=Owner.objects.get())
+            driver.fleets.add(fleet)
+            c.login(username="owner1", password="owner1")
+            response = c.get('/api/fleet/' + str(fleet.id) + '/drivers/')
+            self.assertTrue(response.data[0]["is_online"])
+
+            with self.assertNumQueries(1):
+                self.assertEqual(tracker.flush(), 2)
+        self.assertEqual(Driver.objects.get(id=driver.id).last_seen, tracker.last_seen(driver.user_id))
+
+
+class RolesCacheTest(TestCase):
+
+    def test_roles_are_memoized_per_request(self):
+        createOwner("owner1")
+        user = User.objects.get(username="owner1")
+        with self.assertNumQueries(1):
+            self.assertTrue(is_owner(user))
+            self.assertFalse(is_driver(user))
+
+        # изменения групп видны следующему запросу (новому объекту user) в любом воркере
+        Group.objects.get_or_create(name='DRIVER')[0].user_set.add(user)
+        self.assertTrue(is_driver(User.objects.get(username="owner1")))
+        Group.objects.get(name='OWNER').user_set.remove(user)
+        self.assertFalse(is_owner(User.objects.get(username="owner1")))
+        user.groups.clear()
+        self.assertFalse(is_driver(user))
+
+    def test_profile_id_dropped_with_profile(self):
+        driver = createDriver("driver1")
+        user = User.objects.get(username="driver1")
+        self.assertEqual(profileId(user, 'driver'), driver.id)
+        driver.delete()
+        with self.assertRaises(Driver.DoesNotExist):
+            profileId(User.objects.get(username="driver1"), 'driver')
+
+
+class KeysetPaginationTest(TestCase):
+
+    def test_finished_trips_pages(self):
+        owner = createOwner("owner1")
+        fleet = Fleet.objects.create(name="fleet1", owner=owner)
+        ids = [Trip.objects.create(name="t" + str(i), fleet=fleet, start_date=timezone.now(), is_finished=True).id
+               for i in range(5)]
+        c = Client()
+        c.login(username="owner1", password="owner1")
+        url = '/api/fleet/' + str(fleet.id) + '/trips/finished/'
+
+        response = c.get(url)
+        self.assertEqual(len(response.data), 5)
+
+        seen = []
+        response = c.get(url, {"limit": 2})
+        while True:
+            self.assertLessEqual(len(response.data["results"]), 2)
+            seen.extend(trip["id"] for trip in response.data["results"])
+            if response.data["next"] is None:
+                break
+            response = c.get(response.data["next"])
+        self.assertEqual(seen, sorted(ids, reverse=True))
+
+        response = c.get(url, {"limit": 1000})
+        self.assertEqual(len(response.data["results"]), 5)
+
+        # без limit и cursor - не больше PAGINATION_MAX_LIMIT последних записей
+        with mock.patch.object(KeysetPagination, 'max_page_size', 3):
+            response = c.get(url)
+        self.assertEqual([trip["id"] for trip in response.data], sorted(ids, reverse=True)[:3])
+
+
+class DriverTripListsTest(TestCase):
+
+    def test_lists_do_not_grow_with_fleets(self):
+        owner = createOwner("owner1")
+        driver = createDriver("driver1")
+        other = Fleet.objects.create(name="other", owner=owner)
+        Trip.objects.create(name="other", fleet=other, start_date=timezone.now())
+        c = Client()
+        c.login(username="driver1", password="driver1")
+        c.get('/api/driver/available_trips/')
+
+        counts = []
+        for n in (1, 5):
+            for i in range(n):
+                fleet = Fleet.objects.create(name="fleet", owner=owner)
+                driver.fleets.add(fleet)
+                Trip.objects.create(name="open", fleet=fleet, start_date=timezone.now())
+                Trip.objects.create(name="done", fleet=fleet, driver=driver, start_date=timezone.now(), is_finished=True)
+            with CaptureQueriesContext(connection) as queries:
+                available = c.get('/api/driver/available_trips/').data
+                trips = c.get('/api/driver/trips/').data
+            counts.append(len(queries))
+            self.assertEqual({trip["name"] for trip in available}, {"open"})
+            self.assertEqual(len(available), driver.fleets.count())
+            self.assertEqual(len(trips), driver.fleets.count())
+            self.assertEqual([trip["id"] for trip in trips], sorted((trip["id"] for trip in trips), reverse=True))
+        self.assertEqual(counts[0], counts[1])
+
+
+class TripConstraintsTest(TestCase):
+
+    def test_one_unfinished_trip_per_driver(self):
+        owner = createOwner("owner1")
+        fleet = Fleet.objects.create(name="fleet1", owner=owner)
+        driver = createDriver("driver1")
+        Trip.objects.create(name="done", fleet=fleet, driver=driver, start_date=timezone.now(), is_finished=True)
+        Trip.objects.create(name="free1", fleet=fleet, start_date=timezone.now())
+        Trip.objects.create(name="free2", fleet=fleet, start_date=timezone.now())
+        Trip.objects.create(name="current", fleet=fleet, driver=driver, start_date=timezone.now())
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Trip.objects.create(name="second", fleet=fleet, driver=driver, start_date=timezone.now())
+
+
+class AcceptTripTest(TestCase):
+
+    def setUp(self):
+        self.owner = createOwner("owner1")
+        self.fleet = Fleet.objects.create(name="fleet1", owner=self.owner)
+        self.trip = Trip.objects.create(name="trip1", fleet=self.fleet, start_date=timezone.now())
+
+    def accept(self, login, trip):
+        c = Client()
+        c.login(username=login, password=login)
+        return c.post('/api/driver/accept_trip/', {"trip_id": trip.id})
+
+    def test_single_update_and_reasons(self):
+        first, second, outsider = createDriver("first"), createDriver("second"), createDriver("outsider")
+        first.fleets.add(self.fleet)
+        second.fleets.add(self.fleet)
+
+        response = self.accept("outsider", self.trip)
+        self.assertEqual(response.data["errors"], "You are not a member in that fleet")
+
+        c = Client()
+        c.login(username="first", password="first")
+        with CaptureQueriesContext(connection) as queries:
+            response = c.post('/api/driver/accept_trip/', {"trip_id": self.trip.id})
+        self.assertEqual(response.status_code, 200)
+        updates = [query["sql"] for query in queries if query["sql"].startswith('UPDATE "logistics_trip"')]
+        self.assertEqual(len(updates), 1)
+        self.assertFalse(any(query["sql"].startswith("SELECT") and "logistics_trip" in query["sql"]
+                             for query in queries))
+        self.assertEqual(Trip.objects.get(id=self.trip.id).driver_id, first.id)
+
+        self.assertEqual(self.accept("second", self.trip).data["errors"], "This trip has already been accepted")
+        self.assertEqual(self.accept("first", self.trip).data["errors"], "It's your current trip")
+        other = Trip.objects.create(name="trip2", fleet=self.fleet, start_date=timezone.now())
+        self.assertEqual(self.accept("first", other).data["errors"], "You have already accepted current trip")
+        other.problem = 2
+        other.save()
+        self.assertEqual(self.accept("second", other).data["errors"], "The trip has a problem")
+
+
+class BulkMembershipTest(TestCase):
+
+    def setUp(self):
+        self.owner = createOwner("owner1")
+        self.fleet = Fleet.objects.create(name="fleet1", owner=self.owner)
+        self.drivers = [Driver.objects.create(user=User.objects.create(username="d" + str(i)),
+                                              first_name="d", last_name=str(i)) for i in range(200)]
+        self.owner_client = Client()
+        self.owner_client.login(username="owner1", password="owner1")
+
+    def ids(self, drivers):
+        return ",".join(str(driver.id) for driver in drivers)
+
+    def test_parse_ids_keeps_first_occurrence(self):
+        self.assertEqual(parseIds("3,1,3,,2,1"), [3, 1, 2])
+        self.assertEqual(parseIds(",".join(str(i % 500) for i in range(20000))), list(range(500)))
+
+    def test_invite_and_dismiss_many(self):
+        member, pending = self.drivers[0], self.drivers[1]
+        member.fleets.add(self.fleet)
+        pending.pending_fleets.add(self.fleet)
+        url = '/api/fleet/' + str(self.fleet.id)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.owner_client.post(url + '/invite/', {"driver_id": self.ids(self.drivers)})
+        self.assertLess(len(queries), 12)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data["errors"], {"Drivers is already in fleet": [str(member.id)],
+                                                   "Drivers is already in pending fleet": [str(pending.id)]})
+        self.assertEqual(Driver.objects.filter(pending_fleets=self.fleet).count(), 199)
+
+        response = self.owner_client.post(url + '/invite/', {"driver_id": "999999"})
+        self.assertEqual(response.status_code, 409)
+
+        response = self.owner_client.post(url + '/dismiss/', {"driver_id": str(member.id) + ",999999,999998,999999"})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data, {"status": "error", "errors": ["Driver matching query does not exist."],
+                                         "driver_id": [999998, 999999]})
+        self.assertTrue(member.fleets.filter(id=self.fleet.id).exists())
+
+        for driver in self.drivers[2:50]:
+            driver.fleets.add(self.fleet)
+        with mock.patch('logistics.api.deleteDriverPositionsAsync') as delete_async, \
+                CaptureQueriesContext(connection) as queries:
+            response = self.owner_client.post(url + '/dismiss/', {"driver_id": self.ids(self.drivers[:50])})
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(len(queries), 16)
+        self.assertEqual(sorted(delete_async.call_args[0][1]), [driver.id for driver in self.drivers[:50] if driver != pending])
+        self.assertEqual(Driver.objects.filter(fleets=self.fleet).count(), 0)
+
+    def test_accept_and_decline_pending(self):
+        driver = createDriver("driver1")
+        fleets = [Fleet.objects.create(name="f" + str(i), owner=self.owner) for i in range(30)]
+        driver.pending_fleets.add(*fleets)
+        c = Client()
+        c.login(username="driver1", password="driver1")
+
+        response = c.post('/api/driver/pending_fleets/accept/', {"fleet_id": self.ids(fleets[:20])})
+        self.assertEqual(response.status_code, 200)
+        response = c.post('/api/driver/pending_fleets/decline/', {"fleet_id": self.ids(fleets[20:25])})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(driver.fleets.all()), set(fleets[:20]))
+        self.assertEqual(set(driver.pending_fleets.all()), set(fleets[25:]))
+
+        response = c.post('/api/driver/pending_fleets/accept/', {"fleet_id": "999999"})
+        self.assertEqual(response.status_code, 409)
+
+
+class ImportTripsTest(TestCase):
+
+    def setUp(self):
+        self.owner = createOwner("owner1")
+        self.fleet = Fleet.objects.create(name="fleet1", owner=self.owner)
+        self.url = '/api/fleet/' + str(self.fleet.id) + '/import_trips/'
+        self.client.login(username="owner1", password="owner1")
+
+    def test_json_import(self):
+        rows = [{"description": "trip " + str(i), "passenger_phone": "+7000" + str(i)} for i in range(1000)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, json.dumps(rows), content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["created"], 1000)
+        # bulk_create делит вставку на пачки по лимиту переменных SQLite
+        self.assertLess(len(queries), 30)
+        trips = Trip.objects.filter(fleet=self.fleet)
+        self.assertEqual(trips.count(), 1000)
+        self.assertEqual({trip.name for trip in trips}, {"fleet1#" + str(trip.id) for trip in trips})
+        self.assertEqual(sorted(response.data["ids"]), sorted(trip.id for trip in trips))
+        # имена пишутся при вставке, второго прохода по рейсам нет
+        self.assertFalse([q for q in queries.captured_queries if q["sql"].startswith('UPDATE "logistics_trip"')])
+
+    def test_import_retries_taken_ids(self):
+        taken = Trip.objects.create(name="taken", fleet=self.fleet, start_date=timezone.now())
+        with mock.patch('logistics.tripimport._reserveTripIds', side_effect=[[taken.id], [taken.id + 1]]):
+            response = self.client.post(self.url, json.dumps([{"description": "new"}]), content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["ids"], [taken.id + 1])
+        self.assertEqual(Trip.objects.get(id=taken.id + 1).name, "fleet1#" + str(taken.id + 1))
+        self.assertEqual(Trip.objects.get(id=taken.id).name, "taken")
+
+    def test_csv_import_and_row_errors(self):
+        body = "description,passenger_name,start_position\nfirst,Ivan,A\nsecond,Petr,B\n"
+        response = self.client.post(self.url, body, content_type="text/csv")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(set(Trip.objects.values_list('passenger_name', flat=True)), {"Ivan", "Petr"})
+
+        rows = [{"description": "ok"}, {"passenger_name": "x" * 100}, "bad"]
+        response = self.client.post(self.url, json.dumps(rows), content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error["row"] for error in response.data["errors"]], [1, 2])
+        self.assertIn("passenger_name", response.data["errors"][0]["errors"])
+        self.assertEqual(Trip.objects.count(), 2)
+
+
+class FleetAccessTest(TestCase):
+
+    def test_checks_do_not_load_fleets(self):
+        owner, stranger = createOwner("owner1"), createOwner("owner2")
+        driver = createDriver("driver1")
+        fleets = [Fleet.objects.create(name="f" + str(i), owner=owner) for i in range(50)]
+        driver.fleets.add(*fleets[:40])
+        foreign = Fleet.objects.create(name="foreign", owner=stranger)
+
+        user = User.objects.get(username="owner1")
+        with self.assertNumQueries(2):
+            self.assertTrue(owns_fleet(user, fleets[10].id))
+            self.assertFalse(owns_fleet(user, foreign.id))
+            self.assertTrue(owns_fleet(user, str(fleets[10].id)))
+        self.assertFalse(owns_fleet(user, "abc"))
+
+        user = User.objects.get(username="driver1")
+        with self.assertNumQueries(2):
+            self.assertTrue(in_fleet(user, fleets[0].id))
+            self.assertFalse(in_fleet(user, fleets[45].id))
+
+        c = Client()
+        c.login(username="owner1", password="owner1")
+        response = c.get('/api/fleet/' + str(foreign.id) + '/drivers/')
+        self.assertEqual(response.status_code, 409)
+        response = c.get('/api/fleet/' + str(fleets[0].id) + '/drivers/')
+        self.assertEqual([item["id"] for item in response.data], [driver.id])
+
+
+class VersionedResponseTest(TestCase):
+
+    def setUp(self):
+        self.owner = createOwner("owner1")
+        self.fleet = Fleet.objects.create(name="fleet1", owner=self.owner)
+        self.driver = createDriver("driver1")
+        self.driver.fleets.add(self.fleet)
+        self.trip = Trip.objects.create(name="trip1", fleet=self.fleet, start_date=timezone.now())
+        self.owner_client, self.driver_client = Client(), Client()
+        self.owner_client.login(username="owner1", password="owner1")
+        self.driver_client.login(username="driver1", password="driver1")
+
+    def test_etag_and_not_modified(self):
+        url = '/api/driver/available_trips/'
+        response = self.driver_client.get(url)
+        etag = response['ETag']
+        self.assertEqual([trip["id"] for trip in response.data], [self.trip.id])
+
+        # сессия, пользователь, роли и версии (членства водителя и списка) - и больше ничего
+        with self.assertNumQueries(5):
+            response = self.driver_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.assertEqual(self.driver_client.post('/api/driver/accept_trip/', {"trip_id": self.trip.id}).status_code, 200)
+        response = self.driver_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [])
+
+    def test_versions_shared_between_workers(self):
+        url = '/api/fleet/' + str(self.fleet.id) + '/trips/unaccepted/'
+        etag = self.owner_client.get(url)['ETag']
+        # другой воркер: своего локального кэша нет, версии - из общей таблицы
+        cache.clear()
+        self.assertEqual(self.owner_client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Trip.objects.filter(id=self.trip.id).update(description="changed")
+        bumpFleets([self.fleet.id])
+        cache.clear()
+        response = self.owner_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0]["description"], "changed")
+
+    def test_membership_bumped_after_commit(self):
+        url = '/api/fleet/' + str(self.fleet.id) + '/drivers/'
+        etag = self.owner_client.get(url)['ETag']
+        with mock.patch('django.db.transaction.on_commit') as on_commit, \
+                mock.patch('logistics.api.deleteDriverPositionsAsync'):
+            response = self.owner_client.post('/api/fleet/' + str(self.fleet.id) + '/dismiss/',
+                                              {"driver_id": str(self.driver.id)})
+        self.assertEqual(response.status_code, 200)
+        # до коммита версия прежняя
+        self.assertEqual(self.owner_client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        for call in on_commit.call_args_list:
+            call[0][0]()
+        response = self.owner_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [])
+
+    def test_bulk_changes_change_etag(self):
+        fleets_url = '/api/fleet/'
+        unaccepted_url = '/api/fleet/' + str(self.fleet.id) + '/trips/unaccepted/'
+        drivers_url = '/api/fleet/' + str(self.fleet.id) + '/drivers/'
+        etags = {url: self.owner_client.get(url)['ETag'] for url in (fleets_url, unaccepted_url, drivers_url)}
+
+        response = self.owner_client.post('/api/fleet/' + str(self.fleet.id) + '/import_trips/',
+                                          json.dumps([{"description": "a"}, {"description": "b"}]),
+                                          content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        response = self.owner_client.get(unaccepted_url, HTTP_IF_NONE_MATCH=etags[unaccepted_url])
+        self.assertEqual(len(response.data), 3)
+        response = self.owner_client.get(fleets_url, HTTP_IF_NONE_MATCH=etags[fleets_url])
+        self.assertEqual(response.data[0]["trips_count"], 3)
+
+        with mock.patch('logistics.api.deleteDriverPositionsAsync'):
+            self.owner_client.post('/api/fleet/' + str(self.fleet.id) + '/dismiss/', {"driver_id": self.driver.id})
+        response = self.owner_client.get(drivers_url, HTTP_IF_NONE_MATCH=etags[drivers_url])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [])
+
+
+    def test_fleet_delete_bumps_once(self):
+        def delete_fleet(trips):
+            fleet = Fleet.objects.create(name="spare", owner=self.owner)
+            Trip.objects.bulk_create([Trip(name="t" + str(i), fleet=fleet, start_date=timezone.now())
+                                      for i in range(trips)])
+            with mock.patch.object(Geo2TagService, 'client'), CaptureQueriesContext(connection) as queries:
+                response = self.owner_client.delete('/api/fleet/' + str(fleet.id) + '/')
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        # рейсы удаляются каскадом пачками, версия автопарка повышается один раз, а не на каждый рейс
+        self.assertLess(delete_fleet(50), 20)
+        self.assertLess(delete_fleet(200), 20)
+
+        # после удаления автопарка удаление рейса снова повышает версию
+        version, = getVersions([('fleet', self.fleet.id)])
+        self.trip.delete()
+        self.assertGreater(getVersions([('fleet', self.fleet.id)])[0], version)
+
+class FleetEventsTest(TestCase):
+
+    def setUp(self):
+        self.owner = createOwner("owner1")
+        self.fleet = Fleet.objects.create(name="fleet1", owner=self.owner)
+        self.driver = createDriver("driver1")
+        self.driver.fleets.add(self.fleet)
+        self.owner_client, self.driver_client = Client(), Client()
+        self.owner_client.login(username="owner1", password="owner1")
+        self.driver_client.login(username="driver1", password="driver1")
+
+    def test_bounded_buffer_and_replay(self):
+        broker = EventBroker(buffer_size=3, history_size=2)
+        slow, other = broker.subscribe(1), broker.subscribe(2)
+        ids = [broker.publish(1, "position", {"n": n}) for n in range(5)]
+        events = slow.get(0)
+        self.assertEqual([event[1] for event in events], ["reset", "position", "position", "position"])
+        self.assertEqual(events[0][2], {"dropped": 2})
+        self.assertEqual([event[2]["n"] for event in events[1:]], [2, 3, 4])
+        self.assertEqual(other.get(0), [])
+
+        # переподключение: недостающие события из истории, а если их уже нет - reset
+        self.assertEqual([event[0] for event in broker.subscribe(1, ids[3]).get(0)], [ids[4]])
+        self.assertEqual([event[1] for event in broker.subscribe(1, ids[1]).get(0)], ["reset", "position", "position"])
+
+        slow.close()
+        other.close()
+        self.assertEqual(broker.subscribers_count(1), 2)
+        self.assertEqual(broker.subscribers_count(2), 0)
+        self.assertEqual(formatEvent((7, "trip", {"a": 1})), 'id: 7\nevent: trip\ndata: {"a": 1}\n\n')
+
+    def test_stream(self):
+        url = '/api/fleet/' + str(self.fleet.id) + '/events/'
+        other = createOwner("owner2")
+        other_client = Client()
+        other_client.login(username="owner2", password="owner2")
+        self.assertEqual(other_client.get(url).status_code, 404)
+
+        with self.settings(FLEET_EVENTS_KEEPALIVE=0.01, FLEET_EVENTS_MAX_DURATION=1):
+            response = self.owner_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = iter(response.streaming_content)
+        self.assertEqual(next(stream), b"retry: 3000\n\n")
+        self.assertEqual(fleet_events.subscribers_count(self.fleet.id), 1)
+
+        trip = Trip.objects.create(name="trip1", fleet=self.fleet, start_date=timezone.now())
+        self.assertEqual(self.driver_client.post('/api/driver/accept_trip/', {"trip_id": trip.id}).status_code, 200)
+        with mock.patch('logistics.api.position_queue'):
+            self.assertEqual(self.driver_client.post('/api/driver/update_pos/', {"lat": 60.0, "lon": 30.0}).status_code, 200)
+
+        chunks = b""
+        while b"event: position" not in chunks:
+            chunks += next(stream)
+        self.assertIn(('data: {"state": "accepted", "trip_ids": [' + str(trip.id) + '], "driver_id": '
+                       + str(self.driver.id) + ', "fleet_id": ' + str(self.fleet.id) + '}').encode(), chunks)
+        self.assertIn(b'"lat": 60.0, "lon": 30.0', chunks)
+
+        response.close()
+        self.assertEqual(fleet_events.subscribers_count(self.fleet.id), 0)
+
+
+class DriverWaitTripsTest(TestCase):
+
+    def setUp(self):
+        self.owner = createOwner("owner1")
+        self.fleet = Fleet.objects.create(name="fleet1", owner=self.owner)
+        self.first, self.second = createDriver("first"), createDriver("second")
+        self.first.fleets.add(self.fleet)
+        self.second.fleets.add(self.fleet)
+        self.owner_client, self.first_client, self.second_client = Client(), Client(), Client()
+        self.owner_client.login(username="owner1", password="owner1")
+        self.first_client.login(username="first", password="first")
+        self.second_client.login(username="second", password="second")
+        trips = AvailableTrips(refresh_interval=3600)
+        patchers = [mock.patch('logistics.events.available_trips', trips), mock.patch('logistics.api.available_trips', trips)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def wait(self, client, last_event_id=None, timeout=0.05):
+        params = {"timeout": timeout}
+        if last_event_id is not None:
+            params["last_event_id"] = last_event_id
+        response = client.get('/api/driver/available_trips/wait/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_notices_from_memory(self):
+        data = self.wait(self.first_client)
+        self.assertEqual(data["notices"], [])
+        self.assertEqual(data["available"], {self.fleet.id: []})
+
+        response = self.owner_client.post('/api/fleet/' + str(self.fleet.id) + '/add_trip/', {"description": "a"})
+        self.assertEqual(response.status_code, 201)
+        trip_id = Trip.objects.get(fleet=self.fleet).id
+
+        # уведомление и свободные рейсы без обращения к таблице рейсов
+        with CaptureQueriesContext(connection) as queries:
+            added = self.wait(self.first_client, data["last_event_id"])
+        self.assertFalse(any("logistics_trip" in query["sql"] for query in queries))
+        self.assertEqual([(notice["state"], notice["trip_ids"]) for notice in added["notices"]], [("added", [trip_id])])
+        self.assertEqual(added["available"], {self.fleet.id: [trip_id]})
+
+        self.assertEqual(self.second_client.post('/api/driver/accept_trip/', {"trip_id": trip_id}).status_code, 200)
+        accepted = self.wait(self.first_client, added["last_event_id"])
+        self.assertEqual([notice["state"] for notice in accepted["notices"]], ["accepted"])
+        self.assertEqual(accepted["available"], {self.fleet.id: []})
+        # водитель, принявший рейс, о своём принятии не уведомляется
+        self.assertEqual(self.wait(self.second_client, added["last_event_id"])["notices"], [])
+
+        idle = self.wait(self.first_client, accepted["last_event_id"])
+        self.assertEqual((idle["notices"], idle["last_event_id"]), ([], accepted["last_event_id"]))
+
+    def test_reset_moves_last_event_id(self):
+        # id из другого воркера или до перезапуска - меньше начала истории этого процесса
+        stale = fleet_events._started_id - 1000
+        data = self.wait(self.first_client, stale)
+        self.assertEqual(data["notices"][0], {"state": "reset"})
+        self.assertEqual(data["last_event_id"], fleet_events.last_id())
+        # следующий опрос уже ждёт, а не получает сброс снова
+        self.assertEqual(self.wait(self.first_client, data["last_event_id"])["notices"], [])
+
+    def test_driver_without_fleets_waits(self):
+        createDriver("lonely")
+        client = Client()
+        client.login(username="lonely", password="lonely")
+        last_event_id = self.wait(client)["last_event_id"]
+        started = time.time()
+        data = self.wait(client, last_event_id, timeout=0.3)
+        self.assertGreaterEqual(time.time() - started, 0.3)
+        self.assertEqual((data["notices"], data["available"]), ([], {}))
+
+    def test_busy_asks_to_retry_later(self):
+        last_event_id = self.wait(self.first_client)["last_event_id"]
+        with mock.patch.object(fleet_events, 'subscribers_count', return_value=10 ** 6):
+            response = self.first_client.get('/api/driver/available_trips/wait/', {"last_event_id": last_event_id})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], "5")
+        self.assertEqual(response.data["retry"], 5)
+
+    def test_wakes_up_on_publish(self):
+        last_event_id = fleet_events.last_id()
+        timer = threading.Timer(0.05, publishTrips, (self.fleet.id, "added", [12345]))
+        timer.start()
+        started = time.time()
+        last_event_id, notices = waitTripNotices([self.fleet.id], self.first.id, last_event_id, 5)
+        timer.join()
+        self.assertLess(time.time() - started, 2)
+        self.assertEqual([data["trip_ids"] for event_id, event_type, data in notices], [[12345]])
+        self.assertEqual(last_event_id, notices[0][0])
+
+
+class TripExportTest(TestCase):
+
+    def setUp(self):
+        self.owner = createOwner("owner1")
+        self.fleet = Fleet.objects.create(name="fleet1", owner=self.owner)
+        self.url = '/api/fleet/' + str(self.fleet.id) + '/trips/finished/export.'
+        self.client.login(username="owner1", password="owner1")
+        start = timezone.now() - timezone.timedelta(days=30)
+        Trip.objects.bulk_create([Trip(name="trip" + str(i), fleet=self.fleet, start_date=start, is_finished=True,
+                                       end_date=start + timezone.timedelta(days=i)) for i in range(25)] +
+                                 [Trip(name="open", fleet=self.fleet, start_date=start)])
+        self.trips = list(Trip.objects.filter(is_finished=True).order_by('id'))
+        TripStats.objects.create(trip=self.trips[0], distance=1500.0, points_count=3)
+
+    def test_ndjson_in_chunks(self):
+        with mock.patch('logistics.tripexport.EXPORT_CHUNK', 10):
+            response = self.client.get(self.url + 'ndjson')
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            with CaptureQueriesContext(connection) as queries:
+                chunks = list(response.streaming_content)
+        # пачки по 10 строк и один пустой запрос в конце
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(len(queries), 4)
+        rows = [json.loads(line) for line in b"".join(chunks).decode().splitlines()]
+        self.assertEqual([row["id"] for row in rows], [trip.id for trip in self.trips])
+        self.assertEqual(rows[0]["stats"]["distance"], 1500.0)
+        self.assertIsNone(rows[1]["stats"])
+
+    def test_csv_date_range(self):
+        params = {"date_from": self.trips[5].end_date.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                  "date_to": self.trips[10].end_date.strftime('%Y-%m-%d %H:%M:%S.%f')}
+        response = self.client.get(self.url + 'csv', params)
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.DictReader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual([row["name"] for row in rows], ["trip" + str(i) for i in range(5, 10)])
+        self.assertEqual(self.client.get(self.url + 'csv', {"date_from": "yesterday"}).status_code, 400)
+
+        other = createOwner("owner2")
+        self.client.login(username="owner2", password="owner2")
+        self.assertEqual(self.client.get(self.url + 'csv').status_code, 404)
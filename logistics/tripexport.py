@@ -0,0 +1,63 @@
+import csv
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from logistics.models import Trip
+
+EXPORT_CHUNK = getattr(settings, 'TRIP_EXPORT_CHUNK', 1000)
+
+# поля как в TripSerializer; статистика в NDJSON вложена в stats, в CSV - отдельные колонки
+TRIP_FIELDS = ['id', 'name', 'description', 'passenger_phone', 'passenger_name', 'start_position', 'end_position',
+               'start_date', 'end_date', 'is_finished', 'problem', 'problem_description', 'driver_id']
+STATS_FIELDS = ['distance', 'duration', 'avg_speed', 'max_speed', 'idle_time', 'points_count']
+
+
+# завершённые рейсы автопарка пачками по chunk_size строк (keyset по id, а не OFFSET),
+# в памяти держится одна пачка; date_from/date_to - границы end_date [date_from, date_to)
+def exportTripChunks(fleet_id, date_from=None, date_to=None, chunk_size=None):
+    chunk_size = chunk_size or EXPORT_CHUNK
+    trips = Trip.objects.filter(fleet_id=fleet_id, is_finished=True).order_by('id') \
+        .values(*(TRIP_FIELDS + ['tripstats__' + field for field in STATS_FIELDS]))
+    if date_from is not None:
+        trips = trips.filter(end_date__gte=date_from)
+    if date_to is not None:
+        trips = trips.filter(end_date__lt=date_to)
+    last_id = 0
+    while True:
+        chunk = list(trips.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1]['id']
+
+
+def _stats(row):
+    if row['tripstats__points_count'] is None:
+        return None
+    return {field: row['tripstats__' + field] for field in STATS_FIELDS}
+
+
+# одна строка JSON на рейс, по куску ответа на пачку
+def ndjsonLines(chunks):
+    for chunk in chunks:
+        lines = []
+        for row in chunk:
+            trip = {field: row[field] for field in TRIP_FIELDS}
+            trip['stats'] = _stats(row)
+            lines.append(json.dumps(trip, cls=DjangoJSONEncoder) + "\n")
+        yield "".join(lines)
+
+
+class _Lines(object):
+    def write(self, value):
+        return value
+
+
+def csvLines(chunks):
+    writer = csv.writer(_Lines())
+    yield writer.writerow(TRIP_FIELDS + STATS_FIELDS)
+    for chunk in chunks:
+        yield "".join(writer.writerow([row[field] for field in TRIP_FIELDS] +
+                                      [row['tripstats__' + field] for field in STATS_FIELDS]) for row in chunk)
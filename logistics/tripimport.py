@@ -0,0 +1,81 @@
+import csv
+import io
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.utils import timezone
+
+from logistics.forms import AddTripForm
+from logistics.models import Trip
+
+IMPORT_MAX_ROWS = getattr(settings, 'TRIP_IMPORT_MAX_ROWS', 5000)
+IMPORT_ATTEMPTS = 3  # попытки вставки, если зарезервированные id заняты параллельным импортом
+
+
+# строки импорта: JSON-массив объектов, CSV в теле запроса (text/csv) или CSV-файл в поле file
+def readTripRows(request):
+    if request.content_type.startswith('text/csv'):
+        return list(csv.DictReader(io.StringIO(request.body.decode('utf-8-sig'))))
+    if 'file' in request.FILES:
+        return list(csv.DictReader(io.StringIO(request.FILES['file'].read().decode('utf-8-sig'))))
+    if isinstance(request.data, list):
+        return request.data
+    raise ValueError("Expected a JSON array, text/csv body or CSV file")
+
+
+# проверяет строки правилами AddTripForm; возвращает (рейсы, [{"row": номер, "errors": ...}])
+def validateTripRows(rows):
+    trips = []
+    errors = []
+    for number, row in enumerate(rows):
+        if not isinstance(row, dict):
+            errors.append({"row": number, "errors": ["Not an object"]})
+            continue
+        form = AddTripForm(row)
+        if form.is_valid():
+            trips.append(form.save(commit=False))
+        else:
+            errors.append({"row": number, "errors": form.errors})
+    return trips, errors
+
+
+# резервирует count id рейсов до вставки, чтобы сразу записать имя "<автопарк>#<id>".
+# На PostgreSQL id берутся из последовательности таблицы, на остальных СУБД - после
+# наибольшего выданного id; параллельный импорт тогда может занять те же id, и вставка
+# повторяется (см. createTrips).
+def _reserveTripIds(count):
+    table = Trip._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                           [table, count])
+            return [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT MAX(id) FROM " + table)
+        last = cursor.fetchone()[0] or 0
+        if connection.vendor == 'sqlite':
+            # AUTOINCREMENT не выдаёт повторно id удалённых рейсов
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+            row = cursor.fetchone()
+            if row is not None:
+                last = max(last, row[0])
+    return list(range(last + 1, last + 1 + count))
+
+
+# вставляет рейсы одним bulk_create сразу с итоговыми именами "<автопарк>#<id>",
+# без второго прохода UPDATE по вставленным строкам
+def createTrips(fleet, trips):
+    now = timezone.now()
+    for attempt in range(IMPORT_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                ids = _reserveTripIds(len(trips))
+                for trip, trip_id in zip(trips, ids):
+                    trip.id = trip_id
+                    trip.fleet = fleet
+                    trip.start_date = now
+                    trip.name = fleet.name + "#" + str(trip_id)
+                Trip.objects.bulk_create(trips)
+            return ids
+        except IntegrityError:
+            if attempt == IMPORT_ATTEMPTS - 1:
+                raise
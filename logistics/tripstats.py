@@ -0,0 +1,136 @@
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+from logistics.models import DriverPosition, TripStats, Trip
+
+EARTH_RADIUS = 6371000.0  # метры
+IDLE_SPEED = getattr(settings, 'TRIP_IDLE_SPEED', 0.5)  # м/с, медленнее - считается простоем
+# через сколько секунд после завершения рейса статистика пересчитывается по точкам всех воркеров
+RECOMPUTE_DELAY = getattr(settings, 'TRIP_STATS_RECOMPUTE_DELAY', 2 * getattr(settings, 'POSITION_FLUSH_INTERVAL', 2))
+
+
+# Статистика сразу для многих рейсов по их точкам, без цикла по точкам в Python.
+# Массивы отсортированы по (trip_id, время); seconds - время точки в секундах.
+# Возвращает {trip_id: {distance, track_duration, avg_speed, max_speed, idle_time, points_count}}
+def computeTripStats(trip_ids, lats, lons, seconds):
+    trip_ids = np.asarray(trip_ids)
+    if trip_ids.size == 0:
+        return {}
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lon = np.radians(np.asarray(lons, dtype=float))
+    seconds = np.asarray(seconds, dtype=float)
+
+    # отрезок i соединяет точки i и i+1; отрезки на стыке двух рейсов обнуляются
+    same = trip_ids[1:] == trip_ids[:-1]
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    distance = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1))) * same
+    dt = np.diff(seconds) * same
+    speed = np.divide(distance, dt, out=np.zeros_like(distance), where=dt > 0)
+    idle = np.where(speed < IDLE_SPEED, dt, 0)
+
+    # добиваем до длины числа точек, чтобы суммировать по индексам начала рейсов
+    starts = np.flatnonzero(np.concatenate(([True], ~same)))
+    ends = np.append(starts[1:], trip_ids.size) - 1
+    distance, speed, idle = (np.append(values, 0.0) for values in (distance, speed, idle))
+    total_distance = np.add.reduceat(distance, starts)
+    max_speed = np.maximum.reduceat(speed, starts)
+    idle_time = np.add.reduceat(idle, starts)
+    span = seconds[ends] - seconds[starts]
+    avg_speed = np.divide(total_distance, span, out=np.zeros_like(total_distance), where=span > 0)
+
+    stats = {}
+    for i, trip_id in enumerate(trip_ids[starts].tolist()):
+        stats[trip_id] = {
+            "distance": float(total_distance[i]),
+            "track_duration": float(span[i]),
+            "avg_speed": float(avg_speed[i]),
+            "max_speed": float(max_speed[i]),
+            "idle_time": float(idle_time[i]),
+            "points_count": int(ends[i] - starts[i] + 1),
+        }
+    return stats
+
+
+# время точки в секундах эпохи, посчитанное в БД; None - СУБД без такого выражения
+def _epoch_sql(vendor):
+    if vendor == 'postgresql':
+        return "EXTRACT(EPOCH FROM logistics_driverposition.timestamp)"
+    if vendor == 'sqlite':
+        return "(julianday(logistics_driverposition.timestamp) - 2440587.5) * 86400.0"
+    return None
+
+
+# точки рейсов колонками numpy: (trip_ids, lats, lons, seconds), по (trip_id, время)
+def _trackColumns(trip_ids):
+    positions = DriverPosition.objects.filter(trip_id__in=trip_ids).order_by('trip_id', 'timestamp')
+    epoch = _epoch_sql(connection.vendor)
+    if epoch is None:
+        rows = positions.values_list('trip_id', 'lat', 'lon', 'timestamp')
+        rows = [(trip_id, lat, lon, timestamp.timestamp()) for trip_id, lat, lon, timestamp in rows]
+    else:
+        rows = list(positions.extra(select={'seconds': epoch}).values_list('trip_id', 'lat', 'lon', 'seconds'))
+    data = np.array(rows, dtype=float).reshape(-1, 4)
+    return data[:, 0].astype(np.int64), data[:, 1], data[:, 2], data[:, 3]
+
+
+# пересчитывает и сохраняет TripStats для рейсов (при завершении рейса и в recompute_trip_stats)
+def updateTripStats(trips):
+    trips = {trip.id: trip for trip in trips}
+    if not trips:
+        return []
+    computed = computeTripStats(*_trackColumns(list(trips)))
+
+    result = []
+    for trip_id, trip in trips.items():
+        values = computed.get(trip_id, {"distance": 0.0, "track_duration": 0.0, "avg_speed": 0.0,
+                                        "max_speed": 0.0, "idle_time": 0.0, "points_count": 0})
+        duration = values["track_duration"]
+        if trip.start_date is not None and trip.end_date is not None:
+            duration = (trip.end_date - trip.start_date).total_seconds()
+        result.append(TripStats(trip_id=trip_id, distance=values["distance"], duration=duration,
+                                avg_speed=values["avg_speed"], max_speed=values["max_speed"],
+                                idle_time=values["idle_time"], points_count=values["points_count"]))
+    with transaction.atomic():
+        TripStats.objects.filter(trip_id__in=list(trips)).delete()
+        TripStats.objects.bulk_create(result)
+    return result
+
+
+# При завершении рейса статистика считается по точкам в БД и в очереди этого процесса, а точки,
+# принятые другими воркерами, попадают в БД только с их фоновым сбросом (до POSITION_FLUSH_INTERVAL).
+# Поэтому после коммита рейс пересчитывается ещё раз через RECOMPUTE_DELAY секунд. Таймер живёт
+# в памяти процесса: если воркер перезапустится раньше, статистика останется неполной до
+# manage.py recompute_trip_stats.
+def recomputeTripStatsLater(trip_id, delay=None):
+    timer = threading.Timer(RECOMPUTE_DELAY if delay is None else delay, _recomputeTrip, (trip_id,))
+    timer.daemon = True
+    transaction.on_commit(timer.start)
+    return timer
+
+
+def _recomputeTrip(trip_id):
+    try:
+        updateTripStats(Trip.objects.filter(id=trip_id).only('id', 'start_date', 'end_date'))
+    except Exception as e:
+        print("EXCEPTION WHILE recomputing stats of trip " + str(trip_id) + ": " + str(e))
+    finally:
+        close_old_connections()
+
+
+# пересчёт для всех завершённых рейсов пачками по chunk_size
+def recomputeFinishedTrips(chunk_size=1000, fleet_id=None):
+    trips = Trip.objects.filter(is_finished=True).only('id', 'start_date', 'end_date').order_by('id')
+    if fleet_id is not None:
+        trips = trips.filter(fleet_id=fleet_id)
+    last_id = 0
+    total = 0
+    while True:
+        chunk = list(trips.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            return total
+        updateTripStats(chunk)
+        total += len(chunk)
+        last_id = chunk[-1].id
@@ -37,6 +37,11 @@ urlpatterns = [
         name='trips-by-fleet-unaccepted'),
     url(r'^api/fleet/(?P<fleet_id>[-\w]+)/trips/finished/$', api.TripsByFleetFinished().as_view(),
         name='trips-by-fleet-finished'),
+    url(r'^api/fleet/(?P<fleet_id>[-\w]+)/trips/finished/export\.(?P<export_format>ndjson|csv)$',
+        api.TripsByFleetFinishedExport.as_view(), name='trips-by-fleet-finished-export'),
+    url(r'^api/fleet/(?P<fleet_id>[-\w]+)/positions/$', api.FleetPositions.as_view(), name='fleet-positions'),
+    url(r'^api/fleet/(?P<fleet_id>[-\w]+)/events/$', api.FleetEvents.as_view(), name='fleet-events'),
+    url(r'^api/fleet/(?P<fleet_id>[-\w]+)/nearest_drivers/$', api.NearestDrivers.as_view(), name='fleet-nearest-drivers'),
     url(r'^api/fleet/(?P<fleet_id>[-\w]+)/$', api.FleetByIdView().as_view(), name='fleet-by-id'),
 
     # Driver API
@@ -46,6 +51,7 @@ urlpatterns = [
     url(r'^api/driver/fleets/$', api.DriverFleets.as_view(), name='driver-fleets'),
     url(r'^api/driver/fleet/(?P<fleet_id>[-\w]+)/available_trips/$', api.DriverFleetAvailableTrips.as_view(), name='driver-fleet-available-trips'),
     url(r'^api/driver/available_trips/$', api.DriverAvailableTrips.as_view(), name='driver-available-trips'),
+    url(r'^api/driver/available_trips/wait/$', api.DriverWaitTrips.as_view(), name='driver-wait-trips'),
     url(r'^api/driver/fleet/(?P<fleet_id>[-\w]+)/trips/$', api.DriverFleetTrips.as_view(), name='driver-fleet-trips'),
     url(r'^api/driver/trips/$', api.DriverTrips.as_view(), name='driver-trips'),
     url(r'^api/driver/accept_trip/$', api.DriverAcceptTrip.as_view(), name='driver-accept-trip'),
@@ -56,10 +62,14 @@ urlpatterns = [
 
     # Driver&Owner API
     url(r'^api/fleet/(?P<fleet_id>[-\w]+)/add_trip/$', api.AddTrip.as_view(), name='driver-add-trip'),
+    url(r'^api/fleet/(?P<fleet_id>[-\w]+)/import_trips/$', api.ImportTrips.as_view(), name='import-trips'),
     url(r'^api/trip/(?P<trip_id>[-\w]+)/$', api.TripById.as_view(), name='driver-trip-id'),
+    url(r'^api/trip/(?P<trip_id>[-\w]+)/track/$', api.TripTrack.as_view(), name='trip-track'),
 
     # Admin API
     url(r'^api/reload/$', api.ReloadGeo.as_view(), name='admin-restart-geo'),
+    url(r'^api/reload/status/$', api.Geo2TagStartupStats.as_view(), name='admin-startup-geo'),
+    url(r'^api/position_queue/$', api.PositionQueueStats.as_view(), name='admin-position-queue'),
 
     # default
     url(r'^', views.home, name='home'),
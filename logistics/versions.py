@@ -0,0 +1,194 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+from rest_framework import status
+from rest_framework.response import Response
+
+from logistics.models import DataVersion, Driver, Fleet, Owner, Trip
+
+RESPONSE_CACHE_TTL = getattr(settings, 'RESPONSE_CACHE_TTL', 10 * 60)
+PROFILE_CACHE_TTL = getattr(settings, 'PROFILE_CACHE_TTL', 5 * 60)
+
+
+# Счётчики версий данных автопарка ('fleet'), набора автопарков владельца ('owner')
+# и членства водителя в автопарках ('driver'). Хранятся в таблице DataVersion, общей для всех
+# воркеров: повышение версии в одном процессе сразу меняет ETag во всех остальных.
+# Сами списки и id автопарков кэшируются локально под ключом с версией, поэтому устаревают вместе с ней.
+# Любое изменение, видимое в списках, повышает версию: обычные save()/delete() - через сигналы ниже,
+# а bulk_create, update() и массовые операции со связями в api.py вызывают bump* явно,
+# потому что сигналов не посылают.
+def getVersions(keys):
+    by_scope = {}
+    for scope, pk in keys:
+        by_scope.setdefault(scope, set()).add(int(pk))
+    condition = Q()
+    for scope, pks in by_scope.items():
+        condition |= Q(scope=scope, key__in=pks)
+    versions = {}
+    if by_scope:
+        versions = {(scope, key): version for scope, key, version in
+                    DataVersion.objects.filter(condition).values_list('scope', 'key', 'version')}
+    # ещё не менявшиеся данные - версия 0, строка появится при первом bump
+    return [versions.get((scope, int(pk)), 0) for scope, pk in keys]
+
+
+def bump(scope, pks):
+    pks = set(int(pk) for pk in pks)
+    if not pks:
+        return
+    versions = DataVersion.objects.filter(scope=scope, key__in=pks)
+    if versions.update(version=F('version') + 1) == len(pks):
+        return
+    missing = pks - set(versions.values_list('key', flat=True))
+    # новая строка начинается с текущего времени, а не с 1, чтобы после очистки таблицы
+    # не совпасть со старым ETag
+    start = int(time.time() * 1000)
+    try:
+        with transaction.atomic():
+            DataVersion.objects.bulk_create([DataVersion(scope=scope, key=pk, version=start) for pk in missing])
+    except IntegrityError:
+        # строку создал параллельный запрос
+        DataVersion.objects.filter(scope=scope, key__in=missing).update(version=F('version') + 1)
+
+
+# изменились рейсы, водители или свойства автопарков
+def bumpFleets(fleet_ids):
+    bump('fleet', fleet_ids)
+
+
+# изменилось членство водителей в автопарках fleet_ids
+def bumpMembership(fleet_ids, driver_ids):
+    bumpFleets(fleet_ids)
+    bump('driver', driver_ids)
+
+
+# изменился текущий рейс водителя - он виден в списках водителей всех его автопарков
+def bumpDriverFleets(driver_id):
+    bumpFleets(Driver.fleets.through.objects.filter(driver_id=driver_id).values_list('fleet_id', flat=True))
+
+
+def _profile_key(kind, user_id):
+    return 'logistics:profile:' + kind + ':' + str(user_id)
+
+
+# id профиля владельца/водителя пользователя; меняется только при удалении профиля,
+# поэтому кэшируется на PROFILE_CACHE_TTL и сбрасывается сигналом ниже
+def profileId(user, kind):
+    key = _profile_key(kind, user.pk)
+    pk = cache.get(key)
+    if pk is None:
+        pk = getattr(user, kind).pk
+        cache.set(key, pk, PROFILE_CACHE_TTL)
+    return pk
+
+
+# автопарки водителя для текущей версии его членства
+def driverFleetIds(driver_id):
+    return _fleetIds('driver', driver_id,
+                     Driver.fleets.through.objects.filter(driver_id=driver_id).values_list('fleet_id', flat=True))
+
+
+# автопарки владельца для текущей версии их набора
+def ownerFleetIds(owner_id):
+    return _fleetIds('owner', owner_id, Fleet.objects.filter(owner_id=owner_id).values_list('id', flat=True))
+
+
+def _fleetIds(scope, pk, fleet_ids_query):
+    version, = getVersions([(scope, pk)])
+    key = 'logistics:fleet_ids:' + scope + ':' + str(pk) + ':' + str(version)
+    fleet_ids = cache.get(key)
+    if fleet_ids is None:
+        fleet_ids = sorted(fleet_ids_query)
+        cache.set(key, fleet_ids, RESPONSE_CACHE_TTL)
+    return fleet_ids
+
+
+# Ответ со списком, закэшированный по версиям scopes. ETag - хэш пути, параметров,
+# пользователя и версий; If-None-Match с тем же ETag получает 304 без запросов к данным и сериализации.
+# bucket - дополнительный ключ для данных, зависящих от времени (is_online водителей).
+def versionedResponse(request, scopes, build, bucket=None):
+    versions = getVersions(scopes)
+    source = '|'.join([request.get_full_path(), str(request.user.pk), str(bucket),
+                       ','.join(scope + str(pk) for scope, pk in scopes), ','.join(map(str, versions))])
+    etag = '"' + hashlib.sha1(source.encode('utf-8')).hexdigest() + '"'
+    if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        key = 'logistics:response:' + etag
+        data = cache.get(key)
+        if data is None:
+            data = build()
+            cache.set(key, data, RESPONSE_CACHE_TTL)
+        response = Response(data, status=status.HTTP_200_OK)
+    response['ETag'] = etag
+    return response
+
+
+# автопарки, удаляемые в этом потоке: их рейсы удаляются каскадом, и версия автопарка
+# повышается один раз в fleet_changed, а не UPDATE на каждый рейс
+_deleting = threading.local()
+
+
+def _deletingFleets():
+    if not hasattr(_deleting, 'fleet_ids'):
+        _deleting.fleet_ids = set()
+    return _deleting.fleet_ids
+
+
+@receiver(post_save, sender=Trip)
+@receiver(post_delete, sender=Trip)
+def trip_changed(sender, instance, **kwargs):
+    if kwargs['signal'] is post_delete and instance.fleet_id in _deletingFleets():
+        return
+    bumpFleets([instance.fleet_id])
+
+
+@receiver(pre_delete, sender=Fleet)
+def fleet_deleting(sender, instance, **kwargs):
+    _deletingFleets().add(instance.pk)
+
+
+@receiver(post_save, sender=Fleet)
+@receiver(post_delete, sender=Fleet)
+def fleet_changed(sender, instance, **kwargs):
+    _deletingFleets().discard(instance.pk)
+    bumpFleets([instance.pk])
+    bump('owner', [instance.owner_id])
+
+
+# если удаление автопарка упало до post_delete, отметка не должна пережить запрос
+@receiver(request_finished)
+def forget_deleting_fleets(sender, **kwargs):
+    _deletingFleets().clear()
+
+
+@receiver(post_delete, sender=Owner)
+@receiver(post_delete, sender=Driver)
+def profile_deleted(sender, instance, **kwargs):
+    cache.delete(_profile_key('owner' if sender is Owner else 'driver', instance.user_id))
+
+
+@receiver(post_save, sender=Driver)
+def driver_changed(sender, instance, created, **kwargs):
+    if not created:
+        bumpDriverFleets(instance.pk)
+
+
+@receiver(m2m_changed, sender=Driver.fleets.through)
+def membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        fleet_ids = pk_set if pk_set is not None else instance.fleets.values_list('pk', flat=True)
+        bumpMembership(fleet_ids, [instance.pk])
+    else:
+        driver_ids = pk_set if pk_set is not None else instance.fleets.values_list('pk', flat=True)
+        bumpMembership([instance.pk], driver_ids)
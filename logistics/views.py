@@ -6,7 +6,7 @@ from logistics.Geo2TagService import getFleetMap
 from logistics.forms import SignUpForm
 from django.contrib.auth.models import User, Group
 from .models import Driver, Owner, DriverStats
-from logistics.permissions import is_driver, is_owner, IsOwnerPermission, IsDriverPermission, IsOwnerOrDriverPermission
+from logistics.permissions import is_driver, is_owner, owns_fleet, IsOwnerPermission, IsDriverPermission, IsOwnerOrDriverPermission
 
 
 @permission_classes((IsOwnerPermission, ))
@@ -47,12 +47,14 @@ def ownerFleets(request):
 
 @permission_classes((IsOwnerPermission, ))
 def ownerFleetId(request, fleet_id):
-    return render(request, 'logistics/owner-fleet-id.html', {"fleet_id": fleet_id, "map_url": getFleetMap(fleet_id), "username": request.user.username})
+    map_url = getFleetMap(fleet_id) if owns_fleet(request.user, fleet_id) else None
+    return render(request, 'logistics/owner-fleet-id.html', {"fleet_id": fleet_id, "map_url": map_url, "username": request.user.username})
 
 
 @permission_classes((IsOwnerPermission, ))
 def map(request, fleet_id):
-    return render(request, 'logistics/owner-fleet-id-map.html', {"fleet_id": fleet_id, "map_url": getFleetMap(fleet_id), "username": request.user.username})
+    map_url = getFleetMap(fleet_id) if owns_fleet(request.user, fleet_id) else None
+    return render(request, 'logistics/owner-fleet-id-map.html', {"fleet_id": fleet_id, "map_url": map_url, "username": request.user.username})
 
 
 @permission_classes((IsDriverPermission, ))